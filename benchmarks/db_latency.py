@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime, timedelta
+from typing import List
+
+from dotenv import load_dotenv
+from src.db import BaseDB, MongoDB
+from src.sqlite_db import SQLiteDB
+from src.columnar import ColumnarDB, GuildColumns
+
+BENCH_GUILD = 'bench_guild'
+
+def time_call(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def fill_db(db: BaseDB, user_count: int, tick_count: int) -> List[float]:
+    start_time = datetime.now() - timedelta(minutes=tick_count)
+    tick_times = []
+    for tick in range(tick_count):
+        tick_start = start_time + timedelta(minutes=tick)
+        # Every tenth tick a user switches game so sessions get closed as well
+        samples = [(f'user{user}', [f'game{(user + tick//10) % 7}'], tick_start, tick_start + timedelta(minutes=1))
+                   for user in range(user_count)]
+        tick_times.append(time_call(db.add_activities_samples_bulk, BENCH_GUILD, samples))
+    return tick_times
+
+def run(name: str, db: BaseDB, user_count: int, tick_count: int):
+    db.delete_guild_data(BENCH_GUILD)
+    tick_times = fill_db(db, user_count, tick_count)
+    query_times = {
+        'aggregated_user': time_call(db.get_aggregated_activities, BENCH_GUILD, 'user1', None),
+        'aggregated_server_week': time_call(db.get_aggregated_activities, BENCH_GUILD, None, datetime.now() - timedelta(days=7)),
+        'longest_server': time_call(db.get_longest_activities, BENCH_GUILD, None, None),
+        'raw_sessions': time_call(db.get_raw_sessions_data, BENCH_GUILD, None),
+    }
+    db.delete_guild_data(BENCH_GUILD)
+    print(f'{name}: tick {1000*sum(tick_times)/len(tick_times):.2f}ms avg for {user_count} users, ' +
+          ', '.join(f'{query} {1000*duration:.2f}ms' for query, duration in query_times.items()))
+
+if __name__ == '__main__':
+    load_dotenv()
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tick_count = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run('sqlite', SQLiteDB(sqlite_path=os.path.join(temp_dir, 'bench.db')), user_count, tick_count)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        columnar_db = ColumnarDB(SQLiteDB(sqlite_path=os.path.join(temp_dir, 'bench.db')), os.path.join(temp_dir, 'columnar'))
+        run('sqlite+columnar', columnar_db, user_count, tick_count)
+        fill_db(columnar_db, user_count, tick_count)
+        columnar_db.close()
+        reload_time = time_call(GuildColumns, os.path.join(temp_dir, 'columnar', BENCH_GUILD), columnar_db.session_break_delay_)
+        print(f'columnar reload: {1000*reload_time:.2f}ms')
+    mongo_url = os.getenv('MONGO_URL')
+    if mongo_url:
+        run('mongo', MongoDB(mongo_url=mongo_url), user_count, tick_count)
+    else:
+        print('MONGO_URL not set, skipping MongoDB')
@@ -0,0 +1,52 @@
+import sys
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from src.binning import bin_sessions_weekly, get_session_arrays, HEATMAP_TIME_OFFSET
+
+def loop_bin_sessions(sessions_data):
+    # Binning loop from the previous plot_session_heatmap
+    data_samples = []
+    for session in sessions_data:
+        start_timestamp = session['start_time'] + HEATMAP_TIME_OFFSET
+        duration_left = session['duration']
+        while duration_left > 0:
+            next_timestamp = start_timestamp.replace(second=0, microsecond=0) + timedelta(seconds=1800)
+            iter_duration = min(duration_left, (next_timestamp - start_timestamp).total_seconds())
+            data_samples.append((
+                start_timestamp.isoweekday(),
+                start_timestamp.hour*2 + math.floor(start_timestamp.minute/30),
+                iter_duration))
+            duration_left -= iter_duration
+            start_timestamp = next_timestamp
+    xx_weekday = [sample[0] for sample in data_samples]
+    yy_hours = [sample[1] for sample in data_samples]
+    weights = [sample[2]/60 for sample in data_samples]
+    return np.histogram2d(xx_weekday, yy_hours, bins=[np.arange(0.5, 8, 1), np.arange(24*2+1)], weights=weights)[0]
+
+def generate_sessions(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    base_time = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=365)
+    return [{'name': 'game', 'start_time': base_time + timedelta(minutes=30*rng.randrange(2*24*365)), 'duration': 60.0*rng.randrange(1, 300)}
+            for _ in range(count)]
+
+def run(count: int):
+    sessions_data = generate_sessions(count)
+    start = time.perf_counter()
+    loop_weights = loop_bin_sessions(sessions_data)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    arrays = get_session_arrays(sessions_data)
+    convert_time = time.perf_counter() - start
+    start = time.perf_counter()
+    weights = bin_sessions_weekly(*arrays)
+    bin_time = time.perf_counter() - start
+    assert np.allclose(weights/60, loop_weights), 'Binning engine and loop disagree'
+    print(f'{count} sessions: loop {loop_time:.3f}s, engine {bin_time:.4f}s (+{convert_time:.3f}s array conversion), {loop_time/bin_time:.0f}x')
+
+if __name__ == '__main__':
+    for count in map(int, sys.argv[1:] or [1000, 10000, 100000]):
+        run(count)
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from src.db import BaseDB, MongoDB
+from src.sqlite_db import SQLiteDB
+from src.columnar import ColumnarDB
+
+BENCH_GUILD = 'bench_guild'
+
+def fill_db(db: BaseDB, member_count: int, days: int):
+    # One evening session a day for every member, spread over 20 games
+    start_time = datetime.now() - timedelta(days=days)
+    for day in range(days):
+        session_start = start_time + timedelta(days=day)
+        samples = [(f'user{member}', [f'game{(member + day) % 20}'], session_start + timedelta(minutes=member % 60),
+                    session_start + timedelta(minutes=member % 60 + 30 + member % 90))
+                   for member in range(member_count)]
+        for index in range(0, len(samples), 1000):
+            db.add_activities_samples_bulk(BENCH_GUILD, samples[index:index+1000])
+
+def run(name: str, db: BaseDB, member_count: int, days: int):
+    db.delete_guild_data(BENCH_GUILD)
+    fill_db(db, member_count, days)
+    from_time = datetime.now() - timedelta(days=7)
+    timings = dict()
+    for label, game in [('all games', None), ('one game', 'game3')]:
+        start = time.perf_counter()
+        db.get_user_leaderboard(BENCH_GUILD, game, from_time)
+        timings[f'leaderboard {label}'] = time.perf_counter() - start
+    # What ranking members took before, one aggregation per member
+    start = time.perf_counter()
+    for member in range(member_count):
+        db.get_aggregated_activities(BENCH_GUILD, f'user{member}', from_time)
+    timings['per member queries'] = time.perf_counter() - start
+    db.delete_guild_data(BENCH_GUILD)
+    print(f'{name} ({member_count} members, {days} days): ' + ', '.join(f'{label} {1000*duration:.1f}ms' for label, duration in timings.items()))
+
+if __name__ == '__main__':
+    load_dotenv()
+    member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run('sqlite', SQLiteDB(sqlite_path=os.path.join(temp_dir, 'bench.db')), member_count, days)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        columnar_db = ColumnarDB(SQLiteDB(sqlite_path=os.path.join(temp_dir, 'bench.db')), os.path.join(temp_dir, 'columnar'))
+        run('sqlite+columnar', columnar_db, member_count, days)
+        columnar_db.close()
+    mongo_url = os.getenv('MONGO_URL')
+    if mongo_url:
+        run('mongo', MongoDB(mongo_url=mongo_url), member_count, days)
+        run('mongo+rollups', MongoDB(mongo_url=mongo_url, use_rollups=True), member_count, days)
+    else:
+        print('MONGO_URL not set, skipping MongoDB')
@@ -0,0 +1,188 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import subprocess
+from datetime import datetime, timedelta
+from typing import List, Dict, Callable, Awaitable
+
+import numpy as np
+import discord
+from src import log as logging
+from src.db import BaseDB
+from src.sqlite_db import SQLiteDB
+from src.bot import TrakBot
+
+GAMES = [f'Game {index}' for index in range(50)]
+# Popular games get most of the play time like on a real server
+GAME_WEIGHTS = [1/(index+1) for index in range(len(GAMES))]
+
+class FakeActivity():
+    def __init__(self, name: str):
+        self.name = name
+        self.type = discord.ActivityType.playing
+
+class FakeMember():
+    def __init__(self, member_id: int, bot: bool = False):
+        self.id = member_id
+        self.name = f'member{member_id}'
+        self.bot = bot
+        self.activities = []
+
+class FakeGuild():
+    def __init__(self, guild_id: int, members: List[FakeMember]):
+        self.id = guild_id
+        self.name = f'guild{guild_id}'
+        self.members = members
+        self.id_to_member_ = {member.id: member for member in members}
+
+    def get_member(self, member_id: int) -> FakeMember:
+        return self.id_to_member_.get(member_id)
+
+class FakeClient():
+    def __init__(self, guilds: List[FakeGuild]):
+        self.guilds = guilds
+
+class CountingDB():
+    # Passes every call through to the wrapped db and counts them per method
+    def __init__(self, db: BaseDB):
+        self.db_ = db
+        self.call_counts_ = dict()
+
+    def __getattr__(self, name: str):
+        db_attr = getattr(self.db_, name)
+        if not callable(db_attr) or name == 'get_round_trip_count':
+            return db_attr
+        def counted_method(*args, **kwargs):
+            self.call_counts_[name] = self.call_counts_.get(name, 0) + 1
+            return db_attr(*args, **kwargs)
+        return counted_method
+
+    def get_call_count(self) -> int:
+        return sum(self.call_counts_.values())
+
+class PlayPattern():
+    def __init__(self, play_probability: float = 0.3, switch_probability: float = 0.05, seed: int = 0):
+        self.play_probability_ = play_probability
+        self.switch_probability_ = switch_probability
+        self.rng_ = random.Random(seed)
+
+    def random_game(self) -> str:
+        return self.rng_.choices(GAMES, GAME_WEIGHTS)[0]
+
+    def step(self, members: List[FakeMember]):
+        # Members keep playing, start, stop or switch games with fixed per tick chances
+        for member in members:
+            if self.rng_.random() >= self.switch_probability_:
+                continue
+            if self.rng_.random() < self.play_probability_:
+                member.activities = [FakeActivity(self.random_game())]
+            else:
+                member.activities = []
+
+    def reset(self, members: List[FakeMember]):
+        for member in members:
+            member.activities = [FakeActivity(self.random_game())] if self.rng_.random() < self.play_probability_ else []
+
+def create_client(guild_count: int, member_count: int) -> FakeClient:
+    guilds = []
+    for guild_index in range(guild_count):
+        members = [FakeMember(guild_index*member_count + member_index + 1) for member_index in range(member_count)]
+        members.append(FakeMember(guild_index*member_count + member_count + 1, bot=True))
+        guilds.append(FakeGuild(guild_index + 1, members))
+    return FakeClient(guilds)
+
+def seed_history(db: BaseDB, client: FakeClient, pattern: PlayPattern, days: int):
+    # Writes hourly samples for the past days so queries and heatmaps have data to go through
+    start_time = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=days)
+    for hour in range(days*24):
+        sample_start = start_time + timedelta(hours=hour)
+        for guild in client.guilds:
+            pattern.step(guild.members)
+            samples = [(member.id, [activity.name for activity in member.activities], sample_start, sample_start + timedelta(hours=1))
+                       for member in guild.members if member.activities and not member.bot]
+            if samples:
+                db.add_activities_samples_bulk(guild.id, samples)
+
+def get_percentiles(durations: List[float]) -> Dict[str, float]:
+    durations_ms = 1000*np.array(durations)
+    return {'p50_ms': float(np.percentile(durations_ms, 50)), 'p99_ms': float(np.percentile(durations_ms, 99)),
+            'mean_ms': float(durations_ms.mean()), 'count': len(durations)}
+
+async def time_query(bot: TrakBot, query_func: Callable[[], Awaitable], iterations: int) -> Dict[str, float]:
+    durations = []
+    for _ in range(iterations):
+        # Measure the uncached path, a cache hit tells nothing about the db
+        bot.cache_.clear()
+        start = time.perf_counter()
+        await query_func()
+        durations.append(time.perf_counter() - start)
+    return get_percentiles(durations)
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+async def run(member_count: int, guild_count: int, tick_count: int, history_days: int, query_iterations: int) -> dict:
+    db = CountingDB(SQLiteDB(sqlite_path=':memory:'))
+    client = create_client(guild_count, member_count)
+    pattern = PlayPattern()
+    seed_start = time.perf_counter()
+    seed_history(db, client, pattern, history_days)
+    seed_time = time.perf_counter() - seed_start
+    db.call_counts_.clear()
+    for guild in client.guilds:
+        pattern.reset(guild.members)
+
+    bot = TrakBot(client, db, update_time=60)
+    tick_durations, tick_db_calls, tick_round_trips, tick_samples = [], [], [], []
+    for _ in range(tick_count):
+        for guild in client.guilds:
+            pattern.step(guild.members)
+        calls_start = db.get_call_count()
+        round_trips_start = db.get_round_trip_count()
+        start = time.perf_counter()
+        tick_samples.append(await bot.update_tracker())
+        tick_durations.append(time.perf_counter() - start)
+        tick_db_calls.append(db.get_call_count() - calls_start)
+        tick_round_trips.append(db.get_round_trip_count() - round_trips_start)
+
+    guild_id = client.guilds[0].id
+    user_id = client.guilds[0].members[0].id
+    week_ago = datetime.now() - timedelta(days=7)
+    queries = {
+        'aggregated_user_week': lambda: bot.get_aggregated_activity_data(guild_id, user_id, week_ago),
+        'aggregated_server_week': lambda: bot.get_aggregated_activity_data(guild_id, None, week_ago),
+        'aggregated_server_total': lambda: bot.get_aggregated_activity_data(guild_id, None, None),
+        'longest_user': lambda: bot.get_longest_activity_data(guild_id, user_id),
+        'longest_server': lambda: bot.get_longest_activity_data(guild_id, None),
+        'heatmap_server': lambda: bot.plot_session_weekly_heatmap(guild_id, None),
+    }
+    query_results = dict()
+    for query_name, query_func in queries.items():
+        query_results[query_name] = await time_query(bot, query_func, query_iterations)
+    bot.close()
+
+    return {
+        'commit': get_git_commit(),
+        'time': datetime.now().isoformat(),
+        'config': {'members': member_count, 'guilds': guild_count, 'ticks': tick_count, 'history_days': history_days,
+                   'query_iterations': query_iterations, 'backend': 'sqlite'},
+        'seed_seconds': seed_time,
+        'tick': {**get_percentiles(tick_durations),
+                 'db_calls_per_tick': float(np.mean(tick_db_calls)),
+                 'round_trips_per_tick': float(np.mean(tick_round_trips)),
+                 'samples_per_tick': float(np.mean(tick_samples))},
+        'db_calls': db.call_counts_,
+        'queries': query_results,
+    }
+
+if __name__ == '__main__':
+    # Logs go to stdout as well, keep them out of the JSON
+    logging.set_log_level(logging.Level.WARNING)
+    args = [int(arg) for arg in sys.argv[1:]]
+    member_count, guild_count, tick_count, history_days, query_iterations = args + [1000, 4, 20, 30, 20][len(args):]
+    print(json.dumps(asyncio.run(run(member_count, guild_count, tick_count, history_days, query_iterations)), indent=2))
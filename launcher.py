@@ -0,0 +1,77 @@
+import sys
+import time
+import queue
+import asyncio
+import multiprocessing
+from typing import List
+
+import discord
+from src.log import Logger
+from src.config import Config
+from src.runner import run_bot
+
+_log = Logger('Launcher')
+# Discord allows one shard identify every 5 seconds
+WORKER_START_DELAY = 5.0
+HEALTH_TIMEOUT = 120.0
+
+def run_worker(config: Config, worker_id: int, shard_ids: List[int], shard_count: int, health_queue: multiprocessing.Queue):
+    start_time = time.monotonic()
+    discord.utils.setup_logging()
+    try:
+        asyncio.run(run_bot(config, shard_ids, shard_count, health_queue, worker_id, start_time))
+    except KeyboardInterrupt:
+        pass
+
+def split_shards(shard_count: int, worker_count: int) -> List[List[int]]:
+    return [list(range(worker_id, shard_count, worker_count)) for worker_id in range(worker_count)]
+
+def start_worker(context, config: Config, worker_id: int, shard_ids: List[int], shard_count: int, health_queue: multiprocessing.Queue):
+    process = context.Process(target=run_worker, args=(config, worker_id, shard_ids, shard_count, health_queue),
+                              name=f'worker-{worker_id}', daemon=True)
+    process.start()
+    _log.info(f'Started worker {worker_id} for shards {shard_ids} of {shard_count}')
+    return process
+
+def launch(config: Config, worker_count: int, shard_count: int):
+    context = multiprocessing.get_context('spawn')
+    health_queue = context.Queue()
+    worker_shards = split_shards(shard_count, worker_count)
+    workers = []
+    for worker_id, shard_ids in enumerate(worker_shards):
+        workers.append(start_worker(context, config, worker_id, shard_ids, shard_count, health_queue))
+        time.sleep(WORKER_START_DELAY*len(shard_ids))
+    last_reports = {worker_id: time.monotonic() for worker_id in range(worker_count)}
+    try:
+        while True:
+            try:
+                report = health_queue.get(timeout=WORKER_START_DELAY)
+                last_reports[report['worker_id']] = time.monotonic()
+                _log.info(f'Worker {report["worker_id"]}: {report["guilds"]} guilds, shard latencies {report["shard_latencies"]}, tracker {report["tracker"]}')
+            except queue.Empty:
+                pass
+            for worker_id, process in enumerate(workers):
+                if not process.is_alive():
+                    _log.error(f'Worker {worker_id} exited with {process.exitcode}, restarting')
+                    workers[worker_id] = start_worker(context, config, worker_id, worker_shards[worker_id], shard_count, health_queue)
+                    last_reports[worker_id] = time.monotonic()
+                elif time.monotonic() - last_reports[worker_id] > HEALTH_TIMEOUT:
+                    _log.warning(f'No health report from worker {worker_id} in {HEALTH_TIMEOUT}s')
+                    last_reports[worker_id] = time.monotonic()
+    except KeyboardInterrupt:
+        _log.info('Stopping workers')
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        _log.error('Usage: python launcher.py <worker count> [shard count] [debug]')
+        sys.exit(1)
+    worker_count = int(sys.argv[1])
+    shard_count = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else worker_count
+    if worker_count < 1 or shard_count < worker_count:
+        _log.error('Need at least one worker and at least as many shards as workers')
+        sys.exit(1)
+    launch(Config(debug=sys.argv[-1] == 'debug'), worker_count, shard_count)
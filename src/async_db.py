@@ -0,0 +1,51 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from .db import BaseDB
+from .metrics import registry
+
+class AsyncDB():
+    # Coroutine version of the BaseDB interface. Every BaseDB method is
+    # available with the same arguments and runs on a bounded pool of
+    # database threads so driver calls never block the event loop.
+    def __init__(self, db: BaseDB, max_workers: int = 8):
+        self.db_ = db
+        self.executor_ = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+
+    def __getattr__(self, name: str) -> Any:
+        db_attr = getattr(self.db_, name)
+        if not callable(db_attr):
+            return db_attr
+        @functools.wraps(db_attr)
+        async def db_method(*args, **kwargs):
+            return await self._run_timed(name, db_attr, *args, **kwargs)
+        return db_method
+
+    async def run(self, func: Callable[..., Any], *args, method: Optional[str] = None) -> Any:
+        # Runs func(db, *args) on a db thread, for work that iterates over the db.
+        # Timed under method, the name of func by default.
+        return await self._run_timed(method or func.__name__, func, self.db_, *args)
+
+    async def _run_timed(self, name: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        def timed_call():
+            # Timed on the db thread so waiting for a free thread isn't counted as db time
+            try:
+                with registry.timer('timetrak_db_call_seconds', method=name):
+                    return func(*args, **kwargs)
+            except Exception:
+                registry.inc('timetrak_db_call_errors_total', method=name)
+                raise
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor_, timed_call)
+
+    def get_round_trip_count(self) -> int:
+        return self.db_.get_round_trip_count()
+
+    def close(self):
+        self.executor_.shutdown(wait=True)
+        # Lets wrappers like the columnar store write their last snapshot
+        db_close = getattr(self.db_, 'close', None)
+        if db_close:
+            db_close()
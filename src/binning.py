@@ -0,0 +1,72 @@
+from typing import List, Tuple, TYPE_CHECKING
+from datetime import datetime, timedelta
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DAYS_IN_WEEK = 7
+BINS_IN_DAY = 48
+BIN_SECONDS = 1800
+BINS_IN_WEEK = DAYS_IN_WEEK*BINS_IN_DAY
+# Heatmaps are plotted in IST
+HEATMAP_TIME_OFFSET = timedelta(hours=5, minutes=30)
+# 1970-01-05 was a Monday, shifting epochs by this aligns bin 0 with Monday 00:00
+_EPOCH_WEEK_SHIFT = 4*24*3600
+
+def get_session_arrays(sessions_data: List[dict]) -> Tuple['np.ndarray', 'np.ndarray']:
+    import numpy as np
+    epoch = datetime(1970, 1, 1)
+    start_epochs = np.array([(session['start_time'] - epoch).total_seconds() for session in sessions_data], dtype=np.float64)
+    durations = np.array([session['duration'] for session in sessions_data], dtype=np.float64)
+    return start_epochs, durations
+
+def bin_sessions_weekly(start_epochs: 'np.ndarray', durations: 'np.ndarray', time_offset: timedelta = HEATMAP_TIME_OFFSET) -> 'np.ndarray':
+    # Returns seconds played in each (weekday, half hour) bin, Monday first.
+    # Sessions are split on bin boundaries: the partial first and last bins are
+    # added directly, the whole bins in between are added to a difference array.
+    import numpy as np
+    starts = np.asarray(start_epochs, dtype=np.float64) + time_offset.total_seconds() - _EPOCH_WEEK_SHIFT
+    ends = starts + np.asarray(durations, dtype=np.float64)
+    first_bins = np.floor(starts / BIN_SECONDS).astype(np.int64)
+    last_bins = np.floor(ends / BIN_SECONDS).astype(np.int64)
+    weights = np.zeros(BINS_IN_WEEK, dtype=np.float64)
+
+    single_bin = first_bins == last_bins
+    np.add.at(weights, first_bins[single_bin] % BINS_IN_WEEK, ends[single_bin] - starts[single_bin])
+
+    multi_bin = ~single_bin
+    first_bins, last_bins = first_bins[multi_bin], last_bins[multi_bin]
+    np.add.at(weights, first_bins % BINS_IN_WEEK, (first_bins + 1)*BIN_SECONDS - starts[multi_bin])
+    np.add.at(weights, last_bins % BINS_IN_WEEK, ends[multi_bin] - last_bins*BIN_SECONDS)
+
+    whole_bins = last_bins - first_bins - 1
+    weights += BIN_SECONDS * np.sum(whole_bins // BINS_IN_WEEK)
+    remaining_bins = whole_bins % BINS_IN_WEEK
+    range_starts = (first_bins + 1) % BINS_IN_WEEK
+    # Ranges can wrap past Sunday so the difference array covers two weeks
+    bin_deltas = np.zeros(2*BINS_IN_WEEK + 1, dtype=np.float64)
+    np.add.at(bin_deltas, range_starts, BIN_SECONDS)
+    np.add.at(bin_deltas, range_starts + remaining_bins, -BIN_SECONDS)
+    wrapped_weights = np.cumsum(bin_deltas)[:2*BINS_IN_WEEK]
+    weights += wrapped_weights[:BINS_IN_WEEK] + wrapped_weights[BINS_IN_WEEK:]
+    return weights.reshape(DAYS_IN_WEEK, BINS_IN_DAY)
+
+_EPOCH = datetime(1970, 1, 1)
+WEEK = timedelta(days=DAYS_IN_WEEK)
+
+def get_heatmap_week_start(time: datetime, time_offset: timedelta = HEATMAP_TIME_OFFSET) -> datetime:
+    # Start of the heatmap week (Monday 00:00 in heatmap time) that time falls in
+    shifted_seconds = (time - _EPOCH).total_seconds() + time_offset.total_seconds() - _EPOCH_WEEK_SHIFT
+    week_index = shifted_seconds // WEEK.total_seconds()
+    return _EPOCH + timedelta(seconds=week_index*WEEK.total_seconds() + _EPOCH_WEEK_SHIFT - time_offset.total_seconds())
+
+def split_by_heatmap_weeks(start_time: datetime, end_time: datetime) -> List[Tuple[datetime, datetime, float]]:
+    # (week_start, start_time, duration) for the parts of the range in each heatmap week
+    parts = []
+    week_start = get_heatmap_week_start(start_time)
+    while start_time < end_time:
+        part_end = min(end_time, week_start + WEEK)
+        parts.append((week_start, start_time, (part_end - start_time).total_seconds()))
+        start_time = part_end
+        week_start += WEEK
+    return parts
@@ -1,53 +1,81 @@
+import asyncio
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from io import BytesIO
+from typing import Optional, Dict, List, Callable, Awaitable, Any, Hashable
 
 import discord
 from .log import Logger
-from .db import BaseDB, IdType
+from .db import BaseDB, IdType, SampleType
+from .async_db import AsyncDB
 from .stats import StatsGenerator
+from .render import PlotRenderer
+from .cache import QueryCache
+from .flight import SingleFlight
+from .compaction import export_sessions
 
 _log = Logger('TrakBot')
 
 class TrakBot():
-    def __init__(self, client: discord.Client, db: BaseDB, update_time: int, session_break_delay: int = 10):
+    def __init__(self, client: discord.Client, db: BaseDB, update_time: int, session_break_delay: int = 10, event_driven: bool = False,
+                 renderer: Optional[PlotRenderer] = None, cache: Optional[QueryCache] = None, max_concurrent_writes: int = 4):
         self.client_ = client
-        self.db_ = db
+        self.db_ = AsyncDB(db)
         self.update_time_ = update_time
         self.session_break_delay_ = session_break_delay
+        self.event_driven_ = event_driven
         self.guild_to_tracked_users_ = {}
+        # Polling maps activity name to the last tick it was seen. Event driven
+        # mode maps it to the time up to which the session has been written.
         self.guild_user_to_current_activities_ = {}
         self.stats_gen_ = StatsGenerator(db)
+        self.renderer_ = renderer if renderer else PlotRenderer()
+        self.cache_ = cache if cache else QueryCache()
+        self.write_semaphore_ = asyncio.Semaphore(max_concurrent_writes)
+        self.single_flight_ = SingleFlight()
+        # Presence updates of a user are flushed one at a time so their writes land in order
+        self.user_locks_ = dict()
 
-    def update_tracker(self):
+    async def update_tracker(self) -> int:
         current_time = datetime.now()
-        self._check_data_structures()
+        await self._check_data_structures()
         _log.info(f'Updating tracker {current_time}')
+        round_trips_start = self.db_.get_round_trip_count()
+        guild_samples = []
         for guild in self.client_.guilds:
+            samples = []
             for user_id in self.guild_to_tracked_users_[str(guild.id)]:
-                self._update_tracker_for_user(guild, user_id, current_time)
+                sample = self._update_tracker_for_user(guild, user_id, current_time)
+                if sample:
+                    samples.append(sample)
+            if samples:
+                guild_samples.append((guild.id, samples))
+        await asyncio.gather(*[self._write_samples(guild_id, samples) for guild_id, samples in guild_samples])
+        samples_count = sum(len(samples) for _, samples in guild_samples)
+        _log.info(f'Tracker tick wrote {samples_count} samples with {self.db_.get_round_trip_count() - round_trips_start} db round trips')
+        return samples_count
 
-    def _check_data_structures(self):
+    async def _check_data_structures(self):
         for guild in self.client_.guilds:
             guild_id = str(guild.id)
             if guild_id not in self.guild_to_tracked_users_:
                 self.guild_to_tracked_users_[guild_id] = set()
-                self.guild_user_to_current_activities_[guild_id] = dict()
-            all_users = [str(user.id) for user in guild.members if not user.bot]
-            blacklisted_users = self.db_.get_blacklisted_users(guild_id)
-            tracked_users = list(filter(lambda user_id: user_id not in blacklisted_users, all_users))
-            self.guild_to_tracked_users_[guild_id].update(tracked_users)
+                # Kept when restored from a checkpoint
+                self.guild_user_to_current_activities_.setdefault(guild_id, dict())
+            blacklisted_users = await self.db_.get_blacklisted_user_set(guild_id)
+            tracked_users = [str(user.id) for user in guild.members if not user.bot and str(user.id) not in blacklisted_users]
+            self.guild_to_tracked_users_[guild_id] = set(tracked_users)
             for tracked_user in tracked_users:
                 if tracked_user not in self.guild_user_to_current_activities_[guild_id]:
                     self.guild_user_to_current_activities_[guild_id][str(tracked_user)] = dict()
 
-    def _update_tracker_for_user(self, guild: discord.Guild, user_id: IdType, current_time: datetime=datetime.now()):
+    def _update_tracker_for_user(self, guild: discord.Guild, user_id: IdType, current_time: datetime=datetime.now()) -> Optional[SampleType]:
         user = guild.get_member(int(user_id))
         if not user:
             _log.warning(f'User {user_id} not found in {guild.name}')
-            return
-        user_activities = [activity.name for activity in user.activities if activity.type == discord.ActivityType.playing]
+            return None
+        user_activities = self._get_playing_activities(user)
         if user_activities:
-            _log.debug(f'Updating data for user {user} doing {user_activities}')
+            _log.debug(lambda: f'Updating data for user {user} doing {user_activities}')
         ongoing_activities = self.guild_user_to_current_activities_[str(guild.id)][str(user.id)]
         updated_activities = []
         continued_activites = []
@@ -57,26 +85,186 @@ class TrakBot():
                 continued_activites.append(activity_name)
             updated_activities.append(activity_name)
 
-        if continued_activites:
-            self.db_.add_user_activities_sample(guild.id, user.id, continued_activites, prev_start_time, current_time)
         ongoing_activities.clear()
         for activity_name in updated_activities:
             ongoing_activities[activity_name] = current_time
+        if continued_activites:
+            return (user.id, continued_activites, prev_start_time, current_time)
+        return None
+
+    def _get_playing_activities(self, user: discord.Member) -> List[str]:
+        return [activity.name for activity in user.activities if activity.type == discord.ActivityType.playing]
+
+    async def on_presence_update(self, before: discord.Member, after: discord.Member):
+        guild_id = str(after.guild.id)
+        user_id = str(after.id)
+        if user_id not in self.guild_to_tracked_users_.get(guild_id, ()):
+            return
+        user_activities = self._get_playing_activities(after)
+        if set(self._get_playing_activities(before)) == set(user_activities):
+            return
+        async with self._get_user_lock(guild_id, user_id):
+            current_time = datetime.now()
+            _log.debug(lambda: f'Presence update for {after} now doing {user_activities}')
+            ongoing_activities = self.guild_user_to_current_activities_[guild_id].setdefault(user_id, dict())
+            # Every open activity is flushed, not just the stopped ones. Otherwise writing the
+            # user's sample closes the games still being played as if they had stopped.
+            samples = []
+            for activity_name, flushed_time in list(ongoing_activities.items()):
+                samples.append((user_id, [activity_name], flushed_time, current_time))
+                if activity_name in user_activities:
+                    ongoing_activities[activity_name] = current_time
+                else:
+                    del ongoing_activities[activity_name]
+            for activity_name in user_activities:
+                ongoing_activities.setdefault(activity_name, current_time)
+            if samples:
+                await self._write_samples(guild_id, samples)
+
+    def _get_user_lock(self, guild_id: IdType, user_id: IdType) -> asyncio.Lock:
+        return self.user_locks_.setdefault((str(guild_id), str(user_id)), asyncio.Lock())
+
+    async def _write_samples(self, guild_id: IdType, samples: List[SampleType]):
+        async with self.write_semaphore_:
+            await self.db_.add_activities_samples_bulk(guild_id, samples)
+        self.cache_.invalidate(guild_id, [sample[0] for sample in samples])
+
+    async def reconcile_tracker(self) -> int:
+        current_time = datetime.now()
+        await self._check_data_structures()
+        _log.info(f'Reconciling tracker {current_time}')
+        guild_samples = []
+        user_locks = []
+        for guild in self.client_.guilds:
+            samples = []
+            for user_id in self.guild_to_tracked_users_[str(guild.id)]:
+                user_lock = self._get_user_lock(guild.id, user_id)
+                if user_lock.locked():
+                    # A presence update is flushing this user right now
+                    continue
+                user_samples = self._reconcile_tracker_for_user(guild, user_id, current_time)
+                if user_samples:
+                    # Free, so it's taken without yielding to a presence update in between
+                    await user_lock.acquire()
+                    user_locks.append(user_lock)
+                    samples.extend(user_samples)
+            if samples:
+                guild_samples.append((guild.id, samples))
+        try:
+            await asyncio.gather(*[self._write_samples(guild_id, samples) for guild_id, samples in guild_samples])
+        finally:
+            for user_lock in user_locks:
+                user_lock.release()
+        samples_count = sum(len(samples) for _, samples in guild_samples)
+        _log.info(f'Reconciliation flushed {samples_count} samples')
+        return samples_count
+
+    def _reconcile_tracker_for_user(self, guild: discord.Guild, user_id: IdType, current_time: datetime) -> List[SampleType]:
+        ongoing_activities = self.guild_user_to_current_activities_[str(guild.id)][str(user_id)]
+        user = guild.get_member(int(user_id))
+        user_activities = self._get_playing_activities(user) if user else []
+        samples = []
+        for activity_name, flushed_time in list(ongoing_activities.items()):
+            if activity_name in user_activities:
+                samples.append((user_id, [activity_name], flushed_time, current_time))
+                ongoing_activities[activity_name] = current_time
+            else:
+                # Missed the stop event, the unknown tail after the last flush is dropped
+                del ongoing_activities[activity_name]
+        for activity_name in user_activities:
+            ongoing_activities.setdefault(activity_name, current_time)
+        return samples
+
+    def get_tracker_state(self) -> dict:
+        return {
+            'event_driven': self.event_driven_,
+            'activities': {guild_id: {user_id: {activity_name: activity_time.isoformat() for activity_name, activity_time in activities.items()}
+                                      for user_id, activities in user_to_activities.items() if activities}
+                           for guild_id, user_to_activities in self.guild_user_to_current_activities_.items()},
+        }
+
+    def restore_tracker_state(self, state: dict, max_age: float) -> int:
+        # Activities last seen more than max_age seconds ago can't be continued
+        # and start a new session as usual
+        if state.get('event_driven') != self.event_driven_:
+            _log.warning('Tracker checkpoint is from the other tracking mode, not restoring it')
+            return 0
+        oldest_time = datetime.now() - timedelta(seconds=max_age)
+        restored_count = 0
+        for guild_id, user_to_activities in state.get('activities', {}).items():
+            guild_activities = self.guild_user_to_current_activities_.setdefault(guild_id, dict())
+            for user_id, activities in user_to_activities.items():
+                for activity_name, activity_time in activities.items():
+                    activity_time = datetime.fromisoformat(activity_time)
+                    if activity_time >= oldest_time:
+                        guild_activities.setdefault(user_id, dict())[activity_name] = activity_time
+                        restored_count += 1
+        _log.info(f'Restored {restored_count} ongoing activities from the tracker checkpoint')
+        return restored_count
+
+    async def _get_cached_query(self, query_type: Hashable, query_func: Callable[..., Awaitable[Any]], guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime]) -> Any:
+        from_time = self.cache_.bucket_time(from_time)
+        key = (str(guild_id), str(user_id) if user_id else None, query_type, from_time)
+        found, result = self.cache_.get(key)
+        if not found:
+            result = await self.single_flight_.do(key, lambda: self._run_query(key, query_func, guild_id, user_id, from_time))
+        return result
+
+    async def _run_query(self, key: tuple, query_func: Callable[..., Awaitable[Any]], guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime]) -> Any:
+        generation = self.cache_.get_generation(guild_id)
+        result = await query_func(guild_id, user_id, from_time)
+        self.cache_.put(key, result, generation)
+        return result
+
+    async def get_aggregated_activity_data(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Dict[str, float]:
+        return await self._get_cached_query('aggregated', self.db_.get_aggregated_activities, guild_id, user_id, from_time)
+
+    async def get_last_activity_data(self, guild_id: IdType, user_id: IdType) -> Dict[str, float]:
+        return await self._get_cached_query('last', self.db_.get_last_activities, guild_id, user_id, None)
+
+    async def get_longest_activity_data(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> List[dict]:
+        return await self._get_cached_query('longest', self.db_.get_longest_activities, guild_id, user_id, from_time)
+
+    async def get_leaderboard_data(self, guild_id: IdType, game: Optional[str]=None, from_time: Optional[datetime]=None) -> List[dict]:
+        # Guild wide entry, so any write in the guild invalidates it
+        return await self._get_cached_query(('leaderboard', game), lambda guild_id, _, from_time: self.db_.get_user_leaderboard(guild_id, game, from_time),
+                                            guild_id, None, from_time)
+
+    def get_cache_stats(self) -> dict:
+        return self.cache_.get_stats()
+
+    async def reset_user_data(self, guild_id: IdType, user_id: IdType):
+        await self.db_.reset_user_data(guild_id, user_id)
+        self.cache_.invalidate(guild_id, [user_id])
+
+    async def reset_guild_data(self, guild_id: IdType):
+        await self.db_.reset_guild_data(guild_id)
+        self.cache_.invalidate(guild_id)
+
+    async def delete_user_data(self, guild_id: IdType, user_id: IdType):
+        await self.db_.delete_user_data(guild_id, user_id)
+        self.cache_.invalidate(guild_id, [user_id])
 
-    def get_aggregated_activity_data(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Dict[str, float]:
-        return self.db_.get_aggregated_activities(guild_id, user_id, from_time)
+    async def plot_session_weekly_heatmap(self, guild_id: IdType, user_id: Optional[IdType] = None, weeks: Optional[int] = None) -> BytesIO:
+        key = (str(guild_id), str(user_id) if user_id else None, 'heatmap', weeks)
+        # Every caller gets its own buffer over the shared png
+        png_data = await self.single_flight_.do(key, lambda: self._plot_session_weekly_heatmap(guild_id, user_id, weeks))
+        return BytesIO(png_data)
 
-    def get_last_activity_data(self, guild_id: IdType, user_id: IdType) -> Dict[str, float]:
-        return self.db_.get_last_activities(guild_id, user_id)
+    async def _plot_session_weekly_heatmap(self, guild_id: IdType, user_id: Optional[IdType], weeks: Optional[int]) -> bytes:
+        weights = await self.db_.run(lambda db: self.stats_gen_.get_session_heatmap(guild_id, user_id, weeks), method='get_session_heatmap')
+        plot_buffer = await self.renderer_.render_heatmap(weights)
+        return plot_buffer.getvalue()
 
-    def get_longest_activity_data(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> List[dict]:
-        return self.db_.get_longest_activities(guild_id, user_id, from_time)
+    async def export_guild_sessions(self, guild_id: IdType, file_path: str) -> int:
+        return await self.db_.run(export_sessions, str(guild_id), file_path)
 
-    def reset_user_data(self, guild_id: IdType, user_id: IdType):
-        self.db_.reset_user_data(guild_id, user_id)
+    async def run_maintenance(self):
+        await self.db_.run_maintenance()
 
-    def plot_session_weekly_heatmap(self, guild_id: IdType, user_id: Optional[IdType] = None, file_name: str = 'plot.png'):
-        self.stats_gen_.plot_session_heatmap(guild_id, user_id, file_name)
+    def close(self):
+        self.renderer_.shutdown()
+        self.db_.close()
 
 if __name__ == '__main__':
     import os
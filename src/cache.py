@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Any, Callable, Hashable, Iterable, Tuple
+
+from .log import Logger
+
+_log = Logger('Cache')
+
+class QueryCache():
+    # Keys are tuples starting with (guild_id, user_id) so entries can be
+    # invalidated per guild or per user. Guild wide entries use None as user_id.
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0, window_granularity: float = 60.0,
+                 time_func: Callable[[], float] = time.monotonic):
+        self.max_size_ = max_size
+        self.ttl_ = ttl
+        self.window_granularity_ = window_granularity
+        self.time_func_ = time_func
+        self.entries_ = OrderedDict()
+        # Bumped on every invalidation, so a query started before a write can tell
+        # that its result may be stale
+        self.guild_generations_ = dict()
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def bucket_time(self, from_time: Optional[datetime]) -> Optional[datetime]:
+        if not from_time:
+            return None
+        timestamp = from_time.timestamp()
+        return datetime.fromtimestamp(timestamp - timestamp % self.window_granularity_)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Tuple[bool, Any]:
+        entry = self.entries_.get(key, None)
+        if entry and entry[0] > self.time_func_():
+            self.entries_.move_to_end(key)
+            self.hits_ += 1
+            return True, entry[1]
+        if entry:
+            del self.entries_[key]
+        self.misses_ += 1
+        return False, None
+
+    def get_generation(self, guild_id: Hashable) -> int:
+        return self.guild_generations_.get(str(guild_id), 0)
+
+    def put(self, key: Tuple[Hashable, ...], value: Any, generation: Optional[int] = None):
+        # Pass the guild's generation from before the query to skip results that a
+        # write invalidated while they were computed
+        if generation is not None and generation != self.get_generation(key[0]):
+            _log.debug(lambda: f'Not caching {key}, the guild was written meanwhile')
+            return
+        self.entries_[key] = (self.time_func_() + self.ttl_, value)
+        self.entries_.move_to_end(key)
+        while len(self.entries_) > self.max_size_:
+            self.entries_.popitem(last=False)
+
+    def invalidate(self, guild_id: Hashable, user_ids: Optional[Iterable[Hashable]] = None):
+        guild_id = str(guild_id)
+        self.guild_generations_[guild_id] = self.guild_generations_.get(guild_id, 0) + 1
+        user_ids = set(str(user_id) for user_id in user_ids) if user_ids is not None else None
+        stale_keys = [key for key in self.entries_
+                      if key[0] == guild_id and (user_ids is None or key[1] is None or key[1] in user_ids)]
+        for key in stale_keys:
+            del self.entries_[key]
+        if stale_keys:
+            _log.debug(lambda: f'Invalidated {len(stale_keys)} cache entries for {guild_id}')
+
+    def clear(self):
+        self.entries_.clear()
+
+    def get_stats(self) -> dict:
+        return {'hits': self.hits_, 'misses': self.misses_, 'size': len(self.entries_)}
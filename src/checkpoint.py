@@ -0,0 +1,27 @@
+import os
+import json
+from typing import Optional
+
+from .log import Logger
+
+_log = Logger('Checkpoint')
+
+def save_state(file_path: str, state: dict):
+    # Written to a temporary name and renamed once synced, so a crash never
+    # leaves a partial checkpoint behind
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'w') as state_file:
+        json.dump(state, state_file)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(temp_path, file_path)
+
+def load_state(file_path: str) -> Optional[dict]:
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError) as e:
+        _log.warning(f'Ignoring unreadable checkpoint {file_path}: {e!r}')
+        return None
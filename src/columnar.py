@@ -0,0 +1,459 @@
+import os
+import json
+import shutil
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Tuple, Any, Callable
+import numpy as np
+
+from .log import Logger
+from .db import BaseDB, IdType, SampleType
+from .binning import bin_sessions_weekly
+
+_log = Logger('Columnar')
+_EPOCH = datetime(1970, 1, 1)
+SESSION_DTYPE = np.dtype([('start', '<f8'), ('duration', '<f8'), ('game', '<i4'), ('user', '<i4')])
+# Every log record sets one row, rows past the end are appended
+LOG_DTYPE = np.dtype([('row', '<i8'), ('start', '<f8'), ('duration', '<f8'), ('game', '<i4'), ('user', '<i4')])
+# Sessions that ended this long before a reload can't be continued by the tracker anymore
+OPEN_SESSION_WINDOW = 3600.0
+# The log is folded into a new snapshot once it holds this many records
+SNAPSHOT_LOG_RECORDS = 100000
+
+def to_epoch(time: datetime) -> float:
+    return (time - _EPOCH).total_seconds()
+
+def from_epoch(seconds: float) -> datetime:
+    return _EPOCH + timedelta(seconds=float(seconds))
+
+class _NameIndex():
+    # Interns names to ids in insertion order. New names are appended to a file
+    # before any row refers to them.
+    def __init__(self, file_path: str):
+        self.names_ = []
+        self.name_to_id_ = dict()
+        if os.path.exists(file_path):
+            with open(file_path) as names_file:
+                for line in names_file:
+                    try:
+                        self._add(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Only the last line can be cut short by a crash
+                        break
+        self.file_ = open(file_path, 'a')
+
+    def _add(self, name: str) -> int:
+        self.name_to_id_[name] = len(self.names_)
+        self.names_.append(name)
+        return self.name_to_id_[name]
+
+    def get_id(self, name: str, create: bool = True) -> Optional[int]:
+        name_id = self.name_to_id_.get(name, None)
+        if name_id is None and create:
+            name_id = self._add(name)
+            self.file_.write(json.dumps(name) + '\n')
+            self.file_.flush()
+        return name_id
+
+    def get_name(self, name_id: int) -> str:
+        return self.names_[name_id]
+
+    def __len__(self) -> int:
+        return len(self.names_)
+
+    def sync(self):
+        os.fsync(self.file_.fileno())
+
+    def close(self):
+        self.file_.close()
+
+class GuildColumns():
+    # Sessions of one guild as columns of start epoch, duration, game id and
+    # user index. Persisted as a snapshot .npy file plus a log of the rows
+    # written since the snapshot. The snapshot is memory mapped copy on write
+    # and queried in place, rows added after it are kept in a growable array.
+    # Row numbers count the snapshot rows first. Daily summaries of compacted
+    # sessions are kept apart with the day as start, they only count for totals.
+    def __init__(self, guild_dir: str, session_break_delay: float):
+        self.guild_dir_ = guild_dir
+        self.session_break_delay_ = session_break_delay
+        self.lock_ = threading.Lock()
+        os.makedirs(guild_dir, exist_ok=True)
+        self.games_ = _NameIndex(os.path.join(guild_dir, 'games.ndjson'))
+        self.users_ = _NameIndex(os.path.join(guild_dir, 'users.ndjson'))
+        snapshot_path = os.path.join(guild_dir, 'sessions.npy')
+        # Continued sessions update snapshot rows in memory, only the touched pages are copied
+        self.base_ = np.load(snapshot_path, mmap_mode='c') if os.path.exists(snapshot_path) else np.zeros(0, dtype=SESSION_DTYPE)
+        self.rows_ = np.zeros(1024, dtype=SESSION_DTYPE)
+        self.size_ = 0
+        summaries_path = os.path.join(guild_dir, 'summaries.npy')
+        self.summaries_ = np.load(summaries_path) if os.path.exists(summaries_path) else np.zeros(0, dtype=SESSION_DTYPE)
+        self.log_path_ = os.path.join(guild_dir, 'sessions.log')
+        self.log_record_count_ = 0
+        if os.path.exists(self.log_path_):
+            with open(self.log_path_, 'rb') as log_file:
+                log_data = log_file.read()
+            # A crash can leave a partial record at the end
+            self.log_record_count_ = len(log_data) // LOG_DTYPE.itemsize
+            self._replay(np.frombuffer(log_data[:self.log_record_count_*LOG_DTYPE.itemsize], dtype=LOG_DTYPE))
+            if len(log_data) % LOG_DTYPE.itemsize:
+                with open(self.log_path_, 'r+b') as log_file:
+                    log_file.truncate(self.log_record_count_*LOG_DTYPE.itemsize)
+        self.log_file_ = open(self.log_path_, 'ab')
+        self.open_sessions_ = dict()
+        self._restore_open_sessions()
+
+    def _reserve(self, size: int):
+        if size <= len(self.rows_):
+            return
+        rows = np.zeros(max(size, 2*len(self.rows_)), dtype=SESSION_DTYPE)
+        rows[:self.size_] = self.rows_[:self.size_]
+        self.rows_ = rows
+
+    def _segments(self) -> List[np.ndarray]:
+        return [self.base_, self.rows_[:self.size_]]
+
+    def _replay(self, records: np.ndarray):
+        if not len(records):
+            return
+        # Keep the last record of every row
+        _, last_indices = np.unique(records['row'][::-1], return_index=True)
+        records = records[len(records) - 1 - last_indices]
+        base_records = records[records['row'] < len(self.base_)]
+        for field in SESSION_DTYPE.names:
+            self.base_[field][base_records['row']] = base_records[field]
+        added_records = records[records['row'] >= len(self.base_)]
+        if len(added_records):
+            added_rows = added_records['row'] - len(self.base_)
+            self._reserve(int(added_rows.max()) + 1)
+            for field in SESSION_DTYPE.names:
+                self.rows_[field][added_rows] = added_records[field]
+            self.size_ = max(self.size_, int(added_rows.max()) + 1)
+
+    def _restore_open_sessions(self):
+        ends = np.concatenate([rows['start'] + rows['duration'] for rows in self._segments()])
+        if not len(ends):
+            return
+        recent_rows = np.flatnonzero(ends >= ends.max() - OPEN_SESSION_WINDOW)
+        for row in recent_rows[np.argsort(ends[recent_rows], kind='stable')]:
+            session = self._get_row(int(row))
+            self.open_sessions_[(int(session['user']), int(session['game']))] = int(row)
+
+    def _get_row(self, row: int) -> np.void:
+        return self.base_[row] if row < len(self.base_) else self.rows_[row - len(self.base_)]
+
+    def _set_row(self, row: int, start: float, duration: float, game: int, user: int, records: List[tuple]):
+        if row < len(self.base_):
+            self.base_[row] = (start, duration, game, user)
+        else:
+            self.rows_[row - len(self.base_)] = (start, duration, game, user)
+        records.append((row, start, duration, game, user))
+
+    def add_samples(self, samples: List[SampleType]):
+        with self.lock_:
+            records = []
+            for user_id, activities, start_time, end_time in samples:
+                user = self.users_.get_id(str(user_id))
+                start = to_epoch(start_time)
+                duration = (end_time - start_time).total_seconds()
+                for activity_name in activities:
+                    game = self.games_.get_id(activity_name)
+                    row = self.open_sessions_.get((user, game), None)
+                    session = self._get_row(row) if row is not None else None
+                    # Same continuation rule as BaseDB sessions
+                    if session is not None and session['start'] + session['duration'] + self.session_break_delay_ > start:
+                        self._set_row(row, float(session['start']), float(session['duration']) + duration, game, user, records)
+                    else:
+                        self._reserve(self.size_ + 1)
+                        row = len(self.base_) + self.size_
+                        self.size_ += 1
+                        self._set_row(row, start, duration, game, user, records)
+                        self.open_sessions_[(user, game)] = row
+            if records:
+                self.log_file_.write(np.array(records, dtype=LOG_DTYPE).tobytes())
+                self.log_file_.flush()
+                self.log_record_count_ += len(records)
+        if self.log_record_count_ >= SNAPSHOT_LOG_RECORDS:
+            self.snapshot()
+
+    def add_sessions(self, sessions: List[dict]):
+        # Appends whole sessions, used to fill the store from the db
+        with self.lock_:
+            self._reserve(self.size_ + len(sessions))
+            for session in sessions:
+                self.rows_[self.size_] = (to_epoch(session['start_time']), session['duration'],
+                                          self.games_.get_id(session['name']), self.users_.get_id(str(session['user_id'])))
+                self.size_ += 1
+            self._restore_open_sessions()
+
+    def add_summaries(self, summaries: List[dict]):
+        # Appends daily summaries, used to fill the store from the db of a compacted guild
+        with self.lock_:
+            rows = np.array([(to_epoch(summary['day']), summary['duration'], self.games_.get_id(summary['name']),
+                              self.users_.get_id(str(summary['user_id']))) for summary in summaries], dtype=SESSION_DTYPE)
+            self.summaries_ = np.concatenate([self.summaries_, rows])
+            self._save('summaries.npy', self.summaries_)
+
+    def _get_masks(self, user_id: Optional[IdType], from_time: Optional[datetime], segments: Optional[List[np.ndarray]] = None) -> Optional[List[np.ndarray]]:
+        user = None
+        if user_id:
+            user = self.users_.get_id(str(user_id), create=False)
+            if user is None:
+                return None
+        masks = []
+        for rows in self._segments() if segments is None else segments:
+            mask = np.ones(len(rows), dtype=bool)
+            if user is not None:
+                mask &= rows['user'] == user
+            if from_time:
+                mask &= rows['start'] >= to_epoch(from_time)
+            masks.append(mask)
+        return masks
+
+    def _sum_durations(self, field: str, segments: List[np.ndarray], masks: List[np.ndarray], id_count: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Row counts and play time per id in field over the masked rows
+        counts = np.zeros(id_count, dtype=np.int64)
+        durations = np.zeros(id_count)
+        for rows, mask in zip(segments, masks):
+            counts += np.bincount(rows[field][mask], minlength=id_count)
+            durations += np.bincount(rows[field][mask], weights=rows['duration'][mask], minlength=id_count)
+        return counts, durations
+
+    def get_aggregated_activities(self, user_id: Optional[IdType], from_time: Optional[datetime]) -> Dict[str, float]:
+        with self.lock_:
+            # Like the db, summaries count whole days from the first day in the window
+            segments = self._segments() + [self.summaries_]
+            masks = self._get_masks(user_id, from_time, segments)
+            if masks is None:
+                return dict()
+            counts, durations = self._sum_durations('game', segments, masks, len(self.games_))
+            return {self.games_.get_name(game): float(durations[game]) for game in np.flatnonzero(counts)}
+
+    def get_longest_activities(self, user_id: Optional[IdType], from_time: Optional[datetime], limit: int) -> List[dict]:
+        with self.lock_:
+            masks = self._get_masks(user_id, from_time)
+            if masks is None:
+                return []
+            # The longest sessions of every part, then the longest of those
+            candidates = []
+            for rows, mask in zip(self._segments(), masks):
+                indices = np.flatnonzero(mask)
+                if len(indices) > limit:
+                    indices = indices[np.argpartition(-rows['duration'][indices], limit)[:limit]]
+                candidates.append(rows[indices])
+            candidates = np.concatenate(candidates)
+            candidates = candidates[np.argsort(-candidates['duration'], kind='stable')[:limit]]
+            return [{'name': self.games_.get_name(session['game']), 'duration': float(session['duration']),
+                     'start_time': from_epoch(session['start']), 'user_id': self.users_.get_name(session['user'])}
+                    for session in candidates]
+
+    def get_user_leaderboard(self, game_name: Optional[str], from_time: Optional[datetime], limit: int) -> List[dict]:
+        with self.lock_:
+            segments = self._segments() + [self.summaries_]
+            masks = self._get_masks(None, from_time, segments)
+            if game_name:
+                game = self.games_.get_id(game_name, create=False)
+                if game is None:
+                    return []
+                masks = [mask & (rows['game'] == game) for rows, mask in zip(segments, masks)]
+            counts, durations = self._sum_durations('user', segments, masks, len(self.users_))
+            played_users = np.flatnonzero(counts)
+            top_users = played_users[np.argsort(-durations[played_users], kind='stable')[:limit]]
+            return [{'user_id': self.users_.get_name(user), 'duration': float(durations[user])} for user in top_users]
+
+    def get_heatmap(self, user_id: Optional[IdType], from_time: Optional[datetime]) -> np.ndarray:
+        with self.lock_:
+            masks = self._get_masks(user_id, from_time)
+            if masks is None:
+                masks = [np.zeros(len(rows), dtype=bool) for rows in self._segments()]
+            return sum(bin_sessions_weekly(rows['start'][mask], rows['duration'][mask]) for rows, mask in zip(self._segments(), masks))
+
+    def delete_user(self, user_id: IdType):
+        with self.lock_:
+            user = self.users_.get_id(str(user_id), create=False)
+            if user is None:
+                return
+            kept_rows = np.concatenate([rows[rows['user'] != user] for rows in self._segments()])
+            self.base_ = np.zeros(0, dtype=SESSION_DTYPE)
+            self.rows_ = np.zeros(max(1024, len(kept_rows)), dtype=SESSION_DTYPE)
+            self.rows_[:len(kept_rows)] = kept_rows
+            self.size_ = len(kept_rows)
+            self.open_sessions_ = dict()
+            self._restore_open_sessions()
+            if np.any(self.summaries_['user'] == user):
+                self.summaries_ = self.summaries_[self.summaries_['user'] != user]
+                self._save('summaries.npy', self.summaries_)
+        # Row numbers moved, so the log has to start over from a new snapshot
+        self.snapshot()
+
+    def _save(self, file_name: str, rows: np.ndarray) -> str:
+        file_path = os.path.join(self.guild_dir_, file_name)
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'wb') as array_file:
+            np.save(array_file, rows)
+            array_file.flush()
+            os.fsync(array_file.fileno())
+        self.games_.sync()
+        self.users_.sync()
+        # A mapped file stays valid after the replace, it is only unlinked
+        os.replace(temp_path, file_path)
+        return file_path
+
+    def snapshot(self):
+        with self.lock_:
+            # Same row order as before, so open sessions keep their row numbers
+            snapshot_path = self._save('sessions.npy', np.concatenate(self._segments()))
+            self.log_file_.close()
+            self.log_file_ = open(self.log_path_, 'wb')
+            self.log_record_count_ = 0
+            # The new snapshot holds the added rows, map it so they don't stay in memory too
+            self.base_ = np.load(snapshot_path, mmap_mode='c')
+            self.rows_ = np.zeros(1024, dtype=SESSION_DTYPE)
+            self.size_ = 0
+
+    def get_size(self) -> int:
+        return len(self.base_) + self.size_
+
+    def close(self):
+        self.log_file_.close()
+        self.games_.close()
+        self.users_.close()
+
+class ColumnarStore():
+    # A guild is filled from the db on first use. Its directory is only loaded
+    # once the fill has been snapshotted and marked complete, a fill cut short
+    # by a crash is started over.
+    COMPLETE_MARKER = 'complete'
+
+    def __init__(self, base_dir: str, session_break_delay: float = 10.0):
+        self.base_dir_ = base_dir
+        self.session_break_delay_ = session_break_delay
+        self.guilds_ = dict()
+        self.guild_locks_ = dict()
+        self.lock_ = threading.Lock()
+
+    def _get_guild_lock(self, guild_id: str) -> threading.Lock:
+        with self.lock_:
+            return self.guild_locks_.setdefault(guild_id, threading.Lock())
+
+    def get_guild(self, guild_id: IdType, fill_func: Callable[[GuildColumns], None]) -> GuildColumns:
+        guild_id = str(guild_id)
+        guild = self.guilds_.get(guild_id, None)
+        if guild:
+            return guild
+        # Only callers of the same guild wait for its fill
+        with self._get_guild_lock(guild_id):
+            if guild_id in self.guilds_:
+                return self.guilds_[guild_id]
+            guild_dir = os.path.join(self.base_dir_, guild_id)
+            marker_path = os.path.join(guild_dir, self.COMPLETE_MARKER)
+            if os.path.exists(marker_path):
+                guild = GuildColumns(guild_dir, self.session_break_delay_)
+            else:
+                shutil.rmtree(guild_dir, ignore_errors=True)
+                guild = GuildColumns(guild_dir, self.session_break_delay_)
+                fill_func(guild)
+                guild.snapshot()
+                self._mark_complete(guild_dir)
+            self.guilds_[guild_id] = guild
+            return guild
+
+    def _mark_complete(self, guild_dir: str):
+        # The snapshot rename is made durable first, so the marker never outlives it
+        dir_fd = os.open(guild_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        with open(os.path.join(guild_dir, self.COMPLETE_MARKER), 'w') as marker_file:
+            marker_file.flush()
+            os.fsync(marker_file.fileno())
+
+    def delete_guild(self, guild_id: IdType):
+        guild_id = str(guild_id)
+        with self._get_guild_lock(guild_id):
+            guild = self.guilds_.pop(guild_id, None)
+            if guild:
+                guild.close()
+            shutil.rmtree(os.path.join(self.base_dir_, guild_id), ignore_errors=True)
+
+    def snapshot(self):
+        for guild in list(self.guilds_.values()):
+            guild.snapshot()
+
+    def close(self):
+        self.snapshot()
+        for guild in list(self.guilds_.values()):
+            guild.close()
+        self.guilds_ = dict()
+
+class ColumnarDB():
+    # Wraps a BaseDB. Writes go to the db and to the columnar store, and the
+    # play time, longest session, leaderboard and heatmap queries are answered
+    # from the store with numpy instead of the db. Everything else goes to the db.
+    def __init__(self, db: BaseDB, base_dir: str, longest_limit: int = 15):
+        self.db_ = db
+        self.store_ = ColumnarStore(base_dir, db.session_break_delay_)
+        self.longest_limit_ = longest_limit
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.db_, name)
+
+    def _get_guild(self, guild_id: IdType) -> GuildColumns:
+        return self.store_.get_guild(guild_id, lambda guild: self._fill_guild(guild_id, guild))
+
+    def _fill_guild(self, guild_id: IdType, guild: GuildColumns):
+        # First use of the guild, fill it with the history from the db including the
+        # summaries of compacted sessions
+        for sessions in self.db_.iter_sessions(guild_id, include_user_id=True):
+            guild.add_sessions(sessions)
+        for summaries in self.db_.iter_summaries(guild_id):
+            guild.add_summaries(summaries)
+        _log.info(f'Loaded {guild.get_size()} sessions and {len(guild.summaries_)} daily summaries of {guild_id} into the columnar store')
+
+    def add_user_activities_sample(self, guild_id: IdType, user_id: IdType, activities: List[str], start_time: datetime, end_time: datetime):
+        self.add_activities_samples_bulk(guild_id, [(user_id, activities, start_time, end_time)])
+
+    def add_activities_samples_bulk(self, guild_id: IdType, samples: List[SampleType]):
+        guild = self._get_guild(guild_id)
+        self.db_.add_activities_samples_bulk(guild_id, samples)
+        if not self.db_.debug_:
+            guild.add_samples(samples)
+
+    def get_aggregated_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Dict[str, float]:
+        return self._get_guild(guild_id).get_aggregated_activities(user_id, from_time)
+
+    def get_longest_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> List[dict]:
+        return self._get_guild(guild_id).get_longest_activities(user_id, from_time, self.longest_limit_)
+
+    def get_user_leaderboard(self, guild_id: IdType, game: Optional[str]=None, from_time: Optional[datetime]=None, limit: int=10) -> List[dict]:
+        return self._get_guild(guild_id).get_user_leaderboard(game, from_time, limit)
+
+    def get_heatmap(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Optional[np.ndarray]:
+        return self._get_guild(guild_id).get_heatmap(user_id, from_time)
+
+    def reset_guild_data(self, guild_id: IdType):
+        self.db_.reset_guild_data(guild_id)
+        self.store_.delete_guild(guild_id)
+
+    def delete_guild_data(self, guild_id: IdType):
+        self.db_.delete_guild_data(guild_id)
+        self.store_.delete_guild(guild_id)
+
+    def reset_user_data(self, guild_id: IdType, user_id: IdType):
+        self.db_.reset_user_data(guild_id, user_id)
+        self._get_guild(guild_id).delete_user(user_id)
+
+    def delete_user_data(self, guild_id: IdType, user_id: IdType):
+        self.db_.delete_user_data(guild_id, user_id)
+        self._get_guild(guild_id).delete_user(user_id)
+
+    def run_maintenance(self):
+        self.db_.run_maintenance()
+        self.store_.snapshot()
+
+    def close(self):
+        self.store_.close()
+        db_close = getattr(self.db_, 'close', None)
+        if db_close:
+            db_close()
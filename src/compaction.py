@@ -0,0 +1,76 @@
+import os
+import gzip
+import json
+from datetime import datetime
+from typing import List, Dict, Tuple, Iterable, BinaryIO, TYPE_CHECKING
+
+from .log import Logger
+if TYPE_CHECKING:
+    from .db import BaseDB
+
+_log = Logger('Compaction')
+
+def day_start(time: datetime) -> datetime:
+    return time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def select_sessions_to_compact(sessions: List[dict], keep_longest: int) -> List[dict]:
+    # The longest old sessions of every user stay raw. Any user's or the guild's
+    # all time top keep_longest is then still made of raw sessions.
+    user_to_sessions = dict()
+    for session in sessions:
+        user_to_sessions.setdefault(session['user_id'], []).append(session)
+    compacted_sessions = []
+    for user_sessions in user_to_sessions.values():
+        user_sessions.sort(key=lambda session: session['duration'], reverse=True)
+        compacted_sessions.extend(user_sessions[keep_longest:])
+    return compacted_sessions
+
+def summarize_sessions(sessions: List[dict]) -> List[dict]:
+    summaries: Dict[Tuple[str, str, datetime], dict] = dict()
+    for session in sessions:
+        key = (session['user_id'], session['name'], day_start(session['start_time']))
+        summary = summaries.setdefault(key, {'user_id': key[0], 'name': key[1], 'day': key[2], 'duration': 0.0, 'session_count': 0, 'longest': 0.0})
+        summary['duration'] += session['duration']
+        summary['session_count'] += 1
+        summary['longest'] = max(summary['longest'], session['duration'])
+    return list(summaries.values())
+
+def write_sessions_ndjson(file_obj: BinaryIO, session_batches: Iterable[List[dict]]) -> int:
+    # Writes batch by batch so only one batch is in memory at a time
+    session_count = 0
+    with gzip.GzipFile(fileobj=file_obj, mode='wb') as archive_file:
+        for sessions in session_batches:
+            archive_file.write(''.join(json.dumps({
+                'user_id': session['user_id'], 'name': session['name'],
+                'start_time': session['start_time'].isoformat(), 'duration': session['duration'],
+                }) + '\n' for session in sessions).encode())
+            session_count += len(sessions)
+    return session_count
+
+def export_sessions(db: 'BaseDB', guild_id: str, file_path: str, batch_size: int=1000) -> int:
+    with open(file_path, 'wb') as export_file:
+        session_count = write_sessions_ndjson(export_file, db.iter_sessions(guild_id, batch_size=batch_size, include_user_id=True))
+    _log.info(f'Exported {session_count} sessions of {guild_id}')
+    return session_count
+
+def archive_sessions(archive_dir: str, guild_id: str, sessions: List[dict]) -> str:
+    # Written to a temporary name and renamed once synced, so a crash never
+    # leaves a partial archive that looks complete
+    guild_dir = os.path.join(archive_dir, guild_id)
+    os.makedirs(guild_dir, exist_ok=True)
+    file_path = os.path.join(guild_dir, f'sessions-{datetime.now().strftime("%Y%m%dT%H%M%S%f")}.ndjson.gz')
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as raw_file:
+        write_sessions_ndjson(raw_file, [sessions])
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+    os.replace(temp_path, file_path)
+    _log.info(f'Archived {len(sessions)} sessions of {guild_id} to {file_path}')
+    return file_path
+
+def read_archive(file_path: str) -> List[dict]:
+    with gzip.open(file_path, 'rt') as archive_file:
+        sessions = [json.loads(line) for line in archive_file]
+    for session in sessions:
+        session['start_time'] = datetime.fromisoformat(session['start_time'])
+    return sessions
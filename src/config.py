@@ -0,0 +1,31 @@
+import os
+from dotenv import load_dotenv
+
+class Config():
+    # Settings shared by the single process bot, the shard launcher and its workers
+    def __init__(self, debug: bool = False):
+        load_dotenv()
+        self.token = os.getenv('DISCORD_TOKEN')
+        self.mongo_url = os.getenv('MONGO_URL')
+        self.update_time = 60.0 # seconds
+        self.reconcile_time = 600.0 # seconds, sweep interval when tracking presence events
+        self.health_time = 30.0 # seconds between shard health reports
+        self.maintenance_time = 3600.0 # seconds between db maintenance runs like trimming indexes
+        self.checkpoint_time = 60.0 # seconds between tracker state checkpoints
+        self.session_break_delay = 10.0
+        self.event_driven = os.getenv('TRACKING_MODE', 'poll') == 'event'
+        self.session_layout = os.getenv('SESSION_LAYOUT', 'embedded')
+        self.use_rollups = os.getenv('USE_ROLLUPS', '') == '1'
+        self.use_longest_index = os.getenv('USE_LONGEST_INDEX', '') == '1'
+        self.use_heatmaps = os.getenv('USE_HEATMAPS', '') == '1'
+        self.encode_game_names = os.getenv('ENCODE_GAME_NAMES', '') == '1'
+        self.db_backend = os.getenv('DB_BACKEND', 'mongo')
+        self.sqlite_path = os.getenv('SQLITE_PATH', 'timetrak.db')
+        self.compact_after_days = int(os.getenv('COMPACT_AFTER_DAYS', '0'))
+        self.archive_dir = os.getenv('ARCHIVE_DIR', 'archive')
+        self.columnar_dir = os.getenv('COLUMNAR_DIR', '')
+        self.tracker_state_path = os.getenv('TRACKER_STATE_PATH', 'tracker_state.json')
+        self.metrics_port = int(os.getenv('METRICS_PORT', '0'))
+        self.json_logs = os.getenv('LOG_FORMAT', 'text') == 'json'
+        self.debug = debug
+        self.prefix = '-' if not debug else '--'
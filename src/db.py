@@ -1,17 +1,138 @@
-from typing import Optional, Union, List, Dict
+import time
+from typing import Optional, Union, List, Dict, Tuple, Set, Iterator, TYPE_CHECKING
 from datetime import datetime, timedelta
 from abc import ABCMeta, abstractmethod
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne, ReplaceOne, ASCENDING, ReturnDocument, monitoring
 
 from .log import Logger
+from .rollups import MongoRollups, HOUR, DAY, floor_time, ceil_time
+from .longest import MongoLongestSessions, is_month_aligned
+from .heatmaps import MongoHeatmaps
+from .games import MongoGameDictionary
+from .binning import get_heatmap_week_start
+from .compaction import day_start, select_sessions_to_compact, summarize_sessions, archive_sessions
+
+if TYPE_CHECKING:
+    # Only loaded when a heatmap is binned, the bot starts without it
+    import numpy as np
 
 _log = Logger('DB')
 IdType = Union[int, str]
+EMBEDDED_LAYOUT = 'embedded'
+COLLECTION_LAYOUT = 'collection'
+# (user_id, activities, start_time, end_time)
+SampleType = Tuple[IdType, List[str], datetime, datetime]
 
 class BaseDB(metaclass=ABCMeta):
     def __init__(self, session_break_delay: Optional[float]=10.0, **kwargs):
         self.session_break_delay_ = session_break_delay
         self.debug_ = kwargs.get('debug', False)
+        self.round_trips_ = 0
+        # Closed sessions older than this many days are folded into daily summaries, 0 keeps them all
+        self.compact_after_days_ = kwargs.get('compact_after_days', 0)
+        self.archive_dir_ = kwargs.get('archive_dir', 'archive')
+
+    def get_round_trip_count(self) -> int:
+        return self.round_trips_
+
+    def get_blacklisted_user_set(self, guild_id: IdType) -> Set[str]:
+        return set(str(user_id) for user_id in self.get_blacklisted_users(guild_id))
+
+    def add_activities_samples_bulk(self, guild_id: IdType, samples: List[SampleType]):
+        for user_id, activities, start_time, end_time in samples:
+            self.add_user_activities_sample(guild_id, user_id, activities, start_time, end_time)
+
+    def run_maintenance(self):
+        if self.compact_after_days_:
+            before_time = day_start(datetime.now() - timedelta(days=self.compact_after_days_))
+            for guild_id in self.get_guild_ids():
+                self.compact_sessions(guild_id, before_time)
+
+    def compact_sessions(self, guild_id: IdType, before_time: datetime, keep_longest: int=15, archive_dir: Optional[str]=None) -> int:
+        # Closed sessions started before before_time are archived and replaced by per day
+        # summaries. Totals stay the same, windows starting before before_time count whole days.
+        sessions = select_sessions_to_compact(self._get_closed_sessions_before(guild_id, before_time), keep_longest)
+        if not sessions:
+            return 0
+        archive_sessions(archive_dir if archive_dir else self.archive_dir_, str(guild_id), sessions)
+        self._replace_sessions_with_summaries(guild_id, sessions, summarize_sessions(sessions))
+        _log.info(f'Compacted {len(sessions)} sessions of {guild_id} started before {before_time}')
+        return len(sessions)
+
+    def get_heatmap(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Optional['np.ndarray']:
+        # Stored weekday and half hour play time matrix, None if the backend doesn't keep one
+        return None
+
+    def iter_sessions(self, guild_id: IdType, user_id: Optional[IdType]=None, batch_size: int=1000, include_user_id: bool=False) -> Iterator[List[dict]]:
+        # Batches of ongoing and closed sessions with name, start_time and duration
+        raw_sessions = self.get_raw_sessions_data(guild_id, user_id)
+        for index in range(0, len(raw_sessions), batch_size):
+            yield raw_sessions[index:index+batch_size]
+
+    def _get_user_session_changes(self, stored_ongoing_sessions: List[dict], user_samples: List[Tuple[List[str], datetime, datetime]]) -> dict:
+        stored_durations = {(session['name'], session['start_time']): session['duration'] for session in stored_ongoing_sessions}
+        user_data = {'ongoing_sessions': [dict(session) for session in stored_ongoing_sessions], 'sessions': []}
+        for activities, start_time, end_time in user_samples:
+            for activity_name in activities:
+                self._add_user_activity_sample(user_data, activity_name, start_time, end_time)
+        # Cleared once all samples are in, so a session continued by a later sample of the batch stays open
+        if user_samples:
+            self._clear_old_ongoing_sessions(user_data, max(end_time for _, _, end_time in user_samples))
+
+        changes = {'incremented': [], 'opened': [], 'closed': [], 'closed_stored': []}
+        for session in user_data['ongoing_sessions']:
+            key = (session['name'], session['start_time'])
+            if key not in stored_durations:
+                changes['opened'].append(session)
+            elif session['duration'] > stored_durations[key]:
+                changes['incremented'].append((session, session['duration'] - stored_durations[key]))
+        for session in user_data['sessions']:
+            changes['closed'].append(session)
+            if (session['name'], session['start_time']) in stored_durations:
+                changes['closed_stored'].append(session)
+        return changes
+
+    def _add_user_activity_sample(self, user_data: dict, activity_name: str, start_time: datetime, end_time: datetime):
+        duration = (end_time - start_time).total_seconds()
+        if self._update_and_check_is_new_ongoing_session(user_data, activity_name, start_time, duration):
+            self._add_new_ongoing_session(user_data, activity_name, start_time, duration)
+
+    def _update_and_check_is_new_ongoing_session(self, user_data: dict, activity_name: str, start_time: datetime, duration: float) -> bool:
+        for session in user_data['ongoing_sessions'][:]:
+            if activity_name == session['name']:
+                session_end_time = session['start_time'] + timedelta(seconds=session['duration'])
+                if session_end_time + timedelta(seconds=self.session_break_delay_) > start_time:
+                    session['duration'] += duration
+                    return False
+                else:
+                    user_data['ongoing_sessions'].remove(session)
+                    user_data['sessions'].append(session)
+                    return True
+        return True
+
+    def _add_new_ongoing_session(self, user_data: dict, activity_name: str, start_time: datetime, duration: float):
+        user_data['ongoing_sessions'].append({'name': activity_name, 'start_time': start_time, 'duration': duration})
+
+    def _clear_old_ongoing_sessions(self, user_data: dict, end_time: datetime):
+        for session in user_data['ongoing_sessions'][:]:
+            session_end_time = session['start_time'] + timedelta(seconds=session['duration'])
+            if session_end_time + timedelta(seconds=self.session_break_delay_) < end_time:
+                user_data['ongoing_sessions'].remove(session)
+                user_data['sessions'].append(session)
+
+    @abstractmethod
+    def get_guild_ids(self) -> List[str]:
+        return NotImplemented
+    @abstractmethod
+    def _get_closed_sessions_before(self, guild_id: IdType, before_time: datetime) -> List[dict]:
+        return NotImplemented
+    @abstractmethod
+    def _replace_sessions_with_summaries(self, guild_id: IdType, sessions: List[dict], summaries: List[dict]):
+        return NotImplemented
+    @abstractmethod
+    def iter_summaries(self, guild_id: IdType, batch_size: int=1000) -> Iterator[List[dict]]:
+        # Batches of daily summaries with user_id, name, day and duration
+        return NotImplemented
     @abstractmethod
     def add_blacklisted_users(self, guild_id: IdType, user_ids: List[IdType]):
         return NotImplemented
@@ -34,6 +155,10 @@ class BaseDB(metaclass=ABCMeta):
     def get_longest_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> List[dict]:
         return NotImplemented
     @abstractmethod
+    def get_user_leaderboard(self, guild_id: IdType, game: Optional[str]=None, from_time: Optional[datetime]=None, limit: int=10) -> List[dict]:
+        # Users with the most play time, of one game if given, as user_id and duration
+        return NotImplemented
+    @abstractmethod
     def get_raw_sessions_data(self, guild_id: IdType, user_id: Optional[IdType]=None) -> List[dict]:
         return NotImplemented
     @abstractmethod
@@ -49,108 +174,222 @@ class BaseDB(metaclass=ABCMeta):
     def delete_user_data(self, guild_id: IdType, user_id: IdType):
         return NotImplemented
 
+class _RoundTripCounter(monitoring.CommandListener):
+    # Counts the commands sent for the tracked data. Connection handshakes,
+    # authentication and session cleanup go to other databases and aren't counted.
+    def __init__(self, db: BaseDB, database_name: str):
+        self.db_ = db
+        self.database_name_ = database_name
+
+    def started(self, event):
+        if event.database_name == self.database_name_:
+            self.db_.round_trips_ += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
 class MongoDB(BaseDB):
+    DATABASE = 'user_data'
+    SESSIONS_COLLECTION = 'sessions'
+    SUMMARIES_COLLECTION = 'daily_summaries'
+    RESERVED_COLLECTIONS = ['blacklisted_user_ids', SESSIONS_COLLECTION, SUMMARIES_COLLECTION, MongoRollups.HOURLY_COLLECTION, MongoRollups.DAILY_COLLECTION,
+                            MongoLongestSessions.COLLECTION, MongoHeatmaps.COLLECTION, MongoGameDictionary.COLLECTION,
+                            MongoGameDictionary.COUNTERS_COLLECTION]
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         mongo_url = kwargs.get('mongo_url', None)
         if not mongo_url:
             raise RuntimeError('Mongo URL not specified. Can\'t initialize database.')
-        self.client_ = MongoClient(mongo_url)
-        self.db_ = self.client_['user_data']
+        self.client_ = MongoClient(mongo_url, event_listeners=[_RoundTripCounter(self, self.DATABASE)])
+        self.db_ = self.client_[self.DATABASE]
+        # Closed sessions live in the user documents for the embedded layout and
+        # as one document per session in a shared collection for the collection layout.
+        self.session_layout_ = kwargs.get('session_layout', EMBEDDED_LAYOUT)
+        if self.session_layout_ not in [EMBEDDED_LAYOUT, COLLECTION_LAYOUT]:
+            raise RuntimeError(f'Unknown session layout {self.session_layout_}')
+        self.sessions_db_ = self.db_[self.SESSIONS_COLLECTION]
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            self._create_session_indexes()
+        # Compacted sessions, one document per user, game and day
+        self.summaries_db_ = self.db_[self.SUMMARIES_COLLECTION]
+        self.summaries_db_.create_index([('guild_id', ASCENDING), ('user_id', ASCENDING), ('day', ASCENDING), ('name', ASCENDING)], unique=True)
+        self.summaries_db_.create_index([('guild_id', ASCENDING), ('day', ASCENDING)])
+        # Aggregated activity queries are answered from hourly and daily play time buckets
+        self.rollups_ = MongoRollups(self.db_) if kwargs.get('use_rollups', False) else None
+        # Longest sessions over whole months are read from a top K index kept up to date on writes
+        self.longest_ = MongoLongestSessions(self.db_) if kwargs.get('use_longest_index', False) else None
+        # Heatmap matrices per user and guild, updated as samples are written
+        self.heatmaps_ = MongoHeatmaps(self.db_) if kwargs.get('use_heatmaps', False) else None
+        # Sessions store game ids from a shared dictionary instead of the names. Once
+        # enabled it has to stay enabled, the ids aren't readable without it.
+        self.games_ = MongoGameDictionary(self.db_) if kwargs.get('encode_game_names', False) else None
+        # Blacklists are loaded once and kept in sync by the blacklist methods. Changes from
+        # other processes are picked up by comparing guild versions every refresh time.
+        self.blacklist_refresh_time_ = kwargs.get('blacklist_refresh_time', 300.0)
+        self.blacklists_ = None
+        self.blacklist_versions_ = dict()
+        self.blacklist_refreshed_at_ = 0.0
+
+    def _create_session_indexes(self):
+        self.sessions_db_.create_index([('guild_id', ASCENDING), ('user_id', ASCENDING), ('start_time', ASCENDING)])
+        self.sessions_db_.create_index([('guild_id', ASCENDING), ('start_time', ASCENDING)])
+
+    def get_guild_ids(self) -> List[str]:
+        return [name for name in self.db_.list_collection_names() if name not in self.RESERVED_COLLECTIONS]
 
     def add_blacklisted_users(self, guild_id: IdType, user_ids: List[IdType]):
         user_db = self.db_['blacklisted_user_ids']
-        _log.debug(f'Adding blacklisted users for {guild_id}: {user_ids}')
-        user_db.find_one_and_update(
+        _log.debug(lambda: f'Adding blacklisted users for {guild_id}: {user_ids}')
+        user_ids_str = [str(user_id) for user_id in user_ids]
+        guild_tracker = user_db.find_one_and_update(
             {'guild_id': str(guild_id)},
-            {'$push': {'blacklisted_users': {'$each': [str(user_id) for user_id in user_ids]}}},
-            upsert=True)
+            {'$addToSet': {'blacklisted_users': {'$each': user_ids_str}}, '$inc': {'version': 1}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        self._update_cached_blacklist(guild_tracker)
 
     def remove_blacklisted_users(self, guild_id: IdType, user_ids: List[IdType]):
         user_db = self.db_['blacklisted_user_ids']
-        guild_tracker = user_db.find_one({'guild_id':str(guild_id)})
+        _log.debug(lambda: f'Removing blacklisted users for {guild_id}: {user_ids}')
+        guild_tracker = user_db.find_one_and_update(
+            {'guild_id': str(guild_id)},
+            {'$pull': {'blacklisted_users': {'$in': [str(user_id) for user_id in user_ids]}}, '$inc': {'version': 1}},
+            upsert=False, return_document=ReturnDocument.AFTER)
         if not guild_tracker:
             return False
-        _log.debug(f'Removing blacklisted users for {guild_id}: {user_ids}')
-        user_ids_str = list(map(str, user_ids))
-        blacklisted_users = guild_tracker['blacklisted_users']
-        blacklisted_users[:] = list(filter(lambda user_id: user_id not in user_ids_str, blacklisted_users))
-        user_db.find_one_and_update(
-            {'guild_id':str(guild_id)},
-            {'$set': {'blacklisted_users': guild_tracker['blacklisted_users']}},
-            upsert=False)
+        self._update_cached_blacklist(guild_tracker)
 
     def get_blacklisted_users(self, guild_id: IdType) -> List[IdType]:
+        return list(self.get_blacklisted_user_set(guild_id))
+
+    def get_blacklisted_user_set(self, guild_id: IdType) -> Set[str]:
+        if self.blacklists_ is None or time.monotonic() - self.blacklist_refreshed_at_ > self.blacklist_refresh_time_:
+            self.refresh_blacklists()
+        return self.blacklists_.get(str(guild_id), set())
+
+    def refresh_blacklists(self):
         user_db = self.db_['blacklisted_user_ids']
-        guild_tracker = user_db.find_one({'guild_id': str(guild_id)})
-        if not guild_tracker:
-            return []
-        blacklisted_users = guild_tracker.get('blacklisted_users', [])
-        return list(set(blacklisted_users))
+        if self.blacklists_ is None:
+            self.blacklists_ = dict()
+            for guild_tracker in user_db.find({}):
+                self._update_cached_blacklist(guild_tracker)
+        else:
+            guild_versions = {entry['guild_id']: entry.get('version', 0) for entry in user_db.find({}, {'guild_id': 1, 'version': 1})}
+            changed_guilds = [guild_id for guild_id, version in guild_versions.items() if self.blacklist_versions_.get(guild_id) != version]
+            for guild_id in set(self.blacklists_.keys()) - set(guild_versions.keys()):
+                self.blacklists_.pop(guild_id)
+                self.blacklist_versions_.pop(guild_id, None)
+            if changed_guilds:
+                for guild_tracker in user_db.find({'guild_id': {'$in': changed_guilds}}):
+                    self._update_cached_blacklist(guild_tracker)
+        self.blacklist_refreshed_at_ = time.monotonic()
+
+    def _update_cached_blacklist(self, guild_tracker: dict):
+        if self.blacklists_ is None:
+            return
+        self.blacklists_[guild_tracker['guild_id']] = set(guild_tracker.get('blacklisted_users', []))
+        self.blacklist_versions_[guild_tracker['guild_id']] = guild_tracker.get('version', 0)
 
     def add_user_activities_sample(self, guild_id: IdType, user_id: IdType, activities: List[str], start_time: datetime, end_time: datetime):
-        _log.debug(f'Adding {guild_id} user {user_id} sample for {activities} from {start_time} to {end_time}')
-        if self.debug_:
+        _log.debug(lambda: f'Adding {guild_id} user {user_id} sample for {activities} from {start_time} to {end_time}')
+        self.add_activities_samples_bulk(guild_id, [(user_id, activities, start_time, end_time)])
+
+    def add_activities_samples_bulk(self, guild_id: IdType, samples: List[SampleType]):
+        _log.debug(lambda: f'Adding {len(samples)} samples for {guild_id}')
+        if self.debug_ or not samples:
             return
         guild_db = self.db_[str(guild_id)]
-        user_data = guild_db.find_one({'user_id':str(user_id)})
-        if not user_data:
-            user_data = self._setup_empty_user(guild_id, user_id)
-
-        for activity_name in activities:
-            self._add_user_activity_sample(user_data, activity_name ,start_time, end_time)
-        self._clear_old_ongoing_sessions(user_data, end_time)
-
-        guild_db.find_one_and_update(
-            {'user_id':str(user_id)},
-            {'$set': {
-                'ongoing_sessions': user_data['ongoing_sessions'],
-                'sessions': user_data['sessions']
-            }}, upsert=False)
-
-    def _setup_empty_user(self, guild_id: IdType, user_id: IdType) -> dict:
-        guild_db = self.db_[str(guild_id)]
-        user_data = guild_db.find_one({'user_id': str(user_id)})
-        if user_data:
-            return user_data
-        guild_db.insert_one({'user_id':str(user_id), 'ongoing_sessions':[], 'sessions':[]})
-        return guild_db.find_one({'user_id': str(user_id)})
+        user_to_samples = dict()
+        for user_id, activities, start_time, end_time in self._encode_samples(samples):
+            user_to_samples.setdefault(str(user_id), []).append((activities, start_time, end_time))
+        user_to_ongoing_sessions = {entry['user_id']: entry['ongoing_sessions'] for entry in guild_db.find(
+            {'user_id': {'$in': list(user_to_samples.keys())}}, {'_id': 0, 'user_id': 1, 'ongoing_sessions': 1})}
 
-    def _add_user_activity_sample(self, user_data: dict, activity_name: str, start_time: datetime, end_time: datetime):
-        duration = (end_time - start_time).total_seconds()
-        if self._update_and_check_is_new_ongoing_session(user_data, activity_name, start_time, duration):
-            self._add_new_ongoing_session(user_data, activity_name, start_time, duration)
+        requests = []
+        session_requests = []
+        longest_sessions = []
+        for user_id, user_samples in user_to_samples.items():
+            changes = self._get_user_session_changes(user_to_ongoing_sessions.get(user_id, []), user_samples)
+            requests.extend(self._get_user_session_requests(user_id, changes))
+            if self.longest_:
+                longest_sessions.extend((user_id, session) for session, _ in changes['incremented'])
+                longest_sessions.extend((user_id, session) for session in changes['opened'] + changes['closed'])
+            if self.session_layout_ == COLLECTION_LAYOUT:
+                session_requests.extend(InsertOne(dict(session, guild_id=str(guild_id), user_id=user_id)) for session in changes['closed'])
+        if requests:
+            guild_db.bulk_write(requests, ordered=False)
+        if session_requests:
+            self.sessions_db_.bulk_write(session_requests, ordered=False)
+        if self.rollups_:
+            self.rollups_.add_samples(str(guild_id), samples)
+        if self.longest_:
+            # The index keeps names, copies are decoded so the session changes keep the ids
+            decoded_sessions = self._decode_sessions([dict(session) for _, session in longest_sessions])
+            self.longest_.add_sessions(str(guild_id), [(user_id, session) for (user_id, _), session in zip(longest_sessions, decoded_sessions)])
+        if self.heatmaps_:
+            self.heatmaps_.add_samples(str(guild_id), samples)
 
-    def _update_and_check_is_new_ongoing_session(self, user_data: dict, activity_name: str, start_time: datetime, duration: float) -> bool:
-        for session in user_data['ongoing_sessions'][:]:
-            if activity_name == session['name']:
-                session_end_time = session['start_time'] + timedelta(seconds=session['duration'])
-                if session_end_time + timedelta(seconds=self.session_break_delay_) > start_time:
-                    session['duration'] += duration
-                    return False
-                else:
-                    user_data['ongoing_sessions'].remove(session)
-                    user_data['sessions'].append(session)
-                    return True
-        return True
+    def _encode_samples(self, samples: List[SampleType]) -> List[SampleType]:
+        if not self.games_:
+            return samples
+        name_to_id = self.games_.get_ids(activity_name for _, activities, _, _ in samples for activity_name in activities)
+        return [(user_id, [name_to_id[activity_name] for activity_name in activities], start_time, end_time)
+                for user_id, activities, start_time, end_time in samples]
 
-    def _add_new_ongoing_session(self, user_data: dict, activity_name: str, start_time: datetime, duration: float):
-        user_data['ongoing_sessions'].append({'name': activity_name, 'start_time': start_time, 'duration': duration})
+    def _decode_sessions(self, sessions: List[dict]) -> List[dict]:
+        if not self.games_ or not sessions:
+            return sessions
+        stored_name_to_name = self.games_.decode(session['name'] for session in sessions)
+        for session in sessions:
+            session['name'] = stored_name_to_name[session['name']]
+        return sessions
 
-    def _clear_old_ongoing_sessions(self, user_data: dict, end_time: datetime):
-        for session in user_data['ongoing_sessions'][:]:
-            session_end_time = session['start_time'] + timedelta(seconds=session['duration'])
-            if session_end_time + timedelta(seconds=self.session_break_delay_) < end_time:
-                user_data['ongoing_sessions'].remove(session)
-                user_data['sessions'].append(session)
+    def _get_stored_names(self, name: str) -> List[Union[int, str]]:
+        # Sessions can hold the game id or, from before encoding, the name itself.
+        # A name missing from the dictionary was never stored encoded.
+        if not self.games_:
+            return [name]
+        return list(self.games_.find_ids([name]).values()) + [name]
+
+    def _get_user_session_requests(self, user_id: str, changes: dict) -> List[UpdateOne]:
+        requests = []
+        if changes['closed_stored']:
+            update = {'$pull': {'ongoing_sessions': {'$or': [
+                {'name': session['name'], 'start_time': session['start_time']} for session in changes['closed_stored']]}}}
+            if self.session_layout_ == EMBEDDED_LAYOUT:
+                update['$push'] = {'sessions': {'$each': changes['closed']}}
+            requests.append(UpdateOne({'user_id': user_id}, update))
+        elif changes['closed'] and self.session_layout_ == EMBEDDED_LAYOUT:
+            requests.append(UpdateOne(
+                {'user_id': user_id},
+                {'$push': {'sessions': {'$each': changes['closed']}}, '$setOnInsert': {'ongoing_sessions': []}},
+                upsert=True))
+        if changes['incremented']:
+            increments = dict()
+            array_filters = []
+            for index, (session, duration) in enumerate(changes['incremented']):
+                increments[f'ongoing_sessions.$[s{index}].duration'] = duration
+                array_filters.append({f's{index}.name': session['name'], f's{index}.start_time': session['start_time']})
+            requests.append(UpdateOne({'user_id': user_id}, {'$inc': increments}, array_filters=array_filters))
+        if changes['opened']:
+            requests.append(UpdateOne(
+                {'user_id': user_id},
+                {'$push': {'ongoing_sessions': {'$each': changes['opened']}}, '$setOnInsert': {'sessions': []}},
+                upsert=True))
+        return requests
 
     def get_last_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Dict[str, float]:
         last_activities = self._get_aggregated_field_activites_as_dict('ongoing_sessions', guild_id, user_id, from_time)
-        _log.debug(f'user data for {guild_id}, {user_id} {last_activities} {from_time}')
+        _log.debug(lambda: f'user data for {guild_id}, {user_id} {last_activities} {from_time}')
         return last_activities
 
     def _get_aggregated_field_activites_as_dict(self, field_name: str, guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime]) -> Dict[str, float]:
         assert field_name in ['ongoing_sessions', 'sessions'], "Got invalid field name in query"
+        if field_name == 'sessions' and self.session_layout_ == COLLECTION_LAYOUT:
+            return self._get_aggregated_session_collection_as_dict(guild_id, user_id, from_time)
         guild_db = self.db_[str(guild_id)]
         match_data = dict()
         if user_id:
@@ -163,71 +402,386 @@ class MongoDB(BaseDB):
             {'$group': {'_id': f'${field_name}.name',
                         'duration': {'$sum': f'${field_name}.duration'}}}
             ])
-        _log.debug('Got aggregate activitites for field', field_name, aggregate_activities_data)
+        aggregated_activities = self._convert_aggregate_data_to_dict(aggregate_activities_data)
+        _log.debug('Got aggregate activitites for field', field_name, lambda: aggregated_activities)
+        return aggregated_activities
+
+    def _get_session_collection_match(self, guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime]) -> dict:
+        match_data = {'guild_id': str(guild_id)}
+        if user_id:
+            match_data['user_id'] = str(user_id)
+        if from_time:
+            match_data['start_time'] = {'$gte': from_time}
+        return match_data
+
+    def _get_aggregated_session_collection_as_dict(self, guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime]) -> Dict[str, float]:
+        aggregate_activities_data = self.sessions_db_.aggregate([
+            {'$match': self._get_session_collection_match(guild_id, user_id, from_time)},
+            {'$group': {'_id': '$name', 'duration': {'$sum': '$duration'}}}
+            ])
         return self._convert_aggregate_data_to_dict(aggregate_activities_data)
 
     def _convert_aggregate_data_to_dict(self, aggregate_data: List[dict]) -> Dict[str, float]:
         dict_data = dict([(data['_id'], data['duration']) for data in aggregate_data])
-        return dict_data
+        if not self.games_:
+            return dict_data
+        # Ids and not yet encoded names of the same game are grouped apart, merge them
+        stored_name_to_name = self.games_.decode(dict_data.keys())
+        decoded_data = dict()
+        for stored_name, duration in dict_data.items():
+            name = stored_name_to_name[stored_name]
+            decoded_data[name] = decoded_data.get(name, 0) + duration
+        return decoded_data
 
     def get_aggregated_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Dict[str, float]:
+        if self.rollups_:
+            return self._get_aggregated_activities_from_rollups(guild_id, user_id, from_time)
         aggregated_activities = self._get_aggregated_field_activites_as_dict('sessions', guild_id, user_id, from_time)
         last_activities = self.get_last_activities(guild_id, user_id, from_time)
-        for activity, duration in last_activities.items():
-            aggregated_activities[activity] = aggregated_activities.get(activity, 0) + duration
-        _log.debug(f'user data for {guild_id}, {user_id} {from_time} {aggregated_activities}')
+        summary_activities = self._get_summary_activities(guild_id, user_id, from_time)
+        for activities in [last_activities, summary_activities]:
+            for activity, duration in activities.items():
+                aggregated_activities[activity] = aggregated_activities.get(activity, 0) + duration
+        _log.debug(lambda: f'user data for {guild_id}, {user_id} {from_time} {aggregated_activities}')
         return aggregated_activities
 
-    def get_longest_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> List[dict]:
-        guild_db = self.db_[str(guild_id)]
-        match_data = dict()
+    def _get_summary_activities(self, guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime]) -> Dict[str, float]:
+        match_data = {'guild_id': str(guild_id)}
         if user_id:
             match_data['user_id'] = str(user_id)
         if from_time:
-            match_data['sessions.start_time'] = {'$gte': from_time}
+            match_data['day'] = {'$gte': from_time}
+        return self._convert_aggregate_data_to_dict(self.summaries_db_.aggregate([
+            {'$match': match_data},
+            {'$group': {'_id': '$name', 'duration': {'$sum': '$duration'}}}
+            ]))
+
+    def _get_aggregated_activities_from_rollups(self, guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime]) -> Dict[str, float]:
+        # Play time is counted in the bucket it was played in and the window starts at the
+        # hour from_time is in. Whole days come from the daily buckets and the hours before
+        # the first whole day from the hourly buckets.
+        guild_id, user_id = str(guild_id), str(user_id) if user_id else None
+        if not from_time:
+            return self.rollups_.get_aggregated_activities(DAY, guild_id, user_id, None)
+        first_hour = floor_time(from_time, HOUR)
+        first_day = ceil_time(first_hour, DAY)
+        aggregated_activities = self.rollups_.get_aggregated_activities(DAY, guild_id, user_id, first_day)
+        for activity, duration in self.rollups_.get_aggregated_activities(HOUR, guild_id, user_id, first_hour, first_day).items():
+            aggregated_activities[activity] = aggregated_activities.get(activity, 0) + duration
+        _log.debug(lambda: f'rollup data for {guild_id}, {user_id} {from_time} {aggregated_activities}')
+        return aggregated_activities
+
+    def rebuild_rollups(self, guild_id: IdType, batch_size: int=1000):
+        if not self.rollups_:
+            raise RuntimeError('Rollups are not enabled for this database.')
+        self.rollups_.delete(str(guild_id))
+        for entry in self.db_[str(guild_id)].find({}, {'user_id': 1}):
+            samples = [(entry['user_id'], [session['name']], session['start_time'], session['start_time'] + timedelta(seconds=session['duration']))
+                       for session in self.get_raw_sessions_data(guild_id, entry['user_id'])]
+            for index in range(0, len(samples), batch_size):
+                self.rollups_.add_samples(str(guild_id), samples[index:index+batch_size])
+        _log.info(f'Rebuilt rollups for {guild_id}')
+
+    def get_user_leaderboard(self, guild_id: IdType, game: Optional[str]=None, from_time: Optional[datetime]=None, limit: int=10) -> List[dict]:
+        # Per user totals for the whole guild from one grouped pass over every source,
+        # not one aggregation per member
+        if self.rollups_:
+            user_totals = self._get_user_totals_from_rollups(str(guild_id), game, from_time)
+        else:
+            user_totals = self._get_user_totals(str(guild_id), game, from_time)
+        return [{'user_id': user_id, 'duration': duration}
+                for user_id, duration in sorted(user_totals.items(), key=lambda entry: entry[1], reverse=True)[:limit]]
+
+    def _get_user_totals(self, guild_id: str, game: Optional[str], from_time: Optional[datetime]) -> Dict[str, float]:
+        session_match = dict()
+        if from_time:
+            session_match['start_time'] = {'$gte': from_time}
+        if game:
+            session_match['name'] = {'$in': self._get_stored_names(game)}
+        fields = ['$ongoing_sessions'] if self.session_layout_ == COLLECTION_LAYOUT else ['$ongoing_sessions', '$sessions']
+        aggregate_data = list(self.db_[guild_id].aggregate([
+            {'$project': {'_id': 0, 'user_id': 1, 'sessions': {'$concatArrays': fields}}},
+            {'$unwind': '$sessions'},
+            {'$match': {f'sessions.{field}': condition for field, condition in session_match.items()}},
+            {'$group': {'_id': '$user_id', 'duration': {'$sum': '$sessions.duration'}}}
+            ]))
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            aggregate_data.extend(self.sessions_db_.aggregate([
+                {'$match': dict(session_match, guild_id=guild_id)},
+                {'$group': {'_id': '$user_id', 'duration': {'$sum': '$duration'}}}
+                ]))
+        summary_match = {'guild_id': guild_id}
+        if from_time:
+            summary_match['day'] = {'$gte': from_time}
+        if game:
+            summary_match['name'] = game
+        aggregate_data.extend(self.summaries_db_.aggregate([
+            {'$match': summary_match},
+            {'$group': {'_id': '$user_id', 'duration': {'$sum': '$duration'}}}
+            ]))
+        user_totals = dict()
+        for data in aggregate_data:
+            user_totals[data['_id']] = user_totals.get(data['_id'], 0) + data['duration']
+        return user_totals
+
+    def _get_user_totals_from_rollups(self, guild_id: str, game: Optional[str], from_time: Optional[datetime]) -> Dict[str, float]:
+        # Same split of the window into daily and hourly buckets as the aggregated activities
+        if not from_time:
+            return self.rollups_.get_user_totals(DAY, guild_id, game, None)
+        first_hour = floor_time(from_time, HOUR)
+        first_day = ceil_time(first_hour, DAY)
+        user_totals = self.rollups_.get_user_totals(DAY, guild_id, game, first_day)
+        for user_id, duration in self.rollups_.get_user_totals(HOUR, guild_id, game, first_hour, first_day).items():
+            user_totals[user_id] = user_totals.get(user_id, 0) + duration
+        return user_totals
+
+    def get_longest_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> List[dict]:
+        if self.longest_ and is_month_aligned(from_time):
+            return self.longest_.get_longest_sessions(str(guild_id), str(user_id) if user_id else None, from_time)
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            return self._get_longest_activities_from_collection(guild_id, user_id, from_time)
+        guild_db = self.db_[str(guild_id)]
+        user_match_data = {'user_id': str(user_id)} if user_id else dict()
+        session_match_data = {'sessions.start_time': {'$gte': from_time}} if from_time else dict()
         longest_activites_data = guild_db.aggregate([
+            {'$match': user_match_data},
             {'$project': {'user_id': '$user_id', 'sessions': {'$concatArrays': ['$sessions', '$ongoing_sessions']}}},
             {'$unwind': '$sessions'},
-            {'$match': match_data},
+            {'$match': session_match_data},
             {'$project': {'_id': 0, 'name': '$sessions.name', 'duration': '$sessions.duration', 'start_time': '$sessions.start_time', 'user_id': '$user_id'}},
             {'$sort': {'duration': -1}},
             {'$limit': 15}
         ])
-        return list(longest_activites_data)
+        return self._decode_sessions(list(longest_activites_data))
+
+    def _get_longest_activities_from_collection(self, guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime], limit: int=15) -> List[dict]:
+        longest_sessions = list(self.sessions_db_.find(
+            self._get_session_collection_match(guild_id, user_id, from_time),
+            {'_id': 0, 'name': 1, 'duration': 1, 'start_time': 1, 'user_id': 1}
+            ).sort('duration', -1).limit(limit))
+        match_data = dict()
+        if user_id:
+            match_data['user_id'] = str(user_id)
+        if from_time:
+            match_data['ongoing_sessions.start_time'] = {'$gte': from_time}
+        longest_sessions.extend(self.db_[str(guild_id)].aggregate([
+            {'$unwind': '$ongoing_sessions'},
+            {'$match': match_data},
+            {'$project': {'_id': 0, 'name': '$ongoing_sessions.name', 'duration': '$ongoing_sessions.duration', 'start_time': '$ongoing_sessions.start_time', 'user_id': '$user_id'}},
+        ]))
+        return self._decode_sessions(sorted(longest_sessions, key=lambda session: session['duration'], reverse=True)[:limit])
+
+    def rebuild_longest_sessions(self, guild_id: IdType):
+        if not self.longest_:
+            raise RuntimeError('Longest sessions index is not enabled for this database.')
+        self.longest_.delete(str(guild_id))
+        for entry in self.db_[str(guild_id)].find({}, {'user_id': 1}):
+            sessions = self.get_raw_sessions_data(guild_id, entry['user_id'])
+            self.longest_.add_sessions(str(guild_id), [(entry['user_id'], session) for session in sessions])
+            self.longest_.trim(str(guild_id))
+        _log.info(f'Rebuilt longest sessions for {guild_id}')
+
+    def get_heatmap(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Optional['np.ndarray']:
+        if not self.heatmaps_:
+            return None
+        from_week = get_heatmap_week_start(from_time) if from_time else None
+        return self.heatmaps_.get_weights(str(guild_id), str(user_id) if user_id else None, from_week)
+
+    def rebuild_heatmaps(self, guild_id: IdType, batch_size: int=1000):
+        if not self.heatmaps_:
+            raise RuntimeError('Heatmaps are not enabled for this database.')
+        self.heatmaps_.delete(str(guild_id))
+        for sessions in self.iter_sessions(guild_id, batch_size=batch_size, include_user_id=True):
+            self.heatmaps_.add_samples(str(guild_id), [
+                (session['user_id'], [session['name']], session['start_time'], session['start_time'] + timedelta(seconds=session['duration']))
+                for session in sessions])
+        _log.info(f'Rebuilt heatmaps for {guild_id}')
+
+    def run_maintenance(self):
+        super().run_maintenance()
+        if self.longest_:
+            for guild_id in self.get_guild_ids():
+                self.longest_.trim(guild_id)
+
+    def _get_closed_sessions_before(self, guild_id: IdType, before_time: datetime) -> List[dict]:
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            return self._decode_sessions(list(self.sessions_db_.find({'guild_id': str(guild_id), 'start_time': {'$lt': before_time}},
+                                                                     {'guild_id': 0})))
+        return self._decode_sessions(list(self.db_[str(guild_id)].aggregate([
+            {'$match': {'sessions.start_time': {'$lt': before_time}}},
+            {'$unwind': '$sessions'},
+            {'$match': {'sessions.start_time': {'$lt': before_time}}},
+            {'$project': {'_id': 0, 'user_id': '$user_id', 'name': '$sessions.name', 'start_time': '$sessions.start_time', 'duration': '$sessions.duration'}},
+        ])))
+
+    def _replace_sessions_with_summaries(self, guild_id: IdType, sessions: List[dict], summaries: List[dict]):
+        # Not atomic without a replica set. Summaries go first, if removing the sessions
+        # fails the archive has the exact sessions to remove by hand.
+        self.summaries_db_.bulk_write([
+            UpdateOne({'guild_id': str(guild_id), 'user_id': summary['user_id'], 'day': summary['day'], 'name': summary['name']},
+                      {'$inc': {'duration': summary['duration'], 'session_count': summary['session_count']},
+                       '$max': {'longest': summary['longest']}},
+                      upsert=True)
+            for summary in summaries
+            ], ordered=False)
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            session_ids = [session['_id'] for session in sessions]
+            for index in range(0, len(session_ids), 1000):
+                self.sessions_db_.delete_many({'_id': {'$in': session_ids[index:index+1000]}})
+            return
+        user_to_sessions = dict()
+        for session in sessions:
+            user_to_sessions.setdefault(session['user_id'], []).append(session)
+        self.db_[str(guild_id)].bulk_write([
+            UpdateOne({'user_id': user_id}, {'$pull': {'sessions': {'$or': [
+                {'name': {'$in': self._get_stored_names(session['name'])}, 'start_time': session['start_time']} for session in user_sessions]}}})
+            for user_id, user_sessions in user_to_sessions.items()
+            ], ordered=False)
+
+    def iter_sessions(self, guild_id: IdType, user_id: Optional[IdType]=None, batch_size: int=1000, include_user_id: bool=False) -> Iterator[List[dict]]:
+        match_data = {'user_id': str(user_id)} if user_id else dict()
+        session_projection = {'_id': 0, 'name': 1, 'start_time': 1, 'duration': 1}
+        if include_user_id:
+            session_projection['user_id'] = 1
+        fields = ['$ongoing_sessions'] if self.session_layout_ == COLLECTION_LAYOUT else ['$ongoing_sessions', '$sessions']
+        cursors = [self.db_[str(guild_id)].aggregate([
+            {'$match': match_data},
+            {'$project': {'_id': 0, 'user_id': 1, 'sessions': {'$concatArrays': fields}}},
+            {'$unwind': '$sessions'},
+            {'$replaceRoot': {'newRoot': {'$mergeObjects': ['$sessions', {'user_id': '$user_id'}]}}},
+            {'$project': session_projection},
+            ], batchSize=batch_size)]
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            cursors.append(self.sessions_db_.find(self._get_session_collection_match(guild_id, user_id, None), session_projection).batch_size(batch_size))
+        for cursor in cursors:
+            batch = []
+            for session in cursor:
+                batch.append(session)
+                if len(batch) == batch_size:
+                    yield self._decode_sessions(batch)
+                    batch = []
+            if batch:
+                yield self._decode_sessions(batch)
+
+    def iter_summaries(self, guild_id: IdType, batch_size: int=1000) -> Iterator[List[dict]]:
+        batch = []
+        for summary in self.summaries_db_.find({'guild_id': str(guild_id)}, {'_id': 0, 'user_id': 1, 'name': 1, 'day': 1, 'duration': 1}).batch_size(batch_size):
+            batch.append(summary)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
     def get_raw_sessions_data(self, guild_id: IdType, user_id: Optional[IdType]=None) -> List[dict]:
         guild_db = self.db_[str(guild_id)]
         match_data = {}
         if user_id:
             match_data['user_id'] = str(user_id)
-        raw_sessions_list = [entry['ongoing_sessions'] + entry['sessions']
+        raw_sessions_list = [entry.get('ongoing_sessions', []) + entry.get('sessions', [])
                              for entry in guild_db.find(match_data)]
         raw_sessions = [
             session for session_list in raw_sessions_list for session in session_list]
-        return raw_sessions
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            raw_sessions.extend(self.sessions_db_.find(
+                self._get_session_collection_match(guild_id, user_id, None),
+                {'_id': 0, 'name': 1, 'start_time': 1, 'duration': 1}))
+        return self._decode_sessions(raw_sessions)
+
+    def migrate_sessions_to_collection(self, guild_id: IdType) -> int:
+        guild_db = self.db_[str(guild_id)]
+        migrated_count = 0
+        for entry in guild_db.find({'sessions.0': {'$exists': True}}, {'user_id': 1, 'sessions': 1}):
+            # Ids are derived from the session, so running again after a crash replaces
+            # the copies already made instead of duplicating them
+            self.sessions_db_.bulk_write([
+                ReplaceOne({'_id': self._get_session_id(guild_id, entry['user_id'], session)},
+                           dict(session, guild_id=str(guild_id), user_id=entry['user_id']), upsert=True)
+                for session in entry['sessions']], ordered=False)
+            # Only the copied sessions are removed, sessions the tracker closed meanwhile are
+            # left for the next run
+            guild_db.update_one({'_id': entry['_id']}, {'$pull': {'sessions': {'$or': [
+                {'name': session['name'], 'start_time': session['start_time']} for session in entry['sessions']]}}})
+            migrated_count += len(entry['sessions'])
+        _log.info(f'Migrated {migrated_count} sessions of {guild_id} to the sessions collection')
+        return migrated_count
+
+    def _get_session_id(self, guild_id: IdType, user_id: IdType, session: dict) -> str:
+        # A user can't start the same game twice at the same time
+        return f'{guild_id}:{user_id}:{session["name"]}:{session["start_time"].isoformat()}'
+
+    def encode_game_names(self, guild_id: IdType, batch_size: int=100) -> int:
+        if not self.games_:
+            raise RuntimeError('Game name encoding is not enabled for this database.')
+        guild_db = self.db_[str(guild_id)]
+        encoded_count = 0
+        requests = []
+        for entry in guild_db.find({}, {'ongoing_sessions': 1, 'sessions': 1}):
+            stored_fields = {field_name: entry[field_name] for field_name in ['ongoing_sessions', 'sessions'] if field_name in entry}
+            sessions = [session for field_sessions in stored_fields.values() for session in field_sessions if isinstance(session['name'], str)]
+            if not sessions:
+                continue
+            name_to_id = self.games_.get_ids(session['name'] for session in sessions)
+            encoded_fields = {field_name: [dict(session, name=name_to_id.get(session['name'], session['name'])) for session in field_sessions]
+                              for field_name, field_sessions in stored_fields.items()}
+            # Matches the arrays as read, so a document the tracker changed meanwhile is
+            # skipped instead of losing the change. Running the migration again picks it up.
+            requests.append(UpdateOne(dict(stored_fields, _id=entry['_id']), {'$set': encoded_fields}))
+            encoded_count += len(sessions)
+            if len(requests) == batch_size:
+                guild_db.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            guild_db.bulk_write(requests, ordered=False)
+        if self.session_layout_ == COLLECTION_LAYOUT:
+            names = [name for name in self.sessions_db_.distinct('name', {'guild_id': str(guild_id)}) if isinstance(name, str)]
+            for name, game_id in self.games_.get_ids(names).items():
+                encoded_count += self.sessions_db_.update_many({'guild_id': str(guild_id), 'name': name}, {'$set': {'name': game_id}}).modified_count
+        _log.info(f'Encoded {encoded_count} game names of {guild_id}')
+        return encoded_count
+
+    def get_storage_size(self) -> Dict[str, int]:
+        # Uncompressed data size in bytes of the collections holding sessions
+        existing_names = set(self.db_.list_collection_names())
+        collection_names = self.get_guild_ids() + [self.SESSIONS_COLLECTION, MongoGameDictionary.COLLECTION]
+        return {collection_name: self.db_.command('collStats', collection_name).get('size', 0)
+                for collection_name in collection_names if collection_name in existing_names}
 
     def reset_guild_data(self, guild_id: IdType):
         guild_db = self.db_[str(guild_id)]
         guild_db.drop()
+        self.sessions_db_.delete_many({'guild_id': str(guild_id)})
+        self.summaries_db_.delete_many({'guild_id': str(guild_id)})
+        if self.rollups_:
+            self.rollups_.delete(str(guild_id))
+        if self.longest_:
+            self.longest_.delete(str(guild_id))
+        if self.heatmaps_:
+            self.heatmaps_.delete(str(guild_id))
 
     def delete_guild_data(self, guild_id: IdType):
         self.reset_guild_data(guild_id)
         user_db = self.db_['blacklisted_user_ids']
         user_db.delete_one({'guild_id': str(guild_id)})
+        if self.blacklists_ is not None:
+            self.blacklists_.pop(str(guild_id), None)
+            self.blacklist_versions_.pop(str(guild_id), None)
 
     def reset_user_data(self, guild_id: IdType, user_id: IdType):
         guild_db = self.db_[str(guild_id)]
         guild_db.delete_one({'user_id':str(user_id)})
+        self.sessions_db_.delete_many({'guild_id': str(guild_id), 'user_id': str(user_id)})
+        self.summaries_db_.delete_many({'guild_id': str(guild_id), 'user_id': str(user_id)})
+        if self.rollups_:
+            self.rollups_.delete(str(guild_id), str(user_id))
+        if self.longest_:
+            self.longest_.delete(str(guild_id), str(user_id))
+        if self.heatmaps_:
+            self.heatmaps_.delete(str(guild_id), str(user_id))
 
     def delete_user_data(self, guild_id: IdType, user_id: IdType):
         self.reset_user_data(guild_id, user_id)
-        user_db = self.db_['blacklisted_user_ids']
-        guild_tracker = user_db.find_one({'guild_id':str(guild_id)})
-        guild_tracker['blacklisted_users'][:] = [user_id for user_id in guild_tracker['blacklisted_users'][:] if user_id != str(user_id)]
-        user_db.find_one_and_update(
-            {'guild_id':str(guild_id)},
-            {'$set': {'blacklisted_users': guild_tracker['blacklisted_users']}},
-            upsert=False)
+        self.remove_blacklisted_users(guild_id, [user_id])
 
 if __name__ == '__main__':
     import os
@@ -0,0 +1,64 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Callable, Awaitable, Any, Hashable
+
+from .log import Logger
+from .metrics import registry
+
+_log = Logger('Flight')
+
+class GuildBusyError(RuntimeError):
+    pass
+
+class SingleFlight():
+    # Concurrent calls with the same key share one running computation. The
+    # computation runs as its own task so a caller being cancelled doesn't
+    # cancel it for the others.
+    def __init__(self):
+        self.in_flight_ = dict()
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.in_flight_.get(key, None)
+        if task:
+            registry.inc('timetrak_singleflight_shared_total')
+        else:
+            task = asyncio.ensure_future(func())
+            self.in_flight_[key] = task
+            task.add_done_callback(lambda _: self.in_flight_.pop(key, None))
+        return await asyncio.shield(task)
+
+    def get_in_flight_count(self) -> int:
+        return len(self.in_flight_)
+
+class GuildLimiter():
+    # Every guild may run max_concurrent commands with max_queued more waiting.
+    # Anything beyond that is rejected right away so one busy guild can't tie
+    # up the db threads for everyone else.
+    def __init__(self, max_concurrent: int = 2, max_queued: int = 4):
+        self.max_concurrent_ = max_concurrent
+        self.max_queued_ = max_queued
+        self.guild_to_semaphore_ = dict()
+        self.guild_to_pending_count_ = dict()
+
+    @asynccontextmanager
+    async def acquire(self, guild_id: Hashable):
+        guild_id = str(guild_id)
+        pending_count = self.guild_to_pending_count_.get(guild_id, 0)
+        if pending_count >= self.max_concurrent_ + self.max_queued_:
+            registry.inc('timetrak_guild_busy_total')
+            raise GuildBusyError(f'{pending_count} commands are already pending for {guild_id}')
+        if guild_id not in self.guild_to_semaphore_:
+            self.guild_to_semaphore_[guild_id] = asyncio.Semaphore(self.max_concurrent_)
+        self.guild_to_pending_count_[guild_id] = pending_count + 1
+        try:
+            async with self.guild_to_semaphore_[guild_id]:
+                yield
+        finally:
+            self.guild_to_pending_count_[guild_id] -= 1
+            if self.guild_to_pending_count_[guild_id] == 0:
+                # Drop idle guilds so the maps only hold guilds with commands in flight
+                del self.guild_to_pending_count_[guild_id]
+                del self.guild_to_semaphore_[guild_id]
+
+    def get_pending_count(self, guild_id: Hashable) -> int:
+        return self.guild_to_pending_count_.get(str(guild_id), 0)
@@ -0,0 +1,73 @@
+import threading
+from typing import Iterable, Dict, Union
+from pymongo import UpdateOne, ASCENDING, ReturnDocument
+from pymongo.database import Database
+
+from .log import Logger
+
+_log = Logger('Games')
+
+class MongoGameDictionary():
+    # Maps game names to small integer ids shared by every guild, so sessions
+    # store an id instead of repeating the full name. Both directions are
+    # cached in process, names never change ids once assigned.
+    COLLECTION = 'game_names'
+    COUNTERS_COLLECTION = 'counters'
+
+    def __init__(self, db: Database):
+        self.games_db_ = db[self.COLLECTION]
+        self.games_db_.create_index([('name', ASCENDING)], unique=True)
+        self.games_db_.create_index([('game_id', ASCENDING)], unique=True)
+        self.counters_db_ = db[self.COUNTERS_COLLECTION]
+        self.name_to_id_ = dict()
+        self.id_to_name_ = dict()
+        self.lock_ = threading.Lock()
+
+    def _cache(self, entries: Iterable[dict]):
+        with self.lock_:
+            for entry in entries:
+                self.name_to_id_[entry['name']] = entry['game_id']
+                self.id_to_name_[entry['game_id']] = entry['name']
+
+    def get_ids(self, names: Iterable[str]) -> Dict[str, int]:
+        names = set(names)
+        missing_names = [name for name in names if name not in self.name_to_id_]
+        if missing_names:
+            self._cache(self.games_db_.find({'name': {'$in': missing_names}}, {'_id': 0}))
+            missing_names = [name for name in missing_names if name not in self.name_to_id_]
+        if missing_names:
+            # Ids are reserved in one counter update. When another process adds the
+            # same name first its id wins and the reserved one is left unused.
+            counter = self.counters_db_.find_one_and_update({'_id': self.COLLECTION}, {'$inc': {'next_id': len(missing_names)}},
+                                                            upsert=True, return_document=ReturnDocument.AFTER)
+            first_id = counter['next_id'] - len(missing_names)
+            self.games_db_.bulk_write([
+                UpdateOne({'name': name}, {'$setOnInsert': {'game_id': first_id + index}}, upsert=True)
+                for index, name in enumerate(missing_names)
+                ], ordered=False)
+            self._cache(self.games_db_.find({'name': {'$in': missing_names}}, {'_id': 0}))
+            _log.debug(lambda: f'Added {len(missing_names)} game names')
+        return {name: self.name_to_id_[name] for name in names}
+
+    def find_ids(self, names: Iterable[str]) -> Dict[str, int]:
+        # Like get_ids but only for names already in the dictionary, for queries
+        # that must not add the names they are given
+        names = set(names)
+        missing_names = [name for name in names if name not in self.name_to_id_]
+        if missing_names:
+            self._cache(self.games_db_.find({'name': {'$in': missing_names}}, {'_id': 0}))
+        return {name: self.name_to_id_[name] for name in names if name in self.name_to_id_}
+
+    def get_names(self, game_ids: Iterable[int]) -> Dict[int, str]:
+        game_ids = set(game_ids)
+        missing_ids = [game_id for game_id in game_ids if game_id not in self.id_to_name_]
+        if missing_ids:
+            self._cache(self.games_db_.find({'game_id': {'$in': missing_ids}}, {'_id': 0}))
+        # An unknown id is shown as is rather than failing the whole query
+        return {game_id: self.id_to_name_.get(game_id, str(game_id)) for game_id in game_ids}
+
+    def decode(self, names: Iterable[Union[int, str]]) -> Dict[Union[int, str], str]:
+        # Sessions written before names were encoded still hold the name itself
+        names = set(names)
+        id_to_name = self.get_names([name for name in names if isinstance(name, int)])
+        return {name: id_to_name[name] if isinstance(name, int) else name for name in names}
@@ -0,0 +1,67 @@
+from typing import Optional, List, Tuple, Dict, TYPE_CHECKING
+from datetime import datetime
+from pymongo import UpdateOne, ASCENDING
+from pymongo.database import Database
+
+from .log import Logger
+from .binning import DAYS_IN_WEEK, BINS_IN_DAY, BINS_IN_WEEK, bin_sessions_weekly, split_by_heatmap_weeks
+
+if TYPE_CHECKING:
+    import numpy as np
+
+_log = Logger('Heatmaps')
+
+class MongoHeatmaps():
+    # Seconds played in every weekday and half hour bin, kept per user and for
+    # the whole guild (user_id None), both all time (week None) and per heatmap
+    # week. Only bins with play time are stored, as bins.<index>.
+    COLLECTION = 'heatmaps'
+
+    def __init__(self, db: Database):
+        self.heatmaps_db_ = db[self.COLLECTION]
+        self.heatmaps_db_.create_index([('guild_id', ASCENDING), ('user_id', ASCENDING), ('week', ASCENDING)], unique=True)
+
+    def add_samples(self, guild_id: str, samples: List[Tuple[str, List[str], datetime, datetime]]):
+        import numpy as np
+        user_week_to_parts: Dict[Tuple[str, datetime], List[Tuple[float, float]]] = dict()
+        for user_id, activities, start_time, end_time in samples:
+            if not activities:
+                continue
+            for week_start, part_start, duration in split_by_heatmap_weeks(start_time, end_time):
+                # Like sessions, play time counts once per game played at the same time
+                user_week_to_parts.setdefault((str(user_id), week_start), []).extend(
+                    [((part_start - datetime(1970, 1, 1)).total_seconds(), duration)]*len(activities))
+        increments = dict()
+        for (user_id, week_start), parts in user_week_to_parts.items():
+            start_epochs, durations = np.array(parts, dtype=np.float64).T
+            weights = bin_sessions_weekly(start_epochs, durations).ravel()
+            for key in [(user_id, None), (user_id, week_start), (None, None), (None, week_start)]:
+                increments[key] = increments[key] + weights if key in increments else weights
+        if not increments:
+            return
+        self.heatmaps_db_.bulk_write([
+            UpdateOne({'guild_id': guild_id, 'user_id': user_id, 'week': week_start},
+                      {'$inc': {f'bins.{index}': float(weights[index]) for index in np.flatnonzero(weights)}}, upsert=True)
+            for (user_id, week_start), weights in increments.items() if weights.any()
+            ], ordered=False)
+
+    def get_weights(self, guild_id: str, user_id: Optional[str], from_week: Optional[datetime]) -> 'np.ndarray':
+        import numpy as np
+        match_data = {'guild_id': guild_id, 'user_id': user_id}
+        match_data['week'] = {'$gte': from_week} if from_week else None
+        weights = np.zeros(BINS_IN_WEEK, dtype=np.float64)
+        for heatmap in self.heatmaps_db_.find(match_data, {'_id': 0, 'bins': 1}):
+            for index, seconds in heatmap.get('bins', dict()).items():
+                weights[int(index)] += seconds
+        return weights.reshape(DAYS_IN_WEEK, BINS_IN_DAY)
+
+    def delete(self, guild_id: str, user_id: Optional[str]=None):
+        if not user_id:
+            self.heatmaps_db_.delete_many({'guild_id': guild_id})
+            return
+        # The user's play time also comes out of the guild heatmaps
+        for heatmap in self.heatmaps_db_.find({'guild_id': guild_id, 'user_id': user_id}, {'_id': 0, 'week': 1, 'bins': 1}):
+            if heatmap.get('bins'):
+                self.heatmaps_db_.update_one({'guild_id': guild_id, 'user_id': None, 'week': heatmap['week']},
+                                             {'$inc': {f'bins.{index}': -seconds for index, seconds in heatmap['bins'].items()}})
+        self.heatmaps_db_.delete_many({'guild_id': guild_id, 'user_id': user_id})
@@ -1,3 +1,11 @@
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import threading
+from datetime import datetime
 from typing import Optional, Callable
 from enum import IntEnum
 
@@ -9,33 +17,131 @@ class Level(IntEnum):
     ERROR = 40
 
 _global_log_level = Level.INFO
+_json_format = False
 
 def set_log_level(level: Level):
     global _global_log_level
     _global_log_level = level
 
+def set_json_format(enabled: bool):
+    global _json_format
+    _json_format = enabled
+
+class _LogWriter():
+    # Single background thread per process that does the actual writes, so
+    # logging from the event loop never waits on stdout
+    def __init__(self, max_queued: int = 10000):
+        self.queue_ = queue.Queue(maxsize=max_queued)
+        self.dropped_count_ = 0
+        self.thread_ = None
+        self.pid_ = None
+        self.lock_ = threading.Lock()
+
+    def _ensure_started(self):
+        # The thread doesn't survive a fork, so restart it in child processes
+        if self.thread_ is not None and self.pid_ == os.getpid():
+            return
+        with self.lock_:
+            if self.thread_ is not None and self.pid_ == os.getpid():
+                return
+            self.queue_ = queue.Queue(maxsize=self.queue_.maxsize)
+            self.pid_ = os.getpid()
+            self.thread_ = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self.thread_.start()
+
+    def put(self, log_func: Callable[..., None], line: str, kwargs: dict):
+        self._ensure_started()
+        try:
+            self.queue_.put_nowait((log_func, line, kwargs))
+        except queue.Full:
+            self.dropped_count_ += 1
+
+    def _run(self):
+        while True:
+            log_func, line, kwargs = self.queue_.get()
+            try:
+                if self.dropped_count_:
+                    dropped_count, self.dropped_count_ = self.dropped_count_, 0
+                    log_func(f'Log: dropped {dropped_count} records, log queue was full')
+                log_func(line, **kwargs)
+            except Exception:
+                pass
+            finally:
+                self.queue_.task_done()
+
+    def flush(self):
+        if self.thread_ is not None and self.pid_ == os.getpid():
+            self.queue_.join()
+
+_writer = _LogWriter()
+atexit.register(_writer.flush)
+
+def flush():
+    _writer.flush()
+
 class Logger:
-    def __init__(self, name: str, level: Optional[Level] = Level.GLOBAL, log_func: Callable[..., None] = print):
+    # Arguments that are callables are only called once the record passes the
+    # level, sampling and rate checks, so pass lambda: f'...' for anything
+    # costly to build on hot paths.
+    # sample_rate keeps that fraction of debug and info records and
+    # rate_limit caps them to that many records per second. Warnings and
+    # errors are always written.
+    def __init__(self, name: str, level: Optional[Level] = Level.GLOBAL, log_func: Callable[..., None] = print,
+                 sample_rate: float = 1.0, rate_limit: Optional[float] = None):
         self.name_ = name
         self.level_ = level
         self.log_func_ = log_func
+        self.sample_rate_ = sample_rate
+        self.rate_limit_ = rate_limit
+        self.tokens_ = rate_limit
+        self.last_refill_ = time.monotonic()
+        self.suppressed_count_ = 0
+        self.lock_ = threading.Lock()
+
+    def is_enabled_for(self, level: Level) -> bool:
+        log_level = _global_log_level if self.level_ == Level.GLOBAL else self.level_
+        return log_level <= level
+
+    def _allow(self, level: Level) -> bool:
+        if level >= Level.WARNING:
+            return True
+        if self.sample_rate_ < 1.0 and random.random() >= self.sample_rate_:
+            return False
+        if self.rate_limit_ is not None:
+            with self.lock_:
+                now = time.monotonic()
+                self.tokens_ = min(self.rate_limit_, self.tokens_ + (now - self.last_refill_)*self.rate_limit_)
+                self.last_refill_ = now
+                if self.tokens_ < 1:
+                    self.suppressed_count_ += 1
+                    return False
+                self.tokens_ -= 1
+        return True
+
+    def _log(self, level: Level, args: tuple, kwargs: dict):
+        if not self.is_enabled_for(level) or not self._allow(level):
+            return
+        # Keyword arguments go to log_func like they would to print, except sep
+        # which has to be applied before the record is queued
+        sep = kwargs.pop('sep', ' ')
+        message = sep.join(str(arg() if callable(arg) else arg) for arg in args)
+        if self.suppressed_count_:
+            message += f' ({self.suppressed_count_} records suppressed by rate limit)'
+            self.suppressed_count_ = 0
+        if _json_format:
+            line = json.dumps({'time': datetime.now().isoformat(), 'level': level.name, 'logger': self.name_, 'message': message})
+        else:
+            line = self.name_ + ':' + sep + message
+        _writer.put(self.log_func_, line, kwargs)
 
     def debug(self, *args, **kwargs):
-        level = _global_log_level if self.level_ == Level.GLOBAL else self.level_
-        if level <= Level.DEBUG:
-            self.log_func_(self.name_+':', *args, **kwargs)
+        self._log(Level.DEBUG, args, kwargs)
 
     def info(self, *args, **kwargs):
-        level = _global_log_level if self.level_ == Level.GLOBAL else self.level_
-        if level <= Level.INFO:
-            self.log_func_(self.name_+':', *args, **kwargs)
+        self._log(Level.INFO, args, kwargs)
 
     def warning(self, *args, **kwargs):
-        level = _global_log_level if self.level_ == Level.GLOBAL else self.level_
-        if level <= Level.WARNING:
-            self.log_func_(self.name_+':', *args, **kwargs)
+        self._log(Level.WARNING, args, kwargs)
 
     def error(self, *args, **kwargs):
-        level = _global_log_level if self.level_ == Level.GLOBAL else self.level_
-        if level <= Level.ERROR:
-            self.log_func_(self.name_+':', *args, **kwargs)
+        self._log(Level.ERROR, args, kwargs)
@@ -0,0 +1,77 @@
+from typing import Optional, List, Tuple
+from datetime import datetime
+from pymongo import UpdateOne, DeleteMany, ASCENDING, DESCENDING
+from pymongo.database import Database
+
+from .log import Logger
+
+_log = Logger('Longest')
+
+def month_start(time: datetime) -> datetime:
+    return time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def year_start(time: datetime) -> datetime:
+    return month_start(time).replace(month=1)
+
+def is_month_aligned(time: Optional[datetime]) -> bool:
+    return time is None or time == month_start(time)
+
+class MongoLongestSessions():
+    # Keeps the top_k longest sessions of every user in every month. Any top K
+    # for a user or the guild over whole months (all time, a year, a month) is
+    # made of these, so the reads are an index walk of top_k documents.
+    COLLECTION = 'longest_sessions'
+
+    def __init__(self, db: Database, top_k: int = 15):
+        self.top_k_ = top_k
+        self.longest_db_ = db[self.COLLECTION]
+        self.longest_db_.create_index([('guild_id', ASCENDING), ('user_id', ASCENDING), ('name', ASCENDING), ('start_time', ASCENDING)], unique=True)
+        self.longest_db_.create_index([('guild_id', ASCENDING), ('duration', DESCENDING)])
+        self.longest_db_.create_index([('guild_id', ASCENDING), ('user_id', ASCENDING), ('duration', DESCENDING)])
+        self.longest_db_.create_index([('guild_id', ASCENDING), ('month', ASCENDING), ('duration', DESCENDING)])
+
+    def add_sessions(self, guild_id: str, user_sessions: List[Tuple[str, dict]]):
+        # Sessions are upserted with their current duration every time they grow or close
+        if not user_sessions:
+            return
+        self.longest_db_.bulk_write([
+            UpdateOne({'guild_id': guild_id, 'user_id': user_id, 'name': session['name'], 'start_time': session['start_time']},
+                      {'$max': {'duration': session['duration']}, '$setOnInsert': {'month': month_start(session['start_time'])}},
+                      upsert=True)
+            for user_id, session in user_sessions
+            ], ordered=False)
+
+    def get_longest_sessions(self, guild_id: str, user_id: Optional[str], from_time: Optional[datetime]) -> List[dict]:
+        if not is_month_aligned(from_time):
+            raise ValueError(f'Longest sessions index only covers whole months, got {from_time}')
+        match_data = {'guild_id': guild_id}
+        if user_id:
+            match_data['user_id'] = user_id
+        if from_time:
+            match_data['month'] = {'$gte': from_time}
+        return list(self.longest_db_.find(match_data, {'_id': 0, 'name': 1, 'duration': 1, 'start_time': 1, 'user_id': 1}
+                                          ).sort('duration', DESCENDING).limit(self.top_k_))
+
+    def trim(self, guild_id: str) -> int:
+        # Sessions that fell out of their user's monthly top K can never be read again
+        overflowing_groups = self.longest_db_.aggregate([
+            {'$match': {'guild_id': guild_id}},
+            {'$group': {'_id': {'user_id': '$user_id', 'month': '$month'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': self.top_k_}}},
+        ])
+        requests = []
+        for group in overflowing_groups:
+            group_match = {'guild_id': guild_id, 'user_id': group['_id']['user_id'], 'month': group['_id']['month']}
+            cutoff = list(self.longest_db_.find(group_match, {'duration': 1}).sort('duration', DESCENDING).skip(self.top_k_ - 1).limit(1))
+            requests.append(DeleteMany(dict(group_match, duration={'$lt': cutoff[0]['duration']})))
+        if not requests:
+            return 0
+        deleted_count = self.longest_db_.bulk_write(requests, ordered=False).deleted_count
+        _log.info(f'Trimmed {deleted_count} sessions from the longest sessions of {guild_id}')
+        return deleted_count
+
+    def delete(self, guild_id: str, user_id: Optional[str]=None):
+        match_data = {'guild_id': guild_id}
+        if user_id:
+            match_data['user_id'] = user_id
+        self.longest_db_.delete_many(match_data)
@@ -0,0 +1,194 @@
+import math
+import time
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple, Callable
+
+from aiohttp import web
+from .log import Logger
+
+_log = Logger('Metrics')
+
+LabelsType = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _get_labels(labels: Dict[str, str]) -> LabelsType:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(labels: LabelsType, extra: Optional[Tuple[str, str]] = None) -> str:
+    if extra:
+        labels = labels + (extra,)
+    if not labels:
+        return ''
+    label_strs = [key + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for key, value in labels]
+    return '{' + ','.join(label_strs) + '}'
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = percentile/100 * (len(sorted_values) - 1)
+    lower = math.floor(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+class Histogram():
+    # Cumulative buckets for scraping plus a window of recent observations
+    # for the percentiles shown by -debugstats
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, max_recent: int = 1024):
+        self.buckets_ = buckets
+        self.bucket_counts_ = [0]*len(buckets)
+        self.count_ = 0
+        self.sum_ = 0.0
+        self.recent_ = deque(maxlen=max_recent)
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets_):
+            if value <= bound:
+                self.bucket_counts_[index] += 1
+        self.count_ += 1
+        self.sum_ += value
+        self.recent_.append(value)
+
+    def get_percentiles(self) -> Dict[str, float]:
+        recent = sorted(self.recent_)
+        return {'count': self.count_, 'p50': get_percentile(recent, 50), 'p99': get_percentile(recent, 99)}
+
+class MetricsRegistry():
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.counters_ = dict()
+        self.gauges_ = dict()
+        self.histograms_ = dict()
+        self.help_ = dict()
+
+    def describe(self, name: str, help_str: str):
+        self.help_[name] = help_str
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _get_labels(labels)
+        with self.lock_:
+            series = self.counters_.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock_:
+            self.gauges_.setdefault(name, dict())[_get_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _get_labels(labels)
+        with self.lock_:
+            series = self.histograms_.setdefault(name, dict())
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def get_counter(self, name: str, **labels) -> float:
+        with self.lock_:
+            return self.counters_.get(name, dict()).get(_get_labels(labels), 0)
+
+    def get_gauge(self, name: str, **labels) -> Optional[float]:
+        with self.lock_:
+            return self.gauges_.get(name, dict()).get(_get_labels(labels))
+
+    def get_histogram_summary(self) -> Dict[str, Dict[LabelsType, Dict[str, float]]]:
+        with self.lock_:
+            return {name: {labels: histogram.get_percentiles() for labels, histogram in series.items()}
+                    for name, series in self.histograms_.items()}
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self.lock_:
+            for metric_type, metrics in (('counter', self.counters_), ('gauge', self.gauges_)):
+                for name, series in sorted(metrics.items()):
+                    if name in self.help_:
+                        lines.append(f'# HELP {name} {self.help_[name]}')
+                    lines.append(f'# TYPE {name} {metric_type}')
+                    for labels, value in sorted(series.items()):
+                        lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            for name, series in sorted(self.histograms_.items()):
+                if name in self.help_:
+                    lines.append(f'# HELP {name} {self.help_[name]}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.buckets_, histogram.bucket_counts_):
+                        lines.append(f'{name}_bucket{_format_labels(labels, ("le", _format_value(bound)))} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(labels, ("le", "+Inf"))} {histogram.count_}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram.sum_)}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {histogram.count_}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock_:
+            self.counters_.clear()
+            self.gauges_.clear()
+            self.histograms_.clear()
+
+# Process wide registry used by the instrumented modules
+registry = MetricsRegistry()
+registry.describe('timetrak_db_call_seconds', 'Time spent executing BaseDB methods')
+registry.describe('timetrak_db_call_errors_total', 'BaseDB calls that raised')
+registry.describe('timetrak_command_seconds', 'Time to handle a chat command including the reply')
+registry.describe('timetrak_commands_total', 'Chat commands handled')
+registry.describe('timetrak_reply_format_seconds', 'Time spent formatting command replies')
+registry.describe('timetrak_discord_send_seconds', 'Time waiting on discord to send a reply')
+registry.describe('timetrak_tracker_tick_seconds', 'Tracker tick duration')
+registry.describe('timetrak_tracker_tick_lag_seconds', 'How late a tracker tick started')
+registry.describe('timetrak_tracker_skipped_ticks_total', 'Tracker ticks skipped because the previous one was running')
+registry.describe('timetrak_tracker_samples_written', 'Samples written by the last tracker tick')
+registry.describe('timetrak_render_seconds', 'Heatmap render time in the plot workers')
+registry.describe('timetrak_render_pending', 'Plots waiting for or being rendered')
+registry.describe('timetrak_render_rejected_total', 'Plots rejected because the render queue was full')
+registry.describe('timetrak_render_timeouts_total', 'Plots that timed out and replaced the render workers')
+registry.describe('timetrak_singleflight_shared_total', 'Queries and plots that joined an identical one already running')
+registry.describe('timetrak_guild_busy_total', 'Commands rejected because their guild had too many pending')
+registry.describe('timetrak_time_to_first_tick_seconds', 'Time from process start to the end of the first tracker tick')
+
+class MetricsServer():
+    # Serves the registry in Prometheus text format on /metrics
+    def __init__(self, port: int, host: str = '127.0.0.1', metrics_registry: MetricsRegistry = registry):
+        self.port_ = port
+        self.host_ = host
+        self.registry_ = metrics_registry
+        self.runner_ = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry_.render_prometheus(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self.runner_ = web.AppRunner(app, access_log=None)
+        await self.runner_.setup()
+        await web.TCPSite(self.runner_, self.host_, self.port_).start()
+        _log.info(f'Serving metrics on http://{self.host_}:{self.port_}/metrics')
+
+    async def stop(self):
+        if self.runner_:
+            await self.runner_.cleanup()
+            self.runner_ = None
@@ -0,0 +1,50 @@
+import sys
+
+from .log import Logger
+from .db import MongoDB, COLLECTION_LAYOUT
+
+_log = Logger('Migrate')
+
+def migrate_sessions(db: MongoDB):
+    migrated_count = 0
+    for guild_id in db.get_guild_ids():
+        migrated_count += db.migrate_sessions_to_collection(guild_id)
+    _log.info(f'Moved {migrated_count} sessions to the {db.SESSIONS_COLLECTION} collection')
+
+def rebuild_rollups(db: MongoDB):
+    for guild_id in db.get_guild_ids():
+        db.rebuild_rollups(guild_id)
+
+def rebuild_longest_sessions(db: MongoDB):
+    for guild_id in db.get_guild_ids():
+        db.rebuild_longest_sessions(guild_id)
+
+def rebuild_heatmaps(db: MongoDB):
+    for guild_id in db.get_guild_ids():
+        db.rebuild_heatmaps(guild_id)
+
+def encode_game_names(db: MongoDB):
+    size_before = sum(db.get_storage_size().values())
+    for guild_id in db.get_guild_ids():
+        db.encode_game_names(guild_id)
+    size_after = sum(db.get_storage_size().values())
+    _log.info(f'Session storage went from {size_before/2**20:.1f}MiB to {size_after/2**20:.1f}MiB')
+
+MIGRATIONS = {
+    'sessions': (migrate_sessions, {'session_layout': COLLECTION_LAYOUT}),
+    'rollups': (rebuild_rollups, {'use_rollups': True}),
+    'longest': (rebuild_longest_sessions, {'use_longest_index': True}),
+    'heatmaps': (rebuild_heatmaps, {'use_heatmaps': True}),
+    'game_names': (encode_game_names, {'encode_game_names': True}),
+}
+
+if __name__ == '__main__':
+    import os
+    from dotenv import load_dotenv
+    load_dotenv()
+    if len(sys.argv) < 2 or sys.argv[1] not in MIGRATIONS:
+        _log.error(f'Usage: python -m src.migrate <{"|".join(MIGRATIONS.keys())}>')
+        sys.exit(1)
+    migration, db_kwargs = MIGRATIONS[sys.argv[1]]
+    db_kwargs.setdefault('session_layout', os.getenv('SESSION_LAYOUT', 'embedded'))
+    migration(MongoDB(mongo_url=os.getenv('MONGO_URL'), **db_kwargs))
@@ -1,18 +1,28 @@
+import os
 import re
+import asyncio
+import tempfile
 from datetime import datetime, timedelta
 from typing import List, Optional
-import humanize
 
 from discord import Message, File, Guild
 from .log import Logger
 from .bot import TrakBot
+from .render import RenderBusyError
+from .flight import GuildLimiter, GuildBusyError
+from .metrics import registry
+from .longest import month_start, year_start
 
 _log = Logger('Parser')
 
 class MessageParser():
-    def __init__(self, bot: TrakBot, prefix: str='-'):
+    # Commands that query the db or render, these count against the guild's limit
+    LIMITED_COMMANDS = ['stats', 'server', 'plot', 'longest', 'top', 'export']
+
+    def __init__(self, bot: TrakBot, prefix: str='-', limiter: Optional[GuildLimiter]=None):
         self.bot_ = bot
         self.prefix_ = prefix
+        self.limiter_ = limiter if limiter else GuildLimiter()
         self.invalid_message_ = f'Didn\'t understand the command you gave. Try `{self.prefix_}help` to see basic commands or refer my wiki.'
 
     async def parse(self, message: Message):
@@ -23,44 +33,59 @@ class MessageParser():
             return
         _log.debug('got message:', message_str)
         command_word = message_str.split()[0]
-        if command_word == 'stats':
-            await self._parse_stats_message(message)
-        elif command_word == 'server':
-            await self._parse_server_message(message)
-        elif command_word == 'plot':
-            await self._parse_plot_message(message)
-        elif command_word == 'longest':
-            await self._parse_longest_message(message)
-        elif command_word == 'help':
-            await self._parse_help_message(message)
-        else:
-            await message.channel.send(self.invalid_message_)
+        command_handlers = {
+            'stats': self._parse_stats_message,
+            'server': self._parse_server_message,
+            'plot': self._parse_plot_message,
+            'longest': self._parse_longest_message,
+            'top': self._parse_top_message,
+            'help': self._parse_help_message,
+            'debugstats': self._parse_debugstats_message,
+            'export': self._parse_export_message,
+        }
+        command_label = command_word if command_word in command_handlers else 'invalid'
+        registry.inc('timetrak_commands_total', command=command_label)
+        with registry.timer('timetrak_command_seconds', command=command_label):
+            if command_word in self.LIMITED_COMMANDS:
+                try:
+                    async with self.limiter_.acquire(message.guild.id):
+                        await command_handlers[command_word](message)
+                except GuildBusyError:
+                    await self._send(message, 'I\'m still working on earlier commands from this server. Try again in a bit.')
+            elif command_word in command_handlers:
+                await command_handlers[command_word](message)
+            else:
+                await self._send(message, self.invalid_message_)
+
+    async def _send(self, message: Message, *args, **kwargs):
+        with registry.timer('timetrak_discord_send_seconds'):
+            await message.channel.send(*args, **kwargs)
 
     async def _parse_stats_message(self, message: Message):
         message_str = message.content.lower()
         target_user = message.author
         if message.mentions:
             target_user = message.mentions[0]
-        _log.debug(f'Getting stats for user {target_user.name} {target_user.id}')
+        _log.debug(lambda: f'Getting stats for user {target_user.name} {target_user.id}')
         guild = message.guild
         activity_data = None
         time_region = None
 
         if re.match(r'.* (this|last) session', message_str):
-            activity_data = self.bot_.get_last_activity_data(guild.id, target_user.id)
+            activity_data = await self.bot_.get_last_activity_data(guild.id, target_user.id)
         elif re.match(r'.* (\d+|last) (day|week|hour|minute)', message_str):
             search_res = re.search(r' (\d+|last) (day|week|hour|minute)', message_str)
             time_region = self._get_time_region_from_string(search_res[1], search_res[2])
-            activity_data = self.bot_.get_aggregated_activity_data(guild.id, target_user.id, from_time = datetime.now() - time_region)
+            activity_data = await self.bot_.get_aggregated_activity_data(guild.id, target_user.id, from_time = datetime.now() - time_region)
         elif re.match(r'.* (total|full|forever)', message_str):
-            activity_data = self.bot_.get_aggregated_activity_data(guild.id, target_user.id, from_time=None)
+            activity_data = await self.bot_.get_aggregated_activity_data(guild.id, target_user.id, from_time=None)
         else:
             time_region = timedelta(days=7)
-            activity_data = self.bot_.get_aggregated_activity_data(guild.id, target_user.id, from_time = datetime.now() - time_region)
+            activity_data = await self.bot_.get_aggregated_activity_data(guild.id, target_user.id, from_time = datetime.now() - time_region)
 
-        _log.debug(f'Got activity data for {target_user}: {activity_data} for {time_region}')
+        _log.debug(lambda: f'Got activity data for {target_user}: {activity_data} for {time_region}')
         reply_str = self._get_message_from_activity_data(activity_data, target_user.name, time_region)
-        await message.channel.send(reply_str)
+        await self._send(message, reply_str)
 
     def _get_time_region_from_string(self, time_str: str, unit_str: str) -> timedelta:
         num = int(time_str) if time_str.isdigit() else 1
@@ -73,9 +98,12 @@ class MessageParser():
         elif unit_str == "minute":
             return timedelta(minutes=num)
 
+    @registry.timed('timetrak_reply_format_seconds', kind='activity')
     def _get_message_from_activity_data(self, activity_data: dict, user_name: str, time_region: timedelta=None, max_activities: int=15) -> str:
         if not activity_data:
             return f'No play time data available for **{user_name}**. Maybe your game activity isn\'t visible or you didn\'t play anything.'
+        # Loaded on the first reply instead of at startup
+        import humanize
         time_string = ''
         if time_region:
             time_string = ' from ' + humanize.precisedelta(time_region) + ' ago'
@@ -88,23 +116,52 @@ class MessageParser():
     async def _parse_server_message(self, message: Message):
         message_str = message.content.lower()
         guild = message.guild
-        _log.debug(f'Getting stats for server {guild.name}')
+        _log.debug(lambda: f'Getting stats for server {guild.name}')
         activity_data = None
         time_region = None
 
         if re.match(r'.* (\d+|last) (day|week|hour|minute)', message_str):
             search_res = re.search(r' (\d+|last) (day|week|hour|minute)', message_str)
             time_region = self._get_time_region_from_string(search_res[1], search_res[2])
-            activity_data = self.bot_.get_aggregated_activity_data(guild.id, from_time = datetime.now() - time_region)
+            activity_data = await self.bot_.get_aggregated_activity_data(guild.id, from_time = datetime.now() - time_region)
         elif re.match(r'.* (total|full|forever)', message_str):
-            activity_data = self.bot_.get_aggregated_activity_data(guild.id, from_time=None)
+            activity_data = await self.bot_.get_aggregated_activity_data(guild.id, from_time=None)
         else:
             time_region = timedelta(days=7)
-            activity_data = self.bot_.get_aggregated_activity_data(guild.id, from_time = datetime.now() - time_region)
+            activity_data = await self.bot_.get_aggregated_activity_data(guild.id, from_time = datetime.now() - time_region)
 
-        _log.debug(f'Got activity data for server {guild.name}: {activity_data} for {time_region}')
+        _log.debug(lambda: f'Got activity data for server {guild.name}: {activity_data} for {time_region}')
         reply_str = self._get_message_from_activity_data(activity_data, guild.name, time_region)
-        await message.channel.send(reply_str)
+        await self._send(message, reply_str)
+
+    async def _parse_top_message(self, message: Message):
+        # Game names are matched as written so they're taken from the original message
+        args_str = message.content[len(self.prefix_) + len('top'):].strip()
+        guild = message.guild
+        time_region = timedelta(days=7)
+        window_res = re.search(r'(?:^|\s)(?:(\d+|last) (day|week|hour|minute)s?|(total|full|forever))$', args_str, re.IGNORECASE)
+        if window_res:
+            time_region = None if window_res[3] else self._get_time_region_from_string(window_res[1], window_res[2].lower())
+            args_str = args_str[:window_res.start()].strip()
+        game = args_str if args_str else None
+        _log.debug(lambda: f'Getting leaderboard of {guild.name} for {game} over {time_region}')
+        leaderboard = await self.bot_.get_leaderboard_data(guild.id, game, datetime.now() - time_region if time_region else None)
+        reply_str = self._get_message_from_leaderboard(leaderboard, guild, game, time_region)
+        await self._send(message, reply_str)
+
+    @registry.timed('timetrak_reply_format_seconds', kind='leaderboard')
+    def _get_message_from_leaderboard(self, leaderboard: List[dict], guild: Guild, game: Optional[str], time_region: Optional[timedelta]) -> str:
+        game_str = f' of **{game}**' if game else ''
+        if not leaderboard:
+            return f'No play time data{game_str} available for **{guild.name}**.'
+        import humanize
+        time_string = ' from ' + humanize.precisedelta(time_region) + ' ago' if time_region else ''
+        reply_str = f'>>> Top players{game_str} in **{guild.name}**{time_string}:\n\n'
+        for rank, entry in enumerate(leaderboard, 1):
+            member = guild.get_member(int(entry['user_id']))
+            user_name = member.name if member else 'A former member'
+            reply_str += f'{rank}. **{user_name}**: ' + humanize.precisedelta(timedelta(seconds=round(entry['duration'])), minimum_unit='minutes', format='%d') + '\n'
+        return reply_str
 
     async def _parse_plot_message(self, message: Message):
         message_str = message.content.lower()
@@ -114,12 +171,24 @@ class MessageParser():
         guild = message.guild
         if re.match(r'.* server', message_str):
             target_user = None
-        _log.debug(f'Plotting heatmap for {target_user}')
+        _log.debug(lambda: f'Plotting heatmap for {target_user}')
         target_user_id = target_user.id if target_user else None
         target_user_name = target_user.name if target_user else guild.name
-        self.bot_.plot_session_weekly_heatmap(guild.id, target_user_id)
+        weeks = None
+        search_res = re.search(r' (\d+) weeks?', message_str)
+        if search_res and int(search_res[1]) > 0:
+            weeks = int(search_res[1])
+        try:
+            plot_buffer = await self.bot_.plot_session_weekly_heatmap(guild.id, target_user_id, weeks)
+        except RenderBusyError:
+            await self._send(message, 'Too many plots are being drawn right now. Try again in a bit.')
+            return
+        except asyncio.TimeoutError:
+            await self._send(message, 'Drawing the plot took too long. Try again later.')
+            return
 
-        await message.channel.send(content=f'Weekwise playtime heatmap for {target_user_name}', file=File('plot.png'))
+        weeks_str = f' over the last {weeks} weeks' if weeks else ''
+        await self._send(message, content=f'Weekwise playtime heatmap for {target_user_name}{weeks_str}', file=File(plot_buffer, filename='plot.png'))
 
     async def _parse_longest_message(self, message: Message):
         message_str = message.content.lower()
@@ -129,18 +198,28 @@ class MessageParser():
         if re.match(r'.* server', message_str):
             target_user = None
         guild = message.guild
-        _log.debug(f'Getting longest activity data for {target_user}')
+        from_time = None
+        window_str = ''
+        if re.match(r'.* month', message_str):
+            from_time = month_start(datetime.now())
+            window_str = ' this month'
+        elif re.match(r'.* year', message_str):
+            from_time = year_start(datetime.now())
+            window_str = ' this year'
+        _log.debug(lambda: f'Getting longest activity data for {target_user} from {from_time}')
         target_user_id = target_user.id if target_user else None
         target_user_name = target_user.name if target_user else None
-        longest_activity_data = self.bot_.get_longest_activity_data(guild.id, target_user_id)
-        reply_str = self._get_message_from_longest_activites(longest_activity_data, target_user_name, guild)
-        await message.channel.send(reply_str)
+        longest_activity_data = await self.bot_.get_longest_activity_data(guild.id, target_user_id, from_time)
+        reply_str = self._get_message_from_longest_activites(longest_activity_data, target_user_name, guild, window_str)
+        await self._send(message, reply_str)
 
-    def _get_message_from_longest_activites(self, longest_activities: List[dict], target_user: Optional[str], guild: Guild, max_activities: int=10) -> str:
+    @registry.timed('timetrak_reply_format_seconds', kind='longest')
+    def _get_message_from_longest_activites(self, longest_activities: List[dict], target_user: Optional[str], guild: Guild, window_str: str='', max_activities: int=10) -> str:
         user_name = target_user if target_user else guild.name
         if not longest_activities:
             return f'No play time data available for **{user_name}**. Maybe your game activity isn\'t visible or you didn\'t play anything.'
-        reply_str = f'>>> Longest sessions for {user_name}\n\n'
+        import humanize
+        reply_str = f'>>> Longest sessions for {user_name}{window_str}\n\n'
         for activity in longest_activities[:max_activities]:
             reply_str += '**' + activity['name'] + '**: ' + humanize.precisedelta(timedelta(seconds=round(activity['duration'])), minimum_unit='minutes', format='%d') + '\n'
             reply_str += '- _' + humanize.naturaldate(activity['start_time'])
@@ -149,6 +228,37 @@ class MessageParser():
             reply_str += '_ \n'
         return reply_str
 
+    async def _parse_debugstats_message(self, message: Message):
+        if not message.author.guild_permissions.administrator:
+            await self._send(message, 'Only server admins can see debug stats.')
+            return
+        reply_str = '>>> Recent timings (count, p50, p99)\n'
+        for name, series in sorted(registry.get_histogram_summary().items()):
+            for labels, summary in sorted(series.items()):
+                label_str = ','.join(value for _, value in labels)
+                reply_str += f'`{name[len("timetrak_"):]}{"[" + label_str + "]" if label_str else ""}`: {summary["count"]}, {1000*summary["p50"]:.1f}ms, {1000*summary["p99"]:.1f}ms\n'
+        cache_stats = self.bot_.get_cache_stats()
+        reply_str += f'Query cache: {cache_stats}\n'
+        # Stay under the discord message length limit
+        await self._send(message, reply_str[:1990])
+
+    async def _parse_export_message(self, message: Message):
+        if not message.author.guild_permissions.administrator:
+            await self._send(message, 'Only server admins can export the server\'s play time data.')
+            return
+        guild = message.guild
+        _log.debug(lambda: f'Exporting sessions for server {guild.name}')
+        export_file, export_path = tempfile.mkstemp(suffix='.ndjson.gz')
+        os.close(export_file)
+        try:
+            session_count = await self.bot_.export_guild_sessions(guild.id, export_path)
+            if os.path.getsize(export_path) > guild.filesize_limit:
+                await self._send(message, f'The export of {session_count} sessions is too big to upload here.')
+                return
+            await self._send(message, content=f'Exported {session_count} sessions as gzipped NDJSON',
+                             file=File(export_path, filename=f'{guild.id}-sessions.ndjson.gz'))
+        finally:
+            os.remove(export_path)
 
     async def _parse_help_message(self, message: Message):
         stats_help = f'''`{self.prefix_}stats` gives gamewise play time stats. By default the stats for *a week* is shown.
@@ -162,11 +272,17 @@ class MessageParser():
         '''
         plot_help = f'''`{self.prefix_}plot` gives a heatmap of weekwise playtime stats.
         - Mention a user to get their heatmap. By default the server stats is given.
+        - Only look at recent weeks with `{self.prefix_}plot 4 weeks`.
         '''
         longest_help = f'''`{self.prefix_}longest` gives the top 10 longest sessions you had.
         - Mention a user to get their longest sessions.
         - Get longest sessions in the server with `{self.prefix_}longest server`.
+        - Limit it to this month or year with `{self.prefix_}longest month` or `{self.prefix_}longest server year`.
+        '''
+        top_help = f'''`{self.prefix_}top` gives the 10 members of the server who played the most this week.
+        - Add a game name as shown by `{self.prefix_}server` to rank by that game, eg: `{self.prefix_}top Minecraft`.
+        - Time frames can be specified like stats, eg: `{self.prefix_}top total` or `{self.prefix_}top Minecraft 2 days`.
         '''
-        final_help = '\n'.join([stats_help, server_stats_help, plot_help, longest_help])
-        await message.channel.send(final_help)
+        final_help = '\n'.join([stats_help, server_stats_help, plot_help, longest_help, top_help])
+        await self._send(message, final_help)
 
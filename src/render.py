@@ -0,0 +1,71 @@
+import asyncio
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+from .log import Logger
+from .metrics import registry
+from .stats import render_heatmap_png
+
+if TYPE_CHECKING:
+    import numpy as np
+
+_log = Logger('Render')
+
+class RenderBusyError(RuntimeError):
+    pass
+
+class PlotRenderer():
+    def __init__(self, max_workers: int = 2, max_queued: int = 8, timeout: float = 30.0):
+        self.max_workers_ = max_workers
+        self.max_queued_ = max_queued
+        self.timeout_ = timeout
+        self.executor_ = self._create_executor()
+        self.semaphore_ = asyncio.Semaphore(max_workers)
+        self.pending_count_ = 0
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # Spawned workers don't inherit the bot's threads and connections
+        return ProcessPoolExecutor(max_workers=self.max_workers_, mp_context=multiprocessing.get_context('spawn'))
+
+    async def render_heatmap(self, weights: 'np.ndarray') -> BytesIO:
+        if self.pending_count_ >= self.max_workers_ + self.max_queued_:
+            registry.inc('timetrak_render_rejected_total')
+            raise RenderBusyError(f'{self.pending_count_} plots are already pending')
+        self.pending_count_ += 1
+        registry.set('timetrak_render_pending', self.pending_count_)
+        try:
+            async with self.semaphore_:
+                loop = asyncio.get_running_loop()
+                with registry.timer('timetrak_render_seconds'):
+                    png_data = await asyncio.wait_for(loop.run_in_executor(self.executor_, render_heatmap_png, weights), self.timeout_)
+        except asyncio.TimeoutError:
+            registry.inc('timetrak_render_timeouts_total')
+            self._recycle_executor()
+            raise
+        finally:
+            self.pending_count_ -= 1
+            registry.set('timetrak_render_pending', self.pending_count_)
+        _log.debug(lambda: f'Rendered heatmap of {len(png_data)} bytes')
+        return BytesIO(png_data)
+
+    def _recycle_executor(self):
+        # A running worker can't be cancelled. New plots go to a fresh pool and the old
+        # workers are killed once every other plot sent to them has finished or timed out.
+        _log.warning(f'Plot rendering took longer than {self.timeout_}s, replacing the render workers')
+        old_executor = self.executor_
+        # Not public, but the only handle on the workers. Shutting down drops it.
+        old_processes = list(old_executor._processes.values())
+        self.executor_ = self._create_executor()
+        old_executor.shutdown(wait=False)
+        asyncio.get_running_loop().call_later(self.timeout_, self._terminate_processes, old_processes)
+
+    def _terminate_processes(self, processes: list):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    def shutdown(self):
+        # The semaphore keeps every submitted plot running, so nothing is left queued
+        self.executor_.shutdown(wait=False)
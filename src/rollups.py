@@ -0,0 +1,94 @@
+from typing import Optional, List, Dict, Tuple
+from datetime import datetime, timedelta
+from pymongo import UpdateOne, ASCENDING
+from pymongo.database import Database
+
+from .log import Logger
+
+_log = Logger('Rollups')
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+def floor_time(time: datetime, bucket: timedelta) -> datetime:
+    if bucket == DAY:
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+    return time.replace(minute=0, second=0, microsecond=0)
+
+def ceil_time(time: datetime, bucket: timedelta) -> datetime:
+    floored_time = floor_time(time, bucket)
+    return floored_time if floored_time == time else floored_time + bucket
+
+def split_by_buckets(start_time: datetime, end_time: datetime, bucket: timedelta) -> List[Tuple[datetime, float]]:
+    buckets = []
+    bucket_start = floor_time(start_time, bucket)
+    while bucket_start < end_time:
+        bucket_end = bucket_start + bucket
+        duration = (min(end_time, bucket_end) - max(start_time, bucket_start)).total_seconds()
+        if duration > 0:
+            buckets.append((bucket_start, duration))
+        bucket_start = bucket_end
+    return buckets
+
+class MongoRollups():
+    HOURLY_COLLECTION = 'hourly_rollups'
+    DAILY_COLLECTION = 'daily_rollups'
+
+    def __init__(self, db: Database):
+        self.bucket_dbs_ = {HOUR: db[self.HOURLY_COLLECTION], DAY: db[self.DAILY_COLLECTION]}
+        for bucket_db in self.bucket_dbs_.values():
+            bucket_db.create_index([('guild_id', ASCENDING), ('user_id', ASCENDING), ('bucket', ASCENDING), ('name', ASCENDING)], unique=True)
+            bucket_db.create_index([('guild_id', ASCENDING), ('bucket', ASCENDING)])
+
+    def add_samples(self, guild_id: str, samples: List[Tuple[str, List[str], datetime, datetime]]):
+        for bucket, bucket_db in self.bucket_dbs_.items():
+            # Merge the increments so every bucket document is touched once per call
+            increments = dict()
+            for user_id, activities, start_time, end_time in samples:
+                for bucket_start, duration in split_by_buckets(start_time, end_time, bucket):
+                    for activity_name in activities:
+                        key = (str(user_id), activity_name, bucket_start)
+                        increments[key] = increments.get(key, 0) + duration
+            if not increments:
+                continue
+            bucket_db.bulk_write([
+                UpdateOne({'guild_id': guild_id, 'user_id': user_id, 'bucket': bucket_start, 'name': activity_name},
+                          {'$inc': {'duration': duration}}, upsert=True)
+                for (user_id, activity_name, bucket_start), duration in increments.items()
+                ], ordered=False)
+
+    def _get_match(self, guild_id: str, user_id: Optional[str], from_time: Optional[datetime], to_time: Optional[datetime]) -> dict:
+        match_data = {'guild_id': guild_id}
+        if user_id:
+            match_data['user_id'] = user_id
+        bucket_range = dict()
+        if from_time:
+            bucket_range['$gte'] = from_time
+        if to_time:
+            bucket_range['$lt'] = to_time
+        if bucket_range:
+            match_data['bucket'] = bucket_range
+        return match_data
+
+    def get_aggregated_activities(self, bucket: timedelta, guild_id: str, user_id: Optional[str], from_time: Optional[datetime], to_time: Optional[datetime]=None) -> Dict[str, float]:
+        aggregate_data = self.bucket_dbs_[bucket].aggregate([
+            {'$match': self._get_match(guild_id, user_id, from_time, to_time)},
+            {'$group': {'_id': '$name', 'duration': {'$sum': '$duration'}}}
+            ])
+        return {data['_id']: data['duration'] for data in aggregate_data}
+
+    def get_user_totals(self, bucket: timedelta, guild_id: str, name: Optional[str], from_time: Optional[datetime], to_time: Optional[datetime]=None) -> Dict[str, float]:
+        match_data = self._get_match(guild_id, None, from_time, to_time)
+        if name:
+            match_data['name'] = name
+        aggregate_data = self.bucket_dbs_[bucket].aggregate([
+            {'$match': match_data},
+            {'$group': {'_id': '$user_id', 'duration': {'$sum': '$duration'}}}
+            ])
+        return {data['_id']: data['duration'] for data in aggregate_data}
+
+    def delete(self, guild_id: str, user_id: Optional[str]=None):
+        match_data = {'guild_id': guild_id}
+        if user_id:
+            match_data['user_id'] = user_id
+        for bucket_db in self.bucket_dbs_.values():
+            bucket_db.delete_many(match_data)
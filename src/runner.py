@@ -0,0 +1,154 @@
+import time
+import asyncio
+from multiprocessing import Queue
+from typing import Optional, List
+
+import discord
+from . import log as logging
+from .config import Config
+from .db import BaseDB, MongoDB
+from .sqlite_db import SQLiteDB
+from .bot import TrakBot
+from .parser import MessageParser
+from .scheduler import TrackerScheduler
+from .metrics import MetricsServer, registry
+from .checkpoint import save_state, load_state
+
+_log = logging.Logger('Runner')
+
+def create_db(config: Config) -> BaseDB:
+    db = _create_backend_db(config)
+    if config.columnar_dir:
+        # The columnar store is built on numpy, only loaded when it's enabled
+        from .columnar import ColumnarDB
+        return ColumnarDB(db, config.columnar_dir)
+    return db
+
+def _create_backend_db(config: Config) -> BaseDB:
+    if config.db_backend == 'sqlite':
+        return SQLiteDB(sqlite_path=config.sqlite_path, session_break_delay=config.session_break_delay, debug=config.debug,
+                        compact_after_days=config.compact_after_days, archive_dir=config.archive_dir)
+    return MongoDB(mongo_url=config.mongo_url, session_break_delay=config.session_break_delay, debug=config.debug,
+                   session_layout=config.session_layout, use_rollups=config.use_rollups, use_longest_index=config.use_longest_index,
+                   use_heatmaps=config.use_heatmaps, encode_game_names=config.encode_game_names, compact_after_days=config.compact_after_days, archive_dir=config.archive_dir)
+
+def create_client(shard_ids: Optional[List[int]] = None, shard_count: Optional[int] = None) -> discord.Client:
+    if shard_count:
+        return discord.AutoShardedClient(intents=discord.Intents.all(), shard_ids=shard_ids, shard_count=shard_count)
+    return discord.Client(intents=discord.Intents.all())
+
+async def run_bot(config: Config, shard_ids: Optional[List[int]] = None, shard_count: Optional[int] = None,
+                  health_queue: Optional[Queue] = None, worker_id: int = 0, start_time: Optional[float] = None):
+    # start_time is the time.monotonic() the process started at, to measure time to first tick
+    start_time = start_time if start_time is not None else time.monotonic()
+    if config.debug:
+        logging.set_log_level(logging.Level.DEBUG)
+    logging.set_json_format(config.json_logs)
+    db = create_db(config)
+    client = create_client(shard_ids, shard_count)
+    bot = TrakBot(client, db, config.update_time, config.session_break_delay, event_driven=config.event_driven)
+    parser = MessageParser(bot, prefix=config.prefix)
+    tick_func = bot.reconcile_tracker if config.event_driven else bot.update_tracker
+    first_tick_done = False
+
+    async def tick() -> Optional[int]:
+        nonlocal first_tick_done
+        samples_count = await tick_func()
+        if not first_tick_done:
+            first_tick_done = True
+            registry.set('timetrak_time_to_first_tick_seconds', time.monotonic() - start_time)
+            _log.info(f'First tracker tick done {time.monotonic() - start_time:.2f}s after start')
+        return samples_count
+
+    scheduler = TrackerScheduler(config.reconcile_time if config.event_driven else config.update_time, tick)
+    # Every sharded worker tracks its own guilds and keeps its own checkpoint
+    state_path = config.tracker_state_path
+    if state_path and shard_count:
+        state_path = f'{state_path}.{worker_id}'
+    # Restored activities older than one tracker interval can't continue their session
+    state_max_age = (config.reconcile_time if config.event_driven else config.update_time) + config.session_break_delay
+    health_task = None
+    maintenance_task = None
+    checkpoint_task = None
+    # Sharded workers each serve their own metrics on consecutive ports
+    metrics_server = MetricsServer(config.metrics_port + worker_id) if config.metrics_port else None
+
+    @client.event
+    async def on_ready():
+        nonlocal health_task, maintenance_task, checkpoint_task
+        _log.info(f'TimeTrak bot is ready! Shards {shard_ids} of {shard_count}')
+        # on_ready fires again after reconnects, the checkpoint is only restored once
+        if state_path and not checkpoint_task:
+            state = load_state(state_path)
+            if state:
+                bot.restore_tracker_state(state, state_max_age)
+            checkpoint_task = asyncio.create_task(checkpoint_tracker(bot, state_path, config.checkpoint_time))
+        scheduler.start()
+        if health_queue is not None and not health_task:
+            health_task = asyncio.create_task(report_health(client, scheduler, health_queue, worker_id, config.health_time))
+        # Maintenance covers every guild in the db so only the first worker runs it
+        if worker_id == 0 and not maintenance_task:
+            maintenance_task = asyncio.create_task(run_maintenance(bot, config.maintenance_time))
+
+    @client.event
+    async def on_presence_update(before: discord.Member, after: discord.Member):
+        if config.event_driven and not after.bot:
+            await bot.on_presence_update(before, after)
+
+    @client.event
+    async def on_message(message: discord.Message):
+        _log.debug('got message')
+        if message.author == client.user or message.author.bot:
+            return
+        await parser.parse(message)
+
+    async with client:
+        try:
+            if metrics_server:
+                await metrics_server.start()
+            await client.start(config.token)
+        finally:
+            if metrics_server:
+                await metrics_server.stop()
+            if health_task:
+                health_task.cancel()
+            if maintenance_task:
+                maintenance_task.cancel()
+            if checkpoint_task:
+                checkpoint_task.cancel()
+            await scheduler.stop()
+            if checkpoint_task:
+                save_state(state_path, bot.get_tracker_state())
+            bot.close()
+            _log.info('Run stopped')
+
+async def run_maintenance(bot: TrakBot, maintenance_time: float):
+    while True:
+        await asyncio.sleep(maintenance_time)
+        try:
+            await bot.run_maintenance()
+        except Exception as e:
+            _log.error(f'DB maintenance failed: {e!r}')
+
+async def checkpoint_tracker(bot: TrakBot, state_path: str, checkpoint_time: float):
+    while True:
+        await asyncio.sleep(checkpoint_time)
+        try:
+            # The state is copied on the loop, only the write runs on a thread
+            await asyncio.get_running_loop().run_in_executor(None, save_state, state_path, bot.get_tracker_state())
+        except Exception as e:
+            _log.error(f'Tracker checkpoint failed: {e!r}')
+
+async def report_health(client: discord.Client, scheduler: TrackerScheduler, health_queue: Queue, worker_id: int, health_time: float):
+    while True:
+        if isinstance(client, discord.AutoShardedClient):
+            shard_latencies = {shard_id: latency for shard_id, latency in client.latencies}
+        else:
+            shard_latencies = {0: client.latency}
+        health_queue.put({
+            'worker_id': worker_id,
+            'shard_latencies': shard_latencies,
+            'guilds': len(client.guilds),
+            'tracker': scheduler.get_stats(),
+        })
+        await asyncio.sleep(health_time)
@@ -0,0 +1,86 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Optional, Callable, Awaitable, List
+
+from .log import Logger
+from .metrics import registry
+
+_log = Logger('Scheduler')
+
+class TrackerScheduler():
+    # Runs tick_func on the event loop at start + n*interval. A tick that is
+    # due while the previous one is still running is skipped, and slots missed
+    # during a long tick are coalesced into the next aligned one.
+    def __init__(self, interval: float, tick_func: Callable[[], Awaitable[Optional[int]]], max_records: int = 100,
+                 time_func: Callable[[], float] = time.monotonic):
+        self.interval_ = interval
+        self.tick_func_ = tick_func
+        self.time_func_ = time_func
+        self.records_ = deque(maxlen=max_records)
+        self.skipped_ticks_ = 0
+        self.run_task_ = None
+        self.tick_task_ = None
+
+    def is_running(self) -> bool:
+        return self.run_task_ is not None and not self.run_task_.done()
+
+    def start(self):
+        if self.is_running():
+            return
+        self.run_task_ = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 30.0):
+        if self.run_task_:
+            self.run_task_.cancel()
+            await asyncio.gather(self.run_task_, return_exceptions=True)
+            self.run_task_ = None
+        if self.tick_task_ and not self.tick_task_.done():
+            _log.info('Waiting for the running tick to finish')
+            try:
+                await asyncio.wait_for(asyncio.shield(self.tick_task_), timeout)
+            except asyncio.TimeoutError:
+                self.tick_task_.cancel()
+                await asyncio.gather(self.tick_task_, return_exceptions=True)
+
+    async def _run(self):
+        start_time = self.time_func_()
+        tick_index = 0
+        while True:
+            scheduled_time = start_time + tick_index*self.interval_
+            await asyncio.sleep(max(0.0, scheduled_time - self.time_func_()))
+            if self.tick_task_ and not self.tick_task_.done():
+                self.skipped_ticks_ += 1
+                registry.inc('timetrak_tracker_skipped_ticks_total')
+                _log.warning(f'Skipping tick {tick_index}, previous tick is still running')
+            else:
+                self.tick_task_ = asyncio.create_task(self._tick(scheduled_time))
+            elapsed_ticks = math.floor((self.time_func_() - start_time) / self.interval_)
+            tick_index = max(tick_index, elapsed_ticks) + 1
+
+    async def _tick(self, scheduled_time: float):
+        tick_start = self.time_func_()
+        samples_written = None
+        try:
+            samples_written = await self.tick_func_()
+        except Exception as e:
+            _log.error(f'Tracker tick failed: {e!r}')
+        record = {
+            'duration': self.time_func_() - tick_start,
+            'lag': tick_start - scheduled_time,
+            'samples_written': samples_written,
+        }
+        self.records_.append(record)
+        registry.observe('timetrak_tracker_tick_seconds', record['duration'])
+        registry.observe('timetrak_tracker_tick_lag_seconds', record['lag'])
+        if samples_written is not None:
+            registry.set('timetrak_tracker_samples_written', samples_written)
+        _log.info(f'Tick took {record["duration"]:.3f}s, {samples_written} samples written, {record["lag"]:.3f}s behind schedule')
+
+    def get_records(self) -> List[dict]:
+        return list(self.records_)
+
+    def get_stats(self) -> dict:
+        return {'ticks': len(self.records_), 'skipped_ticks': self.skipped_ticks_,
+                'last_tick': self.records_[-1] if self.records_ else None}
@@ -0,0 +1,330 @@
+import time
+import sqlite3
+import threading
+from typing import Optional, List, Dict, Tuple, Set, Iterator
+from datetime import datetime
+
+from .log import Logger
+from .db import BaseDB, IdType, SampleType
+
+_log = Logger('SQLiteDB')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blacklisted_users (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS blacklist_versions (
+    guild_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO blacklist_versions (guild_id, version) SELECT DISTINCT guild_id, 0 FROM blacklisted_users;
+CREATE TABLE IF NOT EXISTS ongoing_sessions (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (guild_id, user_id, name, start_time)
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_summaries (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    day TEXT NOT NULL,
+    duration REAL NOT NULL,
+    session_count INTEGER NOT NULL,
+    longest REAL NOT NULL,
+    PRIMARY KEY (guild_id, user_id, day, name)
+);
+CREATE INDEX IF NOT EXISTS sessions_guild_user_start ON sessions (guild_id, user_id, start_time);
+CREATE INDEX IF NOT EXISTS sessions_guild_start ON sessions (guild_id, start_time);
+CREATE INDEX IF NOT EXISTS sessions_guild_duration ON sessions (guild_id, duration);
+CREATE INDEX IF NOT EXISTS sessions_guild_user_duration ON sessions (guild_id, user_id, duration);
+CREATE INDEX IF NOT EXISTS sessions_guild_name_start ON sessions (guild_id, name, start_time);
+'''
+
+def _to_db_time(time: datetime) -> str:
+    # Stored with millisecond precision like BSON dates so both backends return the same sessions
+    return time.replace(microsecond=time.microsecond // 1000 * 1000).isoformat(sep=' ', timespec='microseconds')
+
+def _from_db_time(time: str) -> datetime:
+    return datetime.fromisoformat(time)
+
+class SQLiteDB(BaseDB):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.path_ = kwargs.get('sqlite_path', 'timetrak.db')
+        self.conn_ = sqlite3.connect(self.path_, check_same_thread=False)
+        self.conn_.row_factory = sqlite3.Row
+        self.lock_ = threading.Lock()
+        with self.lock_:
+            if self.path_ != ':memory:':
+                self.conn_.execute('PRAGMA journal_mode=WAL')
+                self.conn_.execute('PRAGMA synchronous=NORMAL')
+            self.conn_.executescript(_SCHEMA)
+        # Blacklists are cached like in MongoDB, the version of a guild is bumped with every
+        # change so other processes sharing the file are picked up every refresh time
+        self.blacklist_refresh_time_ = kwargs.get('blacklist_refresh_time', 300.0)
+        self.blacklists_ = None
+        self.blacklist_versions_ = dict()
+        self.blacklist_refreshed_at_ = 0.0
+
+    def _query(self, query: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        with self.lock_:
+            self.round_trips_ += 1
+            return self.conn_.execute(query, params).fetchall()
+
+    def _write(self, query: str, params: Tuple = ()):
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            self.conn_.execute(query, params)
+
+    def _get_filter(self, guild_id: IdType, user_id: Optional[IdType], from_time: Optional[datetime], time_column: str='start_time') -> Tuple[str, Tuple]:
+        conditions = ['guild_id = ?']
+        params = [str(guild_id)]
+        if user_id:
+            conditions.append('user_id = ?')
+            params.append(str(user_id))
+        if from_time:
+            conditions.append(f'{time_column} >= ?')
+            params.append(_to_db_time(from_time))
+        return ' AND '.join(conditions), tuple(params)
+
+    def get_guild_ids(self) -> List[str]:
+        rows = self._query('SELECT guild_id FROM ongoing_sessions UNION SELECT guild_id FROM sessions UNION SELECT guild_id FROM daily_summaries')
+        return [row['guild_id'] for row in rows]
+
+    def add_blacklisted_users(self, guild_id: IdType, user_ids: List[IdType]):
+        _log.debug(lambda: f'Adding blacklisted users for {guild_id}: {user_ids}')
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            self.conn_.executemany('INSERT OR IGNORE INTO blacklisted_users (guild_id, user_id) VALUES (?, ?)',
+                                   [(str(guild_id), str(user_id)) for user_id in user_ids])
+            guild_tracker = self._bump_blacklist_version(str(guild_id))
+        self._update_cached_blacklist(guild_tracker)
+
+    def remove_blacklisted_users(self, guild_id: IdType, user_ids: List[IdType]):
+        _log.debug(lambda: f'Removing blacklisted users for {guild_id}: {user_ids}')
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            self.conn_.executemany('DELETE FROM blacklisted_users WHERE guild_id = ? AND user_id = ?',
+                                   [(str(guild_id), str(user_id)) for user_id in user_ids])
+            guild_tracker = self._bump_blacklist_version(str(guild_id))
+        self._update_cached_blacklist(guild_tracker)
+
+    def _bump_blacklist_version(self, guild_id: str) -> dict:
+        # Runs in the transaction of the change, returns the guild's blacklist after it
+        self.conn_.execute('INSERT OR IGNORE INTO blacklist_versions (guild_id, version) VALUES (?, 0)', (guild_id,))
+        self.conn_.execute('UPDATE blacklist_versions SET version = version + 1 WHERE guild_id = ?', (guild_id,))
+        version = self.conn_.execute('SELECT version FROM blacklist_versions WHERE guild_id = ?', (guild_id,)).fetchone()['version']
+        user_ids = [row['user_id'] for row in self.conn_.execute('SELECT user_id FROM blacklisted_users WHERE guild_id = ?', (guild_id,))]
+        return {'guild_id': guild_id, 'blacklisted_users': user_ids, 'version': version}
+
+    def get_blacklisted_users(self, guild_id: IdType) -> List[IdType]:
+        return list(self.get_blacklisted_user_set(guild_id))
+
+    def get_blacklisted_user_set(self, guild_id: IdType) -> Set[str]:
+        if self.blacklists_ is None or time.monotonic() - self.blacklist_refreshed_at_ > self.blacklist_refresh_time_:
+            self.refresh_blacklists()
+        return self.blacklists_.get(str(guild_id), set())
+
+    def refresh_blacklists(self):
+        guild_versions = {row['guild_id']: row['version'] for row in self._query('SELECT guild_id, version FROM blacklist_versions')}
+        if self.blacklists_ is None:
+            self.blacklists_ = dict()
+            changed_guilds = list(guild_versions.keys())
+        else:
+            changed_guilds = [guild_id for guild_id, version in guild_versions.items() if self.blacklist_versions_.get(guild_id) != version]
+            for guild_id in set(self.blacklists_.keys()) - set(guild_versions.keys()):
+                self.blacklists_.pop(guild_id)
+                self.blacklist_versions_.pop(guild_id, None)
+        if changed_guilds:
+            guild_trackers = {guild_id: {'guild_id': guild_id, 'blacklisted_users': [], 'version': guild_versions[guild_id]} for guild_id in changed_guilds}
+            rows = self._query(f'SELECT guild_id, user_id FROM blacklisted_users WHERE guild_id IN ({", ".join("?"*len(changed_guilds))})', tuple(changed_guilds))
+            for row in rows:
+                guild_trackers[row['guild_id']]['blacklisted_users'].append(row['user_id'])
+            for guild_tracker in guild_trackers.values():
+                self._update_cached_blacklist(guild_tracker)
+        self.blacklist_refreshed_at_ = time.monotonic()
+
+    def _update_cached_blacklist(self, guild_tracker: dict):
+        if self.blacklists_ is None:
+            return
+        self.blacklists_[guild_tracker['guild_id']] = set(guild_tracker['blacklisted_users'])
+        self.blacklist_versions_[guild_tracker['guild_id']] = guild_tracker['version']
+
+    def add_user_activities_sample(self, guild_id: IdType, user_id: IdType, activities: List[str], start_time: datetime, end_time: datetime):
+        _log.debug(lambda: f'Adding {guild_id} user {user_id} sample for {activities} from {start_time} to {end_time}')
+        self.add_activities_samples_bulk(guild_id, [(user_id, activities, start_time, end_time)])
+
+    def add_activities_samples_bulk(self, guild_id: IdType, samples: List[SampleType]):
+        _log.debug(lambda: f'Adding {len(samples)} samples for {guild_id}')
+        if self.debug_ or not samples:
+            return
+        guild_id = str(guild_id)
+        user_to_samples = dict()
+        for user_id, activities, start_time, end_time in samples:
+            user_to_samples.setdefault(str(user_id), []).append((activities, start_time, end_time))
+
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            user_ids = list(user_to_samples.keys())
+            user_to_ongoing_sessions = dict()
+            # Stay below SQLite's bound parameter limit
+            for index in range(0, len(user_ids), 500):
+                user_id_batch = user_ids[index:index+500]
+                rows = self.conn_.execute(
+                    f'SELECT user_id, name, start_time, duration FROM ongoing_sessions WHERE guild_id = ? AND user_id IN ({",".join("?"*len(user_id_batch))})',
+                    (guild_id, *user_id_batch)).fetchall()
+                for row in rows:
+                    user_to_ongoing_sessions.setdefault(row['user_id'], []).append(
+                        {'name': row['name'], 'start_time': _from_db_time(row['start_time']), 'duration': row['duration']})
+
+            increments, closed_stored, closed, opened = [], [], [], []
+            for user_id, user_samples in user_to_samples.items():
+                changes = self._get_user_session_changes(user_to_ongoing_sessions.get(user_id, []), user_samples)
+                increments.extend((duration, guild_id, user_id, session['name'], _to_db_time(session['start_time']))
+                                  for session, duration in changes['incremented'])
+                closed_stored.extend((guild_id, user_id, session['name'], _to_db_time(session['start_time']))
+                                     for session in changes['closed_stored'])
+                closed.extend((guild_id, user_id, session['name'], _to_db_time(session['start_time']), session['duration'])
+                              for session in changes['closed'])
+                opened.extend((guild_id, user_id, session['name'], _to_db_time(session['start_time']), session['duration'])
+                              for session in changes['opened'])
+            self.conn_.executemany('UPDATE ongoing_sessions SET duration = duration + ? WHERE guild_id = ? AND user_id = ? AND name = ? AND start_time = ?', increments)
+            self.conn_.executemany('DELETE FROM ongoing_sessions WHERE guild_id = ? AND user_id = ? AND name = ? AND start_time = ?', closed_stored)
+            self.conn_.executemany('INSERT INTO sessions (guild_id, user_id, name, start_time, duration) VALUES (?, ?, ?, ?, ?)', closed)
+            self.conn_.executemany('INSERT OR REPLACE INTO ongoing_sessions (guild_id, user_id, name, start_time, duration) VALUES (?, ?, ?, ?, ?)', opened)
+
+    def get_last_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Dict[str, float]:
+        where, params = self._get_filter(guild_id, user_id, from_time)
+        rows = self._query(f'SELECT name, SUM(duration) AS duration FROM ongoing_sessions WHERE {where} GROUP BY name', params)
+        return {row['name']: row['duration'] for row in rows}
+
+    def get_aggregated_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> Dict[str, float]:
+        where, params = self._get_filter(guild_id, user_id, from_time)
+        summary_where, summary_params = self._get_filter(guild_id, user_id, from_time, time_column='day')
+        rows = self._query(f'''SELECT name, SUM(duration) AS duration FROM (
+            SELECT name, duration FROM sessions WHERE {where}
+            UNION ALL
+            SELECT name, duration FROM ongoing_sessions WHERE {where}
+            UNION ALL
+            SELECT name, duration FROM daily_summaries WHERE {summary_where}
+            ) GROUP BY name''', params*2 + summary_params)
+        return {row['name']: row['duration'] for row in rows}
+
+    def get_longest_activities(self, guild_id: IdType, user_id: Optional[IdType]=None, from_time: Optional[datetime]=None) -> List[dict]:
+        where, params = self._get_filter(guild_id, user_id, from_time)
+        rows = self._query(f'''SELECT name, duration, start_time, user_id FROM (
+            SELECT name, duration, start_time, user_id FROM sessions WHERE {where}
+            UNION ALL
+            SELECT name, duration, start_time, user_id FROM ongoing_sessions WHERE {where}
+            ) ORDER BY duration DESC LIMIT 15''', params*2)
+        return [{'name': row['name'], 'duration': row['duration'], 'start_time': _from_db_time(row['start_time']), 'user_id': row['user_id']}
+                for row in rows]
+
+    def get_user_leaderboard(self, guild_id: IdType, game: Optional[str]=None, from_time: Optional[datetime]=None, limit: int=10) -> List[dict]:
+        where, params = self._get_filter(guild_id, None, from_time)
+        summary_where, summary_params = self._get_filter(guild_id, None, from_time, time_column='day')
+        if game:
+            where, params = where + ' AND name = ?', params + (game,)
+            summary_where, summary_params = summary_where + ' AND name = ?', summary_params + (game,)
+        rows = self._query(f'''SELECT user_id, SUM(duration) AS duration FROM (
+            SELECT user_id, duration FROM sessions WHERE {where}
+            UNION ALL
+            SELECT user_id, duration FROM ongoing_sessions WHERE {where}
+            UNION ALL
+            SELECT user_id, duration FROM daily_summaries WHERE {summary_where}
+            ) GROUP BY user_id ORDER BY duration DESC LIMIT ?''', params*2 + summary_params + (limit,))
+        return [{'user_id': row['user_id'], 'duration': row['duration']} for row in rows]
+
+    def get_raw_sessions_data(self, guild_id: IdType, user_id: Optional[IdType]=None) -> List[dict]:
+        where, params = self._get_filter(guild_id, user_id, None)
+        rows = self._query(f'''SELECT name, start_time, duration FROM ongoing_sessions WHERE {where}
+            UNION ALL
+            SELECT name, start_time, duration FROM sessions WHERE {where}''', params*2)
+        return [{'name': row['name'], 'start_time': _from_db_time(row['start_time']), 'duration': row['duration']} for row in rows]
+
+    def _get_closed_sessions_before(self, guild_id: IdType, before_time: datetime) -> List[dict]:
+        rows = self._query('SELECT id, user_id, name, start_time, duration FROM sessions WHERE guild_id = ? AND start_time < ?',
+                           (str(guild_id), _to_db_time(before_time)))
+        return [{'id': row['id'], 'user_id': row['user_id'], 'name': row['name'], 'start_time': _from_db_time(row['start_time']), 'duration': row['duration']}
+                for row in rows]
+
+    def _replace_sessions_with_summaries(self, guild_id: IdType, sessions: List[dict], summaries: List[dict]):
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            self.conn_.executemany('''INSERT INTO daily_summaries (guild_id, user_id, name, day, duration, session_count, longest) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (guild_id, user_id, day, name) DO UPDATE SET duration = duration + excluded.duration,
+                session_count = session_count + excluded.session_count, longest = MAX(longest, excluded.longest)''',
+                [(str(guild_id), summary['user_id'], summary['name'], _to_db_time(summary['day']), summary['duration'], summary['session_count'], summary['longest'])
+                 for summary in summaries])
+            self.conn_.executemany('DELETE FROM sessions WHERE id = ?', [(session['id'],) for session in sessions])
+
+    def iter_sessions(self, guild_id: IdType, user_id: Optional[IdType]=None, batch_size: int=1000, include_user_id: bool=False) -> Iterator[List[dict]]:
+        # Pages through sessions by id so the lock is only held for one batch at a time
+        where, params = self._get_filter(guild_id, user_id, None)
+        to_session = lambda row: dict({'name': row['name'], 'start_time': _from_db_time(row['start_time']), 'duration': row['duration']},
+                                      **({'user_id': row['user_id']} if include_user_id else {}))
+        ongoing_rows = self._query(f'SELECT user_id, name, start_time, duration FROM ongoing_sessions WHERE {where}', params)
+        for index in range(0, len(ongoing_rows), batch_size):
+            yield [to_session(row) for row in ongoing_rows[index:index+batch_size]]
+        last_id = -1
+        while True:
+            rows = self._query(f'SELECT id, user_id, name, start_time, duration FROM sessions WHERE {where} AND id > ? ORDER BY id LIMIT ?',
+                               params + (last_id, batch_size))
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            yield [to_session(row) for row in rows]
+
+    def iter_summaries(self, guild_id: IdType, batch_size: int=1000) -> Iterator[List[dict]]:
+        last_id = -1
+        while True:
+            rows = self._query('SELECT rowid, user_id, name, day, duration FROM daily_summaries WHERE guild_id = ? AND rowid > ? ORDER BY rowid LIMIT ?',
+                               (str(guild_id), last_id, batch_size))
+            if not rows:
+                return
+            last_id = rows[-1]['rowid']
+            yield [{'user_id': row['user_id'], 'name': row['name'], 'day': _from_db_time(row['day']), 'duration': row['duration']} for row in rows]
+
+    def reset_guild_data(self, guild_id: IdType):
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            self.conn_.execute('DELETE FROM ongoing_sessions WHERE guild_id = ?', (str(guild_id),))
+            self.conn_.execute('DELETE FROM sessions WHERE guild_id = ?', (str(guild_id),))
+            self.conn_.execute('DELETE FROM daily_summaries WHERE guild_id = ?', (str(guild_id),))
+
+    def delete_guild_data(self, guild_id: IdType):
+        self.reset_guild_data(guild_id)
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            self.conn_.execute('DELETE FROM blacklisted_users WHERE guild_id = ?', (str(guild_id),))
+            self.conn_.execute('DELETE FROM blacklist_versions WHERE guild_id = ?', (str(guild_id),))
+        if self.blacklists_ is not None:
+            self.blacklists_.pop(str(guild_id), None)
+            self.blacklist_versions_.pop(str(guild_id), None)
+
+    def reset_user_data(self, guild_id: IdType, user_id: IdType):
+        with self.lock_, self.conn_:
+            self.round_trips_ += 1
+            self.conn_.execute('DELETE FROM ongoing_sessions WHERE guild_id = ? AND user_id = ?', (str(guild_id), str(user_id)))
+            self.conn_.execute('DELETE FROM sessions WHERE guild_id = ? AND user_id = ?', (str(guild_id), str(user_id)))
+            self.conn_.execute('DELETE FROM daily_summaries WHERE guild_id = ? AND user_id = ?', (str(guild_id), str(user_id)))
+
+    def delete_user_data(self, guild_id: IdType, user_id: IdType):
+        self.reset_user_data(guild_id, user_id)
+        self.remove_blacklisted_users(guild_id, [user_id])
+
+    def close(self):
+        self.conn_.close()
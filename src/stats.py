@@ -1,53 +1,62 @@
-from typing import Optional
-from datetime import datetime, timedelta
-import math
-import numpy as np
-import matplotlib.pyplot as plt
+from typing import Optional, TYPE_CHECKING
+from datetime import datetime
+from io import BytesIO
 
 from .log import Logger
 from .db import BaseDB, IdType
+from .binning import DAYS_IN_WEEK, BINS_IN_DAY, WEEK, bin_sessions_weekly, get_session_arrays, get_heatmap_week_start
+
+if TYPE_CHECKING:
+    import numpy as np
 
 _log = Logger('Stats')
 
+def create_heatmap_figure(weights: 'np.ndarray'):
+    # Imported here so only the render workers pay for loading matplotlib
+    import numpy as np
+    from matplotlib.figure import Figure
+    figure = Figure()
+    axes = figure.subplots()
+    mesh = axes.pcolormesh(np.arange(0.5, DAYS_IN_WEEK+1, 1), np.arange(BINS_IN_DAY+1), weights.T/60, cmap='Blues')
+    # Labels are set separately, set_xticks only takes them from matplotlib 3.5
+    axes.set_xticks(list(range(1, 8)))
+    axes.set_xticklabels(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
+    axes.set_yticks(list(range(0, 24*2+1, 2)))
+    axes.set_yticklabels(list(range(25)))
+    axes.set_xlim(0.5, 7.5)
+    axes.set_ylabel('Hour')
+    axes.set_xlabel('Weekday')
+    cb = figure.colorbar(mesh)
+    cb.set_label('Minutes of playtime')
+    return figure
+
+def render_heatmap_png(weights: 'np.ndarray') -> bytes:
+    figure = create_heatmap_figure(weights)
+    buffer = BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
 class StatsGenerator():
     def __init__(self, db: BaseDB):
         self.db_ = db
 
+    def get_session_heatmap(self, guild_id: IdType, user_id: Optional[IdType] = None, weeks: Optional[int] = None, batch_size: int = 10000) -> 'np.ndarray':
+        import numpy as np
+        # weeks limits the heatmap to the current and the weeks-1 heatmap weeks before it
+        from_time = get_heatmap_week_start(datetime.now()) - (weeks - 1)*WEEK if weeks else None
+        weights = self.db_.get_heatmap(guild_id, user_id, from_time)
+        if weights is None:
+            weights = np.zeros((DAYS_IN_WEEK, BINS_IN_DAY), dtype=np.float64)
+            for sessions_data in self.db_.iter_sessions(guild_id, user_id, batch_size=batch_size):
+                if from_time:
+                    sessions_data = [session for session in sessions_data if session['start_time'] >= from_time]
+                weights += bin_sessions_weekly(*get_session_arrays(sessions_data))
+        _log.debug('Heatmap weights', lambda: weights)
+        return weights
+
     def plot_session_heatmap(self, guild_id: IdType, user_id: Optional[IdType] = None, file_name: str = 'plot.png'):
-        sessions_data = self.db_.get_raw_sessions_data(guild_id, user_id)
-        # sessions_data = [{'start_time': datetime(2020, 1, 1, 0, 0, 0, 0), 'duration': 3600*14}]
-        data_samples = []
-        for session in sessions_data:
-            start_timestamp = session['start_time'] + timedelta(hours=5, minutes=30)
-            duration_left = session['duration']
-            while duration_left > 0:
-                next_timestamp = start_timestamp.replace(second=math.floor(
-                    start_timestamp.second/1800)*1800, microsecond=0) + timedelta(seconds=1800)
-                iter_duration = min(
-                    duration_left, (next_timestamp - start_timestamp).total_seconds())
-                data_samples.append((
-                    start_timestamp.isoweekday(),
-                    start_timestamp.hour*2 + math.floor(start_timestamp.minute/30),
-                    iter_duration))
-                duration_left -= iter_duration
-                start_timestamp = next_timestamp
-        xx_weekday = [sample[0] for sample in data_samples]
-        yy_hours = [sample[1] for sample in data_samples]
-        weights = [sample[2]/60 for sample in data_samples]
-        _log.debug('Plotting ', data_samples)
-        plt.clf()
-        plt.hist2d(xx_weekday, yy_hours, bins=[
-                   np.arange(-0.5, 8, 1), np.arange(24*2+1)], weights=weights, cmap='Blues')
-        plt.xticks(list(range(1, 8)), [
-                   'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
-        plt.yticks(list(range(0, 24*2+1, 2)), list(range(25)))
-        plt.xlim(0.5, 7.5)
-        plt.ylabel('Hour')
-        plt.xlabel('Weekday')
-        cb = plt.colorbar()
-        cb.set_label('Minutes of playtime')
-        plt.savefig(file_name)
-        pass
+        with open(file_name, 'wb') as plot_file:
+            plot_file.write(render_heatmap_png(self.get_session_heatmap(guild_id, user_id)))
 
 if __name__ == '__main__':
     import os
@@ -0,0 +1,107 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from io import BytesIO
+from unittest import mock
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+import discord
+from src.bot import TrakBot
+from src.sqlite_db import SQLiteDB
+from src.metrics import registry
+
+TEST_GUILD = 1
+TEST_USER = 2
+
+def create_member(activity_names):
+    return SimpleNamespace(id=TEST_USER, guild=SimpleNamespace(id=TEST_GUILD), bot=False,
+                           activities=[SimpleNamespace(type=discord.ActivityType.playing, name=activity_name) for activity_name in activity_names])
+
+class TestEventTracking(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db_ = SQLiteDB(sqlite_path=':memory:')
+        self.bot_ = TrakBot(None, self.db_, 60, event_driven=True)
+        self.bot_.guild_to_tracked_users_ = {str(TEST_GUILD): {str(TEST_USER)}}
+        # Both games have been played for 20 minutes and were last flushed 20 minutes ago
+        self.flushed_time_ = datetime.now() - timedelta(minutes=20)
+        start_time = self.flushed_time_ - timedelta(minutes=20)
+        self.db_.add_activities_samples_bulk(TEST_GUILD, [(TEST_USER, ['activity1', 'activity2'], start_time, self.flushed_time_)])
+        self.bot_.guild_user_to_current_activities_ = {str(TEST_GUILD): {str(TEST_USER): {'activity1': self.flushed_time_, 'activity2': self.flushed_time_}}}
+
+    async def asyncTearDown(self):
+        self.bot_.close()
+
+    def get_sessions(self):
+        return sorted((session['name'], round(session['duration'] / 60)) for session in self.db_.get_raw_sessions_data(TEST_GUILD, TEST_USER))
+
+    async def test_stop_keeps_other_sessions(self):
+        await self.bot_.on_presence_update(create_member(['activity1', 'activity2']), create_member(['activity1']))
+        self.assertEqual(self.get_sessions(), [('activity1', 40), ('activity2', 40)], "Stopping one game split the other session.")
+        self.assertEqual(self.bot_.guild_user_to_current_activities_[str(TEST_GUILD)][str(TEST_USER)].keys(), {'activity1'}, "Stopped game still tracked.")
+        await self.bot_.on_presence_update(create_member(['activity1']), create_member([]))
+        self.assertEqual(self.get_sessions(), [('activity1', 40), ('activity2', 40)], "Stopping the last game split its session.")
+
+    async def test_start_keeps_other_sessions(self):
+        await self.bot_.on_presence_update(create_member(['activity1', 'activity2']), create_member(['activity1', 'activity2', 'activity3']))
+        await self.bot_.on_presence_update(create_member(['activity1', 'activity2', 'activity3']), create_member([]))
+        sessions = self.get_sessions()
+        self.assertEqual(sessions[:2], [('activity1', 40), ('activity2', 40)], "Starting a game split the other sessions.")
+        self.assertEqual(sessions[2][0], 'activity3', "Started game not written.")
+
+    async def test_concurrent_updates(self):
+        await asyncio.gather(
+            self.bot_.on_presence_update(create_member(['activity1', 'activity2']), create_member(['activity1'])),
+            self.bot_.on_presence_update(create_member(['activity1']), create_member([])))
+        self.assertEqual(self.get_sessions(), [('activity1', 40), ('activity2', 40)], "Concurrent updates split a session.")
+        self.assertFalse(self.bot_.guild_user_to_current_activities_[str(TEST_GUILD)][str(TEST_USER)], "Stopped games still tracked.")
+
+def get_db_call_count(method):
+    return registry.get_histogram_summary().get('timetrak_db_call_seconds', dict()).get((('method', method),), dict()).get('count', 0)
+
+class TestDBCallMetrics(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db_ = SQLiteDB(sqlite_path=':memory:')
+        self.bot_ = TrakBot(None, self.db_, 60)
+        start_time = datetime.now() - timedelta(hours=1)
+        self.db_.add_activities_samples_bulk(TEST_GUILD, [(TEST_USER, ['activity1'], start_time, start_time + timedelta(minutes=20))])
+
+    async def asyncTearDown(self):
+        self.bot_.close()
+
+    async def test_heatmap_and_export_timed(self):
+        heatmap_calls = get_db_call_count('get_session_heatmap')
+        async def render_heatmap(weights):
+            return BytesIO(weights.tobytes())
+        with mock.patch.object(self.bot_.renderer_, 'render_heatmap', render_heatmap):
+            await self.bot_.plot_session_weekly_heatmap(TEST_GUILD, TEST_USER)
+        self.assertEqual(get_db_call_count('get_session_heatmap'), heatmap_calls + 1, "Heatmap query not timed.")
+        export_calls = get_db_call_count('export_sessions')
+        with tempfile.TemporaryDirectory() as export_dir:
+            self.assertEqual(await self.bot_.export_guild_sessions(TEST_GUILD, os.path.join(export_dir, 'sessions.ndjson.gz')), 1, "Wrong number of sessions exported.")
+        self.assertEqual(get_db_call_count('export_sessions'), export_calls + 1, "Export not timed.")
+
+class TestTrackerTick(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db_ = SQLiteDB(sqlite_path=':memory:')
+        self.db_.add_blacklisted_users(TEST_GUILD, [TEST_USER])
+        members = [SimpleNamespace(id=member_id, bot=False, activities=[SimpleNamespace(type=discord.ActivityType.playing, name='activity1')])
+                   for member_id in range(TEST_USER, TEST_USER+5)]
+        guilds = [SimpleNamespace(id=guild_id, name=f'guild{guild_id}', members=members, get_member=lambda member_id: members[member_id-TEST_USER])
+                  for guild_id in [TEST_GUILD, TEST_GUILD+1]]
+        self.bot_ = TrakBot(SimpleNamespace(guilds=guilds), self.db_, 60)
+
+    async def asyncTearDown(self):
+        self.bot_.close()
+
+    async def test_tick_round_trips(self):
+        await self.bot_.update_tracker()
+        round_trips_start = self.db_.get_round_trip_count()
+        self.assertEqual(await self.bot_.update_tracker(), 9, "Wrong number of samples written.")
+        # One bulk write per guild, the blacklists are read from the cache
+        self.assertEqual(self.db_.get_round_trip_count() - round_trips_start, 2, "Tick made more db round trips than one write per guild.")
+        self.assertNotIn(str(TEST_USER), self.bot_.guild_to_tracked_users_[str(TEST_GUILD)], "Blacklisted user tracked.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from datetime import datetime
+
+from src.cache import QueryCache
+
+class FakeClock():
+    def __init__(self):
+        self.now_ = 0.0
+    def __call__(self):
+        return self.now_
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.clock_ = FakeClock()
+        self.cache_ = QueryCache(max_size=3, ttl=60.0, time_func=self.clock_)
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.cache_.get(('guild', 'user', 'aggregated', None)), (False, None), "Empty cache returned a value.")
+        self.cache_.put(('guild', 'user', 'aggregated', None), {'activity1': 60})
+        self.assertEqual(self.cache_.get(('guild', 'user', 'aggregated', None)), (True, {'activity1': 60}), "Cached value not returned.")
+        self.assertEqual(self.cache_.get_stats(), {'hits': 1, 'misses': 1, 'size': 1}, "Hit and miss counters incorrect.")
+
+    def test_ttl_expiry(self):
+        self.cache_.put(('guild', None, 'aggregated', None), {})
+        self.clock_.now_ = 61.0
+        self.assertFalse(self.cache_.get(('guild', None, 'aggregated', None))[0], "Expired entry returned.")
+
+    def test_lru_eviction(self):
+        for user_id in ['user1', 'user2', 'user3']:
+            self.cache_.put(('guild', user_id, 'aggregated', None), user_id)
+        self.cache_.get(('guild', 'user1', 'aggregated', None))
+        self.cache_.put(('guild', 'user4', 'aggregated', None), 'user4')
+        self.assertTrue(self.cache_.get(('guild', 'user1', 'aggregated', None))[0], "Recently used entry evicted.")
+        self.assertFalse(self.cache_.get(('guild', 'user2', 'aggregated', None))[0], "Least recently used entry not evicted.")
+
+    def test_invalidation(self):
+        self.cache_.put(('guild', 'user1', 'aggregated', None), 1)
+        self.cache_.put(('guild', 'user2', 'aggregated', None), 2)
+        self.cache_.put(('guild', None, 'aggregated', None), 3)
+        self.cache_.invalidate('guild', ['user1'])
+        self.assertFalse(self.cache_.get(('guild', 'user1', 'aggregated', None))[0], "User entry not invalidated.")
+        self.assertFalse(self.cache_.get(('guild', None, 'aggregated', None))[0], "Guild entry not invalidated on user write.")
+        self.assertTrue(self.cache_.get(('guild', 'user2', 'aggregated', None))[0], "Other user's entry invalidated.")
+        self.cache_.invalidate('guild')
+        self.assertFalse(self.cache_.get(('guild', 'user2', 'aggregated', None))[0], "Guild invalidation missed an entry.")
+
+    def test_stale_put_skipped(self):
+        generation = self.cache_.get_generation('guild')
+        self.cache_.invalidate('guild', ['user2'])
+        self.cache_.put(('guild', 'user1', 'aggregated', None), 1, generation)
+        self.assertFalse(self.cache_.get(('guild', 'user1', 'aggregated', None))[0], "Result computed before a write cached.")
+        self.cache_.put(('guild', 'user1', 'aggregated', None), 1, self.cache_.get_generation('guild'))
+        self.assertTrue(self.cache_.get(('guild', 'user1', 'aggregated', None))[0], "Result of an unchanged guild not cached.")
+
+    def test_window_bucketing(self):
+        first_time = datetime(2021, 1, 1, 10, 0, 5)
+        second_time = datetime(2021, 1, 1, 10, 0, 55)
+        self.assertEqual(self.cache_.bucket_time(first_time), self.cache_.bucket_time(second_time), "Close windows not bucketed together.")
+        self.assertIsNone(self.cache_.bucket_time(None), "Full window bucketed.")
+
+if __name__ == '__main__':
+    unittest.main()
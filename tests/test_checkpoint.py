@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from src.bot import TrakBot
+from src.sqlite_db import SQLiteDB
+from src.checkpoint import save_state, load_state
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.state_dir_ = tempfile.TemporaryDirectory()
+        self.addCleanup(self.state_dir_.cleanup)
+        self.state_path_ = os.path.join(self.state_dir_.name, 'tracker_state.json')
+
+    def create_bot(self, event_driven: bool = False) -> TrakBot:
+        bot = TrakBot(None, SQLiteDB(sqlite_path=':memory:'), 60, event_driven=event_driven)
+        self.addCleanup(bot.close)
+        return bot
+
+    def test_state_round_trip(self):
+        bot = self.create_bot()
+        recent_time = datetime.now() - timedelta(seconds=30)
+        old_time = datetime.now() - timedelta(hours=1)
+        bot.guild_user_to_current_activities_ = {'guild1': {'user1': {'activity1': recent_time, 'activity2': old_time}, 'user2': {}}}
+        save_state(self.state_path_, bot.get_tracker_state())
+
+        restored_bot = self.create_bot()
+        self.assertEqual(restored_bot.restore_tracker_state(load_state(self.state_path_), 70), 1, "Wrong number of activities restored.")
+        self.assertEqual(restored_bot.guild_user_to_current_activities_, {'guild1': {'user1': {'activity1': recent_time}}}, "Restored activities incorrect.")
+
+    def test_other_mode_not_restored(self):
+        bot = self.create_bot()
+        bot.guild_user_to_current_activities_ = {'guild1': {'user1': {'activity1': datetime.now()}}}
+        save_state(self.state_path_, bot.get_tracker_state())
+        event_bot = self.create_bot(event_driven=True)
+        self.assertEqual(event_bot.restore_tracker_state(load_state(self.state_path_), 70), 0, "Restored a checkpoint of the other mode.")
+        self.assertFalse(event_bot.guild_user_to_current_activities_, "Restored a checkpoint of the other mode.")
+
+    def test_unreadable_state(self):
+        self.assertIsNone(load_state(self.state_path_), "Missing checkpoint not ignored.")
+        with open(self.state_path_, 'w') as state_file:
+            state_file.write('{"activities": ')
+        self.assertIsNone(load_state(self.state_path_), "Partial checkpoint not ignored.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+import numpy as np
+
+from src.sqlite_db import SQLiteDB
+from src.columnar import ColumnarDB, GuildColumns, LOG_DTYPE
+from src.binning import bin_sessions_weekly, get_session_arrays, get_heatmap_week_start
+from tests.test_db import DBScenarios
+
+class TestColumnarDB(DBScenarios, unittest.TestCase):
+    def create_db(self):
+        self.columnar_dir_ = tempfile.TemporaryDirectory()
+        self.addCleanup(self.columnar_dir_.cleanup)
+        db = ColumnarDB(SQLiteDB(sqlite_path=':memory:'), self.columnar_dir_.name)
+        self.addCleanup(db.close)
+        return db
+
+    def test_heatmap_matches_sessions(self):
+        first_activity_starttime = datetime.now() - timedelta(days=20)
+        for index in range(30):
+            session_starttime = first_activity_starttime + timedelta(hours=15*index, minutes=7*index)
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, f'user{index%3}', ['activity1', 'activity2'][:index%2+1], session_starttime, session_starttime+timedelta(minutes=20+index))
+        # SQLite keeps start times to the millisecond, the store to the microsecond
+        for user_id in [None, 'user1']:
+            streamed_weights = bin_sessions_weekly(*get_session_arrays(self.mg_.get_raw_sessions_data(self.TEST_GUILD, user_id)))
+            self.assertTrue(np.allclose(self.mg_.get_heatmap(self.TEST_GUILD, user_id), streamed_weights, atol=1e-2), "Columnar heatmap differs from sessions.")
+        week_start = get_heatmap_week_start(datetime.now())
+        recent_sessions = [session for session in self.mg_.get_raw_sessions_data(self.TEST_GUILD) if session['start_time'] >= week_start]
+        self.assertTrue(np.allclose(self.mg_.get_heatmap(self.TEST_GUILD, None, week_start), bin_sessions_weekly(*get_session_arrays(recent_sessions)), atol=1e-2),
+                        "Weekly heatmap differs from this week's sessions.")
+
+    def add_db_sessions(self):
+        first_activity_starttime = datetime.now() - timedelta(days=3)
+        for index in range(6):
+            session_starttime = first_activity_starttime + timedelta(hours=index)
+            self.mg_.db_.add_user_activities_sample(self.TEST_GUILD, f'user{index%2}', [f'activity{index%3}'], session_starttime, session_starttime+timedelta(seconds=60*(index+1)))
+
+    def test_fills_from_db(self):
+        self.add_db_sessions()
+        self.assertEqual(self.mg_.get_aggregated_activities(self.TEST_GUILD), self.mg_.db_.get_aggregated_activities(self.TEST_GUILD), "Filled store differs from db.")
+        self.assertEqual(self.mg_.get_aggregated_activities(self.TEST_GUILD, 'user1'), self.mg_.db_.get_aggregated_activities(self.TEST_GUILD, 'user1'), "Filled store differs from db.")
+
+    def test_concurrent_first_queries(self):
+        self.add_db_sessions()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.mg_.get_aggregated_activities(self.TEST_GUILD))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = self.mg_.db_.get_aggregated_activities(self.TEST_GUILD)
+        self.assertEqual(results, [expected]*4, "Concurrent first queries filled the store more than once.")
+
+    def test_partial_fill_redone(self):
+        self.add_db_sessions()
+        # A fill cut short by a crash leaves a guild directory without the complete marker
+        partial_guild = GuildColumns(os.path.join(self.columnar_dir_.name, self.TEST_GUILD), 10.0)
+        partial_guild.add_sessions(self.mg_.db_.get_longest_activities(self.TEST_GUILD)[:2])
+        partial_guild.snapshot()
+        partial_guild.close()
+        self.assertEqual(self.mg_.get_aggregated_activities(self.TEST_GUILD), self.mg_.db_.get_aggregated_activities(self.TEST_GUILD), "Partial fill not redone.")
+
+    def test_fills_compacted_guild(self):
+        self.add_db_sessions()
+        with tempfile.TemporaryDirectory() as archive_dir:
+            self.assertEqual(self.mg_.db_.compact_sessions(self.TEST_GUILD, datetime.now(), keep_longest=1, archive_dir=archive_dir), 2, "Wrong sessions compacted.")
+        for from_time in [None, datetime.now() - timedelta(days=10), datetime.now()]:
+            self.assertEqual(self.mg_.get_aggregated_activities(self.TEST_GUILD, None, from_time), self.mg_.db_.get_aggregated_activities(self.TEST_GUILD, None, from_time),
+                             "Compacted guild filled without its summaries.")
+            self.assertEqual(self.mg_.get_user_leaderboard(self.TEST_GUILD, 'activity1', from_time), self.mg_.db_.get_user_leaderboard(self.TEST_GUILD, 'activity1', from_time),
+                             "Leaderboard of a compacted guild differs from db.")
+        self.assertEqual(self.mg_.get_longest_activities(self.TEST_GUILD), self.mg_.db_.get_longest_activities(self.TEST_GUILD), "Summaries counted as sessions.")
+        raw_duration = sum(session['duration'] for session in self.mg_.db_.get_raw_sessions_data(self.TEST_GUILD))
+        self.assertAlmostEqual(self.mg_.get_heatmap(self.TEST_GUILD).sum(), raw_duration, msg="Summaries binned into the heatmap.")
+        self.mg_.delete_user_data(self.TEST_GUILD, 'user1')
+        self.assertEqual(self.mg_.get_aggregated_activities(self.TEST_GUILD), self.mg_.db_.get_aggregated_activities(self.TEST_GUILD), "Deleted user's summaries still counted.")
+
+class TestGuildColumns(unittest.TestCase):
+    def setUp(self):
+        self.guild_dir_ = tempfile.TemporaryDirectory()
+        self.addCleanup(self.guild_dir_.cleanup)
+        self.start_time_ = datetime(2024, 3, 4, 20, 0)
+
+    def add_samples(self, columns: GuildColumns):
+        for index in range(10):
+            sample_starttime = self.start_time_ + timedelta(minutes=index)
+            columns.add_samples([('user1', ['activity1'], sample_starttime, sample_starttime+timedelta(minutes=1)),
+                                 ('user2', ['activity1', 'activity2'], sample_starttime, sample_starttime+timedelta(minutes=1))])
+        later_starttime = self.start_time_ + timedelta(hours=2)
+        columns.add_samples([('user1', ['activity1'], later_starttime, later_starttime+timedelta(minutes=5))])
+
+    def test_samples_make_sessions(self):
+        columns = GuildColumns(self.guild_dir_.name, 10.0)
+        self.add_samples(columns)
+        self.assertEqual(columns.get_size(), 4, "Continuous samples not merged into sessions.")
+        self.assertEqual(columns.get_aggregated_activities(None, None), {'activity1': 25*60.0, 'activity2': 10*60.0}, "Aggregated play time incorrect.")
+        self.assertEqual(columns.get_aggregated_activities('user1', self.start_time_ + timedelta(hours=1)), {'activity1': 5*60.0}, "From time filter failed.")
+        self.assertEqual(columns.get_aggregated_activities('user3', None), {}, "Unknown user has play time.")
+        longest = columns.get_longest_activities(None, None, 2)
+        self.assertEqual([(session['duration'], session['start_time']) for session in longest], [(600.0, self.start_time_)]*2, "Longest sessions incorrect.")
+        columns.close()
+
+    def test_reload_from_snapshot_and_log(self):
+        columns = GuildColumns(self.guild_dir_.name, 10.0)
+        self.add_samples(columns)
+        columns.snapshot()
+        self.assertEqual((len(columns.base_), columns.size_), (4, 0), "Snapshot rows not moved to the mapped snapshot.")
+        # Continues the last session and adds one more after the snapshot
+        continued_starttime = self.start_time_ + timedelta(hours=2, minutes=5)
+        columns.add_samples([('user1', ['activity1'], continued_starttime, continued_starttime+timedelta(minutes=1)),
+                             ('user3', ['activity3'], continued_starttime, continued_starttime+timedelta(minutes=2))])
+        expected = columns.get_aggregated_activities(None, None)
+        columns.close()
+        log_path = os.path.join(self.guild_dir_.name, 'sessions.log')
+        self.assertEqual(os.path.getsize(log_path), 2*LOG_DTYPE.itemsize, "Snapshot didn't restart the log.")
+        # A record cut short by a crash is dropped on reload
+        with open(log_path, 'ab') as log_file:
+            log_file.write(b'\0'*7)
+
+        reloaded = GuildColumns(self.guild_dir_.name, 10.0)
+        self.assertEqual(reloaded.get_size(), 5, "Reload lost sessions.")
+        self.assertEqual(reloaded.get_aggregated_activities(None, None), expected, "Reloaded play time differs.")
+        resumed_starttime = continued_starttime + timedelta(minutes=1)
+        reloaded.add_samples([('user1', ['activity1'], resumed_starttime, resumed_starttime+timedelta(minutes=1))])
+        self.assertEqual(reloaded.get_size(), 5, "Open session not continued after reload.")
+        reloaded.close()
+
+    def test_delete_user(self):
+        columns = GuildColumns(self.guild_dir_.name, 10.0)
+        self.add_samples(columns)
+        columns.delete_user('user2')
+        self.assertEqual(columns.get_aggregated_activities(None, None), {'activity1': 15*60.0}, "Deleted user still counted.")
+        columns.close()
+        reloaded = GuildColumns(self.guild_dir_.name, 10.0)
+        self.assertEqual(reloaded.get_aggregated_activities(None, None), {'activity1': 15*60.0}, "Deleted user back after reload.")
+        reloaded.close()
+
+if __name__ == '__main__':
+    unittest.main()
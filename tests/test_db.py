@@ -1,19 +1,35 @@
 import os
+import glob
+import tempfile
 import unittest
+from abc import ABCMeta, abstractmethod
 from datetime import datetime, timedelta
 import math
+import numpy as np
+import bson
+from pymongo import monitoring
 
-from src.db import MongoDB
+from src.db import BaseDB, MongoDB, COLLECTION_LAYOUT
+from src.longest import month_start
+from src.rollups import floor_time, HOUR
+from src.compaction import day_start, read_archive
+from src.binning import bin_sessions_weekly, get_session_arrays, get_heatmap_week_start
 from dotenv import load_dotenv
 
-class TestMongoDB(unittest.TestCase):
+load_dotenv()
+requires_mongo = unittest.skipUnless(os.getenv('MONGO_URL'), 'MONGO_URL not set')
+
+class DBScenarios(metaclass=ABCMeta):
+    # Scenarios every BaseDB backend has to pass, mixed into a TestCase per backend
     TEST_GUILD = 'test_guild'
     def setUp(self):
-        load_dotenv()
-        mongo_url = os.getenv('MONGO_URL')
-        self.mg_ = MongoDB(mongo_url=mongo_url)
+        self.mg_ = self.create_db()
         self.mg_.delete_guild_data(self.TEST_GUILD)
 
+    @abstractmethod
+    def create_db(self) -> BaseDB:
+        return NotImplemented
+
     def test_blacklist_functions(self):
         b_multiple_users = ['b_user1', 'b_user2']
         self.mg_.add_blacklisted_users(self.TEST_GUILD, b_multiple_users)
@@ -176,5 +192,286 @@ class TestMongoDB(unittest.TestCase):
         self.assertEqual(longest_activities_data[1]['duration'], 60, "Longest duration info incorrect.")
         self.assertEqual(longest_activities_data[1]['user_id'], 'user1', "Longest duration info incorrect.")
 
+    def test_longest_activity_window(self):
+        this_month = month_start(datetime.now())
+        last_month_starttime = this_month - timedelta(days=10)
+        this_month_starttime = max(this_month, datetime.now() - timedelta(hours=1))
+        self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user1', ['activity1'], last_month_starttime, last_month_starttime+timedelta(seconds=600))
+        self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user1', ['activity2'], this_month_starttime, this_month_starttime+timedelta(seconds=60))
+        self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user2', ['activity3'], this_month_starttime, this_month_starttime+timedelta(seconds=120))
+        monthly_user_data = self.mg_.get_longest_activities(self.TEST_GUILD, 'user1', this_month)
+        self.assertEqual([(data['name'], data['duration']) for data in monthly_user_data], [('activity2', 60)], "Monthly longest sessions incorrect.")
+        monthly_guild_data = self.mg_.get_longest_activities(self.TEST_GUILD, None, this_month)
+        self.assertEqual([(data['name'], data['duration']) for data in monthly_guild_data], [('activity3', 120), ('activity2', 60)], "Monthly server longest sessions incorrect.")
+        all_guild_data = self.mg_.get_longest_activities(self.TEST_GUILD)
+        self.assertEqual([data['name'] for data in all_guild_data], ['activity1', 'activity3', 'activity2'], "Server longest sessions incorrect.")
+
+    def test_compaction_keeps_totals(self):
+        old_starttime = day_start(datetime.now()) - timedelta(days=40)
+        for user_id in ['user1', 'user2']:
+            for index in range(5):
+                session_starttime = old_starttime + timedelta(days=index, hours=index)
+                self.mg_.add_user_activities_sample(self.TEST_GUILD, user_id, [f'activity{index%2}'], session_starttime, session_starttime+timedelta(seconds=60*(index+1)))
+            recent_starttime = datetime.now() - timedelta(hours=1)
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, user_id, ['activity1'], recent_starttime, recent_starttime+timedelta(seconds=60))
+        queries = [(None, None), ('user1', None), (None, old_starttime + timedelta(days=2)), (None, datetime.now() - timedelta(days=7))]
+        totals_before = [self.mg_.get_aggregated_activities(self.TEST_GUILD, user_id, from_time) for user_id, from_time in queries]
+        longest_before = self.mg_.get_longest_activities(self.TEST_GUILD)
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            compacted_count = self.mg_.compact_sessions(self.TEST_GUILD, day_start(datetime.now()) - timedelta(days=30), keep_longest=2, archive_dir=archive_dir)
+            archive_files = glob.glob(os.path.join(archive_dir, self.TEST_GUILD, '*.ndjson.gz'))
+            self.assertEqual(len(archive_files), 1, "Compacted sessions not archived.")
+            archived_sessions = read_archive(archive_files[0])
+        self.assertEqual(compacted_count, 6, "Wrong number of sessions compacted.")
+        self.assertEqual(len(archived_sessions), 6, "Archive doesn't hold the compacted sessions.")
+        self.assertEqual(len(self.mg_.get_raw_sessions_data(self.TEST_GUILD)), 6, "Compacted sessions still stored raw.")
+        totals_after = [self.mg_.get_aggregated_activities(self.TEST_GUILD, user_id, from_time) for user_id, from_time in queries]
+        self.assertEqual(totals_after, totals_before, "Compaction changed play time totals.")
+        longest_key = lambda sessions: sorted((session['duration'], session['user_id'], session['name']) for session in sessions[:4])
+        self.assertEqual(longest_key(self.mg_.get_longest_activities(self.TEST_GUILD)), longest_key(longest_before), "Compaction dropped the longest sessions.")
+
+    def test_user_leaderboard(self):
+        old_starttime = datetime.now() - timedelta(days=10)
+        recent_starttime = datetime.now() - timedelta(days=1)
+        for index in range(4):
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, f'user{index}', ['activity1'], old_starttime, old_starttime+timedelta(seconds=600*(4-index)))
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, f'user{index}', ['activity2'], recent_starttime, recent_starttime+timedelta(seconds=60*(index+1)))
+        leaderboard_key = lambda leaderboard: [(entry['user_id'], entry['duration']) for entry in leaderboard]
+        self.assertEqual(leaderboard_key(self.mg_.get_user_leaderboard(self.TEST_GUILD, limit=2)), [('user0', 2460), ('user1', 1920)], "All time leaderboard incorrect.")
+        self.assertEqual(leaderboard_key(self.mg_.get_user_leaderboard(self.TEST_GUILD, from_time=datetime.now() - timedelta(days=7))),
+                         [('user3', 240), ('user2', 180), ('user1', 120), ('user0', 60)], "Weekly leaderboard incorrect.")
+        self.assertEqual(leaderboard_key(self.mg_.get_user_leaderboard(self.TEST_GUILD, 'activity1', limit=1)), [('user0', 2400)], "Game leaderboard incorrect.")
+        self.assertFalse(self.mg_.get_user_leaderboard(self.TEST_GUILD, 'activity3'), "Leaderboard of an unplayed game not empty.")
+
+    def test_iter_sessions(self):
+        first_activity_starttime = datetime.now() - timedelta(days=2)
+        for index in range(7):
+            session_starttime = first_activity_starttime + timedelta(hours=index)
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, f'user{index%2}', ['activity1'], session_starttime, session_starttime+timedelta(seconds=60))
+        session_key = lambda session: (session['name'], session['start_time'], session['duration'])
+        batches = list(self.mg_.iter_sessions(self.TEST_GUILD, batch_size=3))
+        self.assertTrue(all(len(batch) <= 3 for batch in batches), "Batch larger than batch size.")
+        streamed_sessions = [session for batch in batches for session in batch]
+        self.assertEqual(sorted(map(session_key, streamed_sessions)), sorted(map(session_key, self.mg_.get_raw_sessions_data(self.TEST_GUILD))), "Streamed sessions differ from raw sessions.")
+        user_batches = list(self.mg_.iter_sessions(self.TEST_GUILD, 'user1', include_user_id=True))
+        self.assertEqual(sum(len(batch) for batch in user_batches), 3, "User filter not applied.")
+        self.assertTrue(all(session['user_id'] == 'user1' for batch in user_batches for session in batch), "User id missing from sessions.")
+
+@requires_mongo
+class TestMongoDB(DBScenarios, unittest.TestCase):
+    def create_db(self):
+        load_dotenv()
+        mongo_url = os.getenv('MONGO_URL')
+        return MongoDB(mongo_url=mongo_url)
+
+class TestMongoDBHeatmaps(TestMongoDB):
+    def create_db(self):
+        load_dotenv()
+        mongo_url = os.getenv('MONGO_URL')
+        return MongoDB(mongo_url=mongo_url, use_heatmaps=True)
+
+    def test_stored_heatmap_matches_sessions(self):
+        first_activity_starttime = datetime.now() - timedelta(days=20)
+        for index in range(30):
+            session_starttime = first_activity_starttime + timedelta(hours=15*index, minutes=7*index)
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, f'user{index%3}', ['activity1', 'activity2'][:index%2+1], session_starttime, session_starttime+timedelta(minutes=20+index))
+        for user_id in [None, 'user1']:
+            streamed_weights = bin_sessions_weekly(*get_session_arrays(self.mg_.get_raw_sessions_data(self.TEST_GUILD, user_id)))
+            self.assertTrue(np.allclose(self.mg_.get_heatmap(self.TEST_GUILD, user_id), streamed_weights), "Stored heatmap differs from sessions.")
+        stored_weights = self.mg_.get_heatmap(self.TEST_GUILD)
+        self.mg_.rebuild_heatmaps(self.TEST_GUILD)
+        self.assertTrue(np.allclose(self.mg_.get_heatmap(self.TEST_GUILD), stored_weights), "Rebuilt heatmap differs.")
+        week_start = get_heatmap_week_start(datetime.now())
+        recent_sessions = [session for session in self.mg_.get_raw_sessions_data(self.TEST_GUILD) if session['start_time'] >= week_start]
+        self.assertTrue(np.allclose(self.mg_.get_heatmap(self.TEST_GUILD, None, week_start), bin_sessions_weekly(*get_session_arrays(recent_sessions))),
+                        "Weekly heatmap differs from this week's sessions.")
+        self.mg_.reset_user_data(self.TEST_GUILD, 'user1')
+        streamed_weights = bin_sessions_weekly(*get_session_arrays(self.mg_.get_raw_sessions_data(self.TEST_GUILD)))
+        self.assertTrue(np.allclose(self.mg_.get_heatmap(self.TEST_GUILD), streamed_weights), "User reset not removed from guild heatmap.")
+
+class TestMongoDBLongestIndex(TestMongoDB):
+    def create_db(self):
+        load_dotenv()
+        mongo_url = os.getenv('MONGO_URL')
+        return MongoDB(mongo_url=mongo_url, use_longest_index=True)
+
+    def test_longest_index_trim(self):
+        this_month = month_start(datetime.now())
+        for index in range(20):
+            session_starttime = this_month - timedelta(days=1, hours=index)
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user1', [f'activity{index}'], session_starttime, session_starttime+timedelta(seconds=60*(index+1)))
+        longest_before_trim = self.mg_.get_longest_activities(self.TEST_GUILD, 'user1')
+        self.mg_.run_maintenance()
+        self.assertEqual(self.mg_.longest_.longest_db_.count_documents({'guild_id': self.TEST_GUILD}), 15, "Trim kept the wrong number of sessions.")
+        self.assertEqual(self.mg_.get_longest_activities(self.TEST_GUILD, 'user1'), longest_before_trim, "Trim changed the longest sessions.")
+        self.assertEqual(longest_before_trim[0]['duration'], 20*60, "Longest duration info incorrect.")
+
+class TestMongoDBGameNames(TestMongoDB):
+    def create_db(self):
+        load_dotenv()
+        mongo_url = os.getenv('MONGO_URL')
+        return MongoDB(mongo_url=mongo_url, encode_game_names=True)
+
+    def test_game_names_encoded(self):
+        first_activity_starttime = datetime.now() - timedelta(days=2)
+        self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user1', ['activity1'], first_activity_starttime, first_activity_starttime+timedelta(seconds=60))
+        stored_entry = self.mg_.db_[self.TEST_GUILD].find_one({'user_id': 'user1'})
+        self.assertIsInstance(stored_entry['ongoing_sessions'][0]['name'], int, "Game name stored without encoding.")
+        # Sessions from before encoding keep their names until migrated and are merged with encoded ones
+        self.mg_.db_[self.TEST_GUILD].update_one({'user_id': 'user1'}, {'$push': {'sessions': {
+            'name': 'activity1', 'start_time': first_activity_starttime - timedelta(days=1), 'duration': 30.0}}})
+        self.assertEqual(self.mg_.get_aggregated_activities(self.TEST_GUILD, 'user1'), {'activity1': 90}, "Encoded and plain names not merged.")
+        self.assertEqual(self.mg_.encode_game_names(self.TEST_GUILD), 1, "Migration encoded the wrong sessions.")
+        stored_entry = self.mg_.db_[self.TEST_GUILD].find_one({'user_id': 'user1'})
+        self.assertIsInstance(stored_entry['sessions'][0]['name'], int, "Migration didn't encode the session.")
+        self.assertEqual([session['name'] for session in self.mg_.get_raw_sessions_data(self.TEST_GUILD)], ['activity1']*2, "Raw sessions not decoded.")
+
+    def test_unknown_game_not_added(self):
+        first_activity_starttime = datetime.now() - timedelta(days=2)
+        self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user1', ['activity1'], first_activity_starttime, first_activity_starttime+timedelta(seconds=60))
+        self.assertEqual(self.mg_.get_user_leaderboard(self.TEST_GUILD, 'activity1')[0]['user_id'], 'user1', "Leaderboard of an encoded game incorrect.")
+        unknown_name = f'unknown activity {datetime.now().timestamp()}'
+        self.assertEqual(self.mg_.get_user_leaderboard(self.TEST_GUILD, unknown_name), [], "Unknown game has a leaderboard.")
+        self.assertFalse(self.mg_.games_.games_db_.find_one({'name': unknown_name}), "Leaderboard query added the game to the dictionary.")
+
+@requires_mongo
+class TestMongoDBRollups(unittest.TestCase):
+    # Not run over the shared scenarios, rollups count the play time from the hour the window
+    # starts in while raw sessions count the whole sessions started in the window
+    TEST_GUILD = 'test_guild'
+    def setUp(self):
+        load_dotenv()
+        self.raw_db_ = MongoDB(mongo_url=os.getenv('MONGO_URL'))
+        self.mg_ = MongoDB(mongo_url=os.getenv('MONGO_URL'), use_rollups=True)
+        self.mg_.delete_guild_data(self.TEST_GUILD)
+
+    def test_rollups_match_sessions(self):
+        first_hour = (datetime.now() - timedelta(days=3)).replace(minute=0, second=0, microsecond=0)
+        for index in range(40):
+            session_starttime = first_hour + timedelta(hours=2*index, minutes=7*index%40)
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, f'user{index%3}', [f'activity{index%2}'], session_starttime,
+                                                session_starttime+timedelta(minutes=5+index%15))
+        rounded = lambda activities: {name: round(duration, 2) for name, duration in activities.items()}
+        leaderboard = lambda db, game, from_time: {entry['user_id']: round(entry['duration'], 2) for entry in db.get_user_leaderboard(self.TEST_GUILD, game, from_time)}
+        for from_time in [None, first_hour + timedelta(hours=17, minutes=23), datetime.now() - timedelta(days=1)]:
+            for user_id in [None, 'user1']:
+                self.assertEqual(rounded(self.mg_.get_aggregated_activities(self.TEST_GUILD, user_id, from_time)),
+                                 rounded(self.raw_db_.get_aggregated_activities(self.TEST_GUILD, user_id, from_time and floor_time(from_time, HOUR))),
+                                 "Rollups differ from raw sessions.")
+            for game in [None, 'activity1']:
+                self.assertEqual(leaderboard(self.mg_, game, from_time), leaderboard(self.raw_db_, game, from_time and floor_time(from_time, HOUR)),
+                                 "Rollup leaderboard differs from raw sessions.")
+
+    def test_session_across_hours(self):
+        first_hour = (datetime.now() - timedelta(days=2)).replace(minute=0, second=0, microsecond=0)
+        session_starttime = first_hour + timedelta(minutes=40)
+        self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user1', ['activity1'], session_starttime, session_starttime+timedelta(minutes=100))
+        for from_time, minutes in [(None, 100), (first_hour + timedelta(minutes=50), 100), (first_hour + timedelta(hours=1, minutes=15), 80),
+                                   (first_hour + timedelta(hours=2), 20), (first_hour + timedelta(hours=3), 0)]:
+            activities = self.mg_.get_aggregated_activities(self.TEST_GUILD, 'user1', from_time)
+            self.assertEqual(round(activities.get('activity1', 0) / 60), minutes, f"Play time from {from_time} incorrect.")
+            leaderboard = self.mg_.get_user_leaderboard(self.TEST_GUILD, 'activity1', from_time)
+            self.assertEqual(round(leaderboard[0]['duration'] / 60) if leaderboard else 0, minutes, f"Leaderboard from {from_time} incorrect.")
+
+class TestMongoDBSessionCollection(TestMongoDB):
+    def create_db(self):
+        load_dotenv()
+        mongo_url = os.getenv('MONGO_URL')
+        return MongoDB(mongo_url=mongo_url, session_layout=COLLECTION_LAYOUT)
+
+    def test_closed_sessions_in_collection(self):
+        first_activity_starttime = datetime.now() - timedelta(days=2)
+        for index in range(3):
+            session_starttime = first_activity_starttime + timedelta(hours=index)
+            self.mg_.add_user_activities_sample(self.TEST_GUILD, 'user1', ['activity1'], session_starttime, session_starttime+timedelta(seconds=60))
+        stored_entry = self.mg_.db_[self.TEST_GUILD].find_one({'user_id': 'user1'})
+        self.assertFalse(stored_entry.get('sessions'), "Closed sessions stored in the user document.")
+        self.assertEqual(len(stored_entry['ongoing_sessions']), 1, "Ongoing session not kept in the user document.")
+        self.assertEqual(self.mg_.sessions_db_.count_documents({'guild_id': self.TEST_GUILD, 'user_id': 'user1'}), 2, "Closed sessions not in the collection.")
+
+    def test_migrate_sessions(self):
+        load_dotenv()
+        embedded_db = MongoDB(mongo_url=os.getenv('MONGO_URL'))
+        first_activity_starttime = datetime.now() - timedelta(days=2)
+        for index in range(3):
+            session_starttime = first_activity_starttime + timedelta(hours=index)
+            embedded_db.add_user_activities_sample(self.TEST_GUILD, 'user1', ['activity1'], session_starttime, session_starttime+timedelta(seconds=60))
+        embedded_activities = embedded_db.get_aggregated_activities(self.TEST_GUILD, 'user1')
+        self.assertEqual(self.mg_.migrate_sessions_to_collection(self.TEST_GUILD), 2, "Migrated the wrong sessions.")
+        self.assertEqual(self.mg_.get_aggregated_activities(self.TEST_GUILD, 'user1'), embedded_activities, "Migration changed the activities.")
+
+        # A crash after copying leaves the sessions in both places, and a session closed meanwhile is only in the user document
+        migrated_sessions = list(self.mg_.sessions_db_.find({'guild_id': self.TEST_GUILD}, {'_id': 0, 'name': 1, 'start_time': 1, 'duration': 1}))
+        new_session = {'name': 'activity2', 'start_time': first_activity_starttime.replace(microsecond=0) + timedelta(hours=5), 'duration': 30.0}
+        self.mg_.db_[self.TEST_GUILD].update_one({'user_id': 'user1'}, {'$push': {'sessions': {'$each': migrated_sessions + [new_session]}}})
+        self.assertEqual(self.mg_.migrate_sessions_to_collection(self.TEST_GUILD), 3, "Migrated the wrong sessions.")
+        self.assertEqual(self.mg_.sessions_db_.count_documents({'guild_id': self.TEST_GUILD}), 3, "Migration duplicated sessions.")
+        self.assertFalse(self.mg_.db_[self.TEST_GUILD].find_one({'user_id': 'user1'})['sessions'], "Migrated sessions left in the user document.")
+
+class CommandRecorder(monitoring.CommandListener):
+    def __init__(self):
+        self.commands_ = []
+
+    def started(self, event):
+        if event.database_name == MongoDB.DATABASE:
+            self.commands_.append(event.command)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+@requires_mongo
+class TestMongoDBWrites(unittest.TestCase):
+    TEST_GUILD = 'test_guild'
+    recorder_ = None
+
+    @classmethod
+    def setUpClass(cls):
+        # Listeners can only be registered before the client is created and never removed
+        if not TestMongoDBWrites.recorder_:
+            TestMongoDBWrites.recorder_ = CommandRecorder()
+            monitoring.register(TestMongoDBWrites.recorder_)
+
+    def setUp(self):
+        load_dotenv()
+        self.mg_ = MongoDB(mongo_url=os.getenv('MONGO_URL'))
+        self.mg_.delete_guild_data(self.TEST_GUILD)
+
+    def add_tick(self, user_ids, start_time, tick):
+        sample_start = start_time + timedelta(seconds=60*tick)
+        self.recorder_.commands_.clear()
+        round_trips_start = self.mg_.get_round_trip_count()
+        self.mg_.add_activities_samples_bulk(self.TEST_GUILD, [(user_id, ['activity1'], sample_start, sample_start+timedelta(seconds=60)) for user_id in user_ids])
+        return self.mg_.get_round_trip_count() - round_trips_start
+
+    def test_bulk_write_round_trips(self):
+        user_ids = [f'user{index}' for index in range(50)]
+        start_time = datetime.now() - timedelta(days=1)
+        self.add_tick(user_ids, start_time, 0)
+        self.assertEqual(self.add_tick(user_ids, start_time, 1), 2, "Tick not written with one read and one bulk write.")
+        self.assertEqual([next(iter(command)) for command in self.recorder_.commands_], ['find', 'update'], "Unexpected commands for a tick.")
+        self.assertEqual(len(self.recorder_.commands_[1]['updates']), len(user_ids), "Updates not batched into one bulk write.")
+
+    def test_delta_writes(self):
+        start_time = datetime.now() - timedelta(days=1)
+        # Every hour closes the previous session, so the stored history grows while the writes shouldn't
+        update_sizes = dict()
+        for hour in range(20):
+            for tick in range(2):
+                self.add_tick(['user1'], start_time + timedelta(hours=hour), tick)
+                for command in self.recorder_.commands_:
+                    for update in command.get('updates', []):
+                        self.assertNotIn('$set', update['u'], "Session array rewritten instead of updated in place.")
+                        pushed_sessions = [session for field in update['u'].get('$push', {}).values() for session in field['$each']]
+                        self.assertLessEqual(len(pushed_sessions), 1, "Stored sessions written again.")
+                        if hour:
+                            update_sizes.setdefault(tuple(sorted(update['u'])), set()).add(len(bson.encode(update['u'])))
+        stored_entry = self.mg_.db_[self.TEST_GUILD].find_one({'user_id': 'user1'})
+        self.assertEqual(len(stored_entry['sessions']), 19, "Sessions not closed.")
+        self.assertTrue(all(len(sizes) == 1 for sizes in update_sizes.values()), "Update size grows with the history.")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import asyncio
+import unittest
+
+from src.flight import SingleFlight, GuildLimiter, GuildBusyError
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_result(self):
+        async def run():
+            single_flight = SingleFlight()
+            calls = []
+            async def query():
+                calls.append(1)
+                await asyncio.sleep(0.01)
+                return len(calls)
+            results = await asyncio.gather(*[single_flight.do('key', query) for _ in range(5)])
+            other_result = await single_flight.do('other', query)
+            return calls, results, other_result, single_flight.get_in_flight_count()
+        calls, results, other_result, in_flight_count = asyncio.run(run())
+        self.assertEqual(results, [1]*5, "Concurrent calls didn't share the result.")
+        self.assertEqual(other_result, 2, "Different key should run its own computation.")
+        self.assertEqual(len(calls), 2, "Computation ran more often than expected.")
+        self.assertEqual(in_flight_count, 0, "Finished computations still tracked.")
+
+    def test_errors_reach_every_caller(self):
+        async def run():
+            single_flight = SingleFlight()
+            async def failing_query():
+                await asyncio.sleep(0.01)
+                raise ValueError('failed')
+            return await asyncio.gather(*[single_flight.do('key', failing_query) for _ in range(3)], return_exceptions=True)
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(result, ValueError) for result in results), "Error not raised for every caller.")
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        async def run():
+            single_flight = SingleFlight()
+            async def query():
+                await asyncio.sleep(0.02)
+                return 'done'
+            first = asyncio.ensure_future(single_flight.do('key', query))
+            second = asyncio.ensure_future(single_flight.do('key', query))
+            await asyncio.sleep(0.005)
+            first.cancel()
+            return await second
+        self.assertEqual(asyncio.run(run()), 'done', "Cancelling one caller cancelled the shared computation.")
+
+class TestGuildLimiter(unittest.TestCase):
+    def test_limits_per_guild(self):
+        async def run():
+            limiter = GuildLimiter(max_concurrent=1, max_queued=1)
+            running = []
+            max_running = []
+            async def command(guild_id):
+                async with limiter.acquire(guild_id):
+                    running.append(1)
+                    max_running.append(len(running))
+                    await asyncio.sleep(0.01)
+                    running.pop()
+                return 'ok'
+            results = await asyncio.gather(command(1), command(1), command(1), command(2), return_exceptions=True)
+            return results, max(max_running), limiter.get_pending_count(1)
+        results, max_running, pending_count = asyncio.run(run())
+        self.assertEqual(results[:2], ['ok', 'ok'], "Queued command didn't run.")
+        self.assertIsInstance(results[2], GuildBusyError, "Command over the guild limit wasn't rejected.")
+        self.assertEqual(results[3], 'ok', "Other guild was limited by a busy guild.")
+        self.assertEqual(max_running, 2, "More than one command per guild ran at once.")
+        self.assertEqual(pending_count, 0, "Pending count not released.")
+
+if __name__ == '__main__':
+    unittest.main()
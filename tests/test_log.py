@@ -0,0 +1,72 @@
+import json
+import unittest
+
+from src import log as logging
+from src.log import Logger, Level
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+
+    def tearDown(self):
+        logging.set_json_format(False)
+
+    def get_lines(self):
+        logging.flush()
+        return self.lines
+
+    def test_levels_and_lazy_args(self):
+        logger = Logger('Test', level=Level.INFO, log_func=self.lines.append)
+        calls = []
+        def build_message():
+            calls.append(1)
+            return 'built'
+        logger.debug(build_message)
+        logger.info('value', 1, build_message)
+        self.assertEqual(self.get_lines(), ['Test: value 1 built'])
+        self.assertEqual(len(calls), 1)
+
+    def test_global_level(self):
+        logger = Logger('Test', log_func=self.lines.append)
+        logging.set_log_level(Level.WARNING)
+        try:
+            logger.info('hidden')
+            logger.warning('shown')
+        finally:
+            logging.set_log_level(Level.INFO)
+        self.assertEqual(self.get_lines(), ['Test: shown'])
+
+    def test_sampling(self):
+        logger = Logger('Test', log_func=self.lines.append, sample_rate=0.0)
+        for _ in range(10):
+            logger.info('sampled out')
+        logger.error('error')
+        self.assertEqual(self.get_lines(), ['Test: error'])
+
+    def test_rate_limit(self):
+        logger = Logger('Test', log_func=self.lines.append, rate_limit=3)
+        for index in range(10):
+            logger.info(index)
+        self.assertEqual(self.get_lines(), ['Test: 0', 'Test: 1', 'Test: 2'])
+        logger.tokens_ = 1
+        logger.info('after')
+        self.assertEqual(self.get_lines()[-1], 'Test: after (7 records suppressed by rate limit)')
+
+    def test_print_kwargs(self):
+        records = []
+        logger = Logger('Test', log_func=lambda line, **kwargs: records.append((line, kwargs)))
+        logger.info('a', 'b', sep=',', end='')
+        logging.flush()
+        self.assertEqual(records, [('Test:,a,b', {'end': ''})])
+
+    def test_json_format(self):
+        logger = Logger('Test', log_func=self.lines.append)
+        logging.set_json_format(True)
+        logger.info('hello', lambda: 'world')
+        record = json.loads(self.get_lines()[0])
+        self.assertEqual(record['level'], 'INFO')
+        self.assertEqual(record['logger'], 'Test')
+        self.assertEqual(record['message'], 'hello world')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from src.metrics import MetricsRegistry, get_percentile
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_percentile(self):
+        values = sorted(float(value) for value in range(1, 101))
+        self.assertAlmostEqual(get_percentile(values, 50), 50.5)
+        self.assertAlmostEqual(get_percentile(values, 99), 99.01)
+        self.assertEqual(get_percentile([], 50), 0.0)
+        self.assertEqual(get_percentile([3.0], 99), 3.0)
+
+    def test_counters_and_gauges(self):
+        self.registry.inc('commands_total', command='stats')
+        self.registry.inc('commands_total', 2, command='stats')
+        self.registry.inc('commands_total', command='plot')
+        self.registry.set('pending', 3)
+        self.registry.set('pending', 1)
+        self.assertEqual(self.registry.get_counter('commands_total', command='stats'), 3)
+        self.assertEqual(self.registry.get_counter('commands_total', command='plot'), 1)
+        self.assertEqual(self.registry.get_counter('commands_total', command='help'), 0)
+        self.assertEqual(self.registry.get_gauge('pending'), 1)
+
+    def test_histogram_summary(self):
+        for value in range(1, 101):
+            self.registry.observe('latency', value/1000, method='get')
+        summary = self.registry.get_histogram_summary()['latency'][(('method', 'get'),)]
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50'], 0.0505)
+        self.assertAlmostEqual(summary['p99'], 0.09901)
+
+    def test_timed(self):
+        @self.registry.timed('func_seconds', kind='test')
+        def func(value):
+            return value*2
+        self.assertEqual(func(2), 4)
+        with self.assertRaises(ValueError):
+            with self.registry.timer('func_seconds', kind='error'):
+                raise ValueError()
+        summary = self.registry.get_histogram_summary()['func_seconds']
+        self.assertEqual(summary[(('kind', 'test'),)]['count'], 1)
+        self.assertEqual(summary[(('kind', 'error'),)]['count'], 1)
+
+    def test_prometheus_text(self):
+        self.registry.describe('db_seconds', 'Db time')
+        self.registry.inc('calls_total', method='a"b')
+        self.registry.observe('db_seconds', 0.003)
+        self.registry.observe('db_seconds', 0.2)
+        text = self.registry.render_prometheus()
+        self.assertIn('# TYPE calls_total counter\ncalls_total{method="a\\"b"} 1\n', text)
+        self.assertIn('# HELP db_seconds Db time\n# TYPE db_seconds histogram\n', text)
+        self.assertIn('db_seconds_bucket{le="0.0025"} 0\n', text)
+        self.assertIn('db_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('db_seconds_bucket{le="0.25"} 2\n', text)
+        self.assertIn('db_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('db_seconds_count 2\n', text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import time
+import asyncio
+import multiprocessing
+import unittest
+from unittest import mock
+
+import numpy as np
+from src.render import PlotRenderer
+
+def slow_render_heatmap_png(weights: np.ndarray) -> bytes:
+    time.sleep(60)
+    return b''
+
+class TestPlotRenderer(unittest.IsolatedAsyncioTestCase):
+    async def test_timeout_replaces_workers(self):
+        renderer = PlotRenderer(max_workers=1, timeout=1.0)
+        self.addCleanup(renderer.shutdown)
+        stuck_executor = renderer.executor_
+        with mock.patch('src.render.render_heatmap_png', slow_render_heatmap_png):
+            with self.assertRaises(asyncio.TimeoutError):
+                await renderer.render_heatmap(np.zeros((7, 48)))
+        self.assertIsNot(renderer.executor_, stuck_executor, "Render workers not replaced after a timeout.")
+        # The new workers start with the first plot sent to them
+        stuck_processes = multiprocessing.active_children()
+        self.assertTrue(stuck_processes, "Timed out worker not found.")
+
+        renderer.timeout_ = 60.0
+        png_data = (await renderer.render_heatmap(np.zeros((7, 48)))).getvalue()
+        self.assertTrue(png_data.startswith(b'\x89PNG'), "Plot not rendered by the new workers.")
+        await asyncio.sleep(1.5)
+        self.assertFalse(any(process.is_alive() for process in stuck_processes), "Timed out worker still running.")
+
+if __name__ == '__main__':
+    unittest.main()
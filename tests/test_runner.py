@@ -0,0 +1,15 @@
+import os
+import sys
+import subprocess
+import unittest
+
+class TestStartupImports(unittest.TestCase):
+    def test_heavy_libraries_not_imported(self):
+        # A fresh interpreter, the test process has them loaded already
+        code = 'import sys, src.runner; print(" ".join(name for name in ["numpy", "matplotlib"] if name in sys.modules))'
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(result.stdout.strip(), '', "Bot startup imports plotting or array libraries.")
+
+if __name__ == '__main__':
+    unittest.main()
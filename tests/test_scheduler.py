@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+
+from src.scheduler import TrackerScheduler
+
+class TestTrackerScheduler(unittest.TestCase):
+    def test_ticks_on_cadence(self):
+        async def run():
+            async def tick():
+                return 5
+            scheduler = TrackerScheduler(0.02, tick)
+            scheduler.start()
+            await asyncio.sleep(0.11)
+            await scheduler.stop()
+            return scheduler
+        scheduler = asyncio.run(run())
+        records = scheduler.get_records()
+        self.assertTrue(4 <= len(records) <= 7, f"Unexpected tick count {len(records)}.")
+        self.assertTrue(all(record['samples_written'] == 5 for record in records), "Samples written not recorded.")
+        self.assertTrue(all(record['lag'] < 0.02 for record in records), "Ticks drifted behind schedule.")
+        self.assertFalse(scheduler.is_running(), "Scheduler still running after stop.")
+
+    def test_overlapping_ticks_skipped(self):
+        async def run():
+            running_ticks = []
+            max_running = []
+            async def slow_tick():
+                running_ticks.append(1)
+                max_running.append(len(running_ticks))
+                await asyncio.sleep(0.05)
+                running_ticks.pop()
+            scheduler = TrackerScheduler(0.02, slow_tick)
+            scheduler.start()
+            await asyncio.sleep(0.15)
+            await scheduler.stop()
+            return scheduler, max(max_running)
+        scheduler, max_running = asyncio.run(run())
+        self.assertEqual(max_running, 1, "Ticks overlapped.")
+        self.assertTrue(scheduler.get_stats()['skipped_ticks'] > 0, "Overdue ticks were not skipped.")
+
+    def test_stop_waits_for_running_tick(self):
+        async def run():
+            finished = []
+            async def tick():
+                await asyncio.sleep(0.03)
+                finished.append(1)
+            scheduler = TrackerScheduler(1.0, tick)
+            scheduler.start()
+            await asyncio.sleep(0.01)
+            await scheduler.stop()
+            return finished
+        self.assertEqual(asyncio.run(run()), [1], "Stop didn't wait for the running tick.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import os
+import tempfile
+import unittest
+
+from src.sqlite_db import SQLiteDB
+from tests.test_db import DBScenarios
+
+class TestSQLiteDB(DBScenarios, unittest.TestCase):
+    def create_db(self):
+        return SQLiteDB(sqlite_path=':memory:')
+
+    def test_blacklist_cache(self):
+        with tempfile.TemporaryDirectory() as db_dir:
+            sqlite_path = os.path.join(db_dir, 'timetrak.db')
+            cached_db = SQLiteDB(sqlite_path=sqlite_path)
+            other_db = SQLiteDB(sqlite_path=sqlite_path)
+            other_db.add_blacklisted_users(self.TEST_GUILD, ['user1'])
+            self.assertEqual(cached_db.get_blacklisted_user_set(self.TEST_GUILD), {'user1'}, "Blacklist not loaded.")
+            round_trips_start = cached_db.get_round_trip_count()
+            cached_db.get_blacklisted_user_set(self.TEST_GUILD)
+            self.assertEqual(cached_db.get_round_trip_count(), round_trips_start, "Cached blacklist read from the db.")
+            other_db.remove_blacklisted_users(self.TEST_GUILD, ['user1'])
+            self.assertEqual(cached_db.get_blacklisted_user_set(self.TEST_GUILD), {'user1'}, "Blacklist refreshed before the refresh time.")
+            cached_db.refresh_blacklists()
+            self.assertEqual(cached_db.get_blacklisted_user_set(self.TEST_GUILD), set(), "Change from another connection not picked up.")
+            cached_db.close()
+            other_db.close()
+
+if __name__ == '__main__':
+    unittest.main()
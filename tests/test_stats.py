@@ -0,0 +1,99 @@
+import unittest
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+from src.stats import create_heatmap_figure, render_heatmap_png
+from src.binning import bin_sessions_weekly, get_session_arrays, get_heatmap_week_start, split_by_heatmap_weeks, HEATMAP_TIME_OFFSET, WEEK
+
+def minute_bin_sessions(sessions_data):
+    weights = np.zeros((7, 48))
+    for session in sessions_data:
+        start_timestamp = session['start_time'] + HEATMAP_TIME_OFFSET
+        for minute in range(int(session['duration'] // 60)):
+            timestamp = start_timestamp + timedelta(minutes=minute)
+            weights[timestamp.weekday()][timestamp.hour*2 + timestamp.minute//30] += 60
+    return weights
+
+def split_bin_sessions(sessions_data):
+    # Splits every session at the half hour boundaries and adds each part to its bin
+    weights = np.zeros((7, 48))
+    for session in sessions_data:
+        start_timestamp = session['start_time'] + HEATMAP_TIME_OFFSET
+        end_timestamp = start_timestamp + timedelta(seconds=session['duration'])
+        while start_timestamp < end_timestamp:
+            bin_start = start_timestamp.replace(minute=start_timestamp.minute//30*30, second=0, microsecond=0)
+            next_timestamp = min(end_timestamp, bin_start + timedelta(minutes=30))
+            weights[start_timestamp.weekday()][start_timestamp.hour*2 + start_timestamp.minute//30] += (next_timestamp - start_timestamp).total_seconds()
+            start_timestamp = next_timestamp
+    return weights
+
+class TestHeatmapBinning(unittest.TestCase):
+    def test_single_bin_session(self):
+        start_time = datetime(2021, 1, 4, 10, 5) - HEATMAP_TIME_OFFSET
+        weights = bin_sessions_weekly(*get_session_arrays([{'start_time': start_time, 'duration': 600.0}]))
+        self.assertEqual(weights[0][20], 600, "Session inside one bin not binned correctly.")
+        self.assertEqual(weights.sum(), 600, "Session time added outside its bin.")
+
+    def test_week_wrapping_session(self):
+        start_time = datetime(2021, 1, 10, 23, 0) - HEATMAP_TIME_OFFSET
+        sessions_data = [{'start_time': start_time, 'duration': 3600.0*2}]
+        weights = bin_sessions_weekly(*get_session_arrays(sessions_data))
+        self.assertTrue(np.allclose(weights, minute_bin_sessions(sessions_data)), "Session over sunday midnight not binned correctly.")
+
+    def test_multi_week_session(self):
+        start_time = datetime(2021, 1, 6, 7, 15) - HEATMAP_TIME_OFFSET
+        sessions_data = [{'start_time': start_time, 'duration': 3600.0*24*15}]
+        weights = bin_sessions_weekly(*get_session_arrays(sessions_data))
+        self.assertAlmostEqual(weights.sum(), 3600.0*24*15, msg="Total time of multi week session changed.")
+        self.assertTrue(np.allclose(weights, minute_bin_sessions(sessions_data)), "Multi week session not binned correctly.")
+
+    def test_matches_split_binning(self):
+        rng = random.Random(7)
+        base_time = datetime(2021, 1, 1)
+        # Starts and durations off the minute and half hour boundaries
+        sessions_data = [{'start_time': base_time + timedelta(seconds=rng.randrange(3600*24*7*8), microseconds=rng.randrange(10**6)),
+                          'duration': rng.uniform(0, 3600*20)} for _ in range(300)]
+        weights = bin_sessions_weekly(*get_session_arrays(sessions_data))
+        self.assertTrue(np.allclose(weights, split_bin_sessions(sessions_data)), "Per bin totals differ from splitting at half hours.")
+
+    def test_matches_minute_binning(self):
+        rng = random.Random(11)
+        base_time = datetime(2021, 1, 1)
+        sessions_data = [{'start_time': base_time + timedelta(minutes=rng.randrange(60*24*7*8)), 'duration': 60.0*rng.randrange(0, 900)}
+                         for _ in range(200)]
+        weights = bin_sessions_weekly(*get_session_arrays(sessions_data))
+        self.assertTrue(np.allclose(weights, minute_bin_sessions(sessions_data)), "Per bin totals differ from minute binning.")
+
+    def test_empty_sessions(self):
+        weights = bin_sessions_weekly(*get_session_arrays([]))
+        self.assertEqual(weights.shape, (7, 48), "Empty heatmap has the wrong shape.")
+        self.assertFalse(weights.any(), "Empty heatmap has play time.")
+
+    def test_heatmap_weeks(self):
+        # 2021-01-04 was a Monday
+        week_start = datetime(2021, 1, 4) - HEATMAP_TIME_OFFSET
+        self.assertEqual(get_heatmap_week_start(week_start), week_start, "Week start moved.")
+        self.assertEqual(get_heatmap_week_start(week_start + timedelta(days=3, hours=5)), week_start, "Wrong week start mid week.")
+        self.assertEqual(get_heatmap_week_start(week_start - timedelta(seconds=1)), week_start - WEEK, "Wrong week start before Monday.")
+        start_time = week_start - timedelta(hours=1)
+        parts = split_by_heatmap_weeks(start_time, start_time + WEEK + timedelta(hours=3))
+        self.assertEqual(parts, [(week_start - WEEK, start_time, 3600.0), (week_start, week_start, WEEK.total_seconds()),
+                                 (week_start + WEEK, week_start + WEEK, 7200.0)], "Range not split on heatmap weeks.")
+        week_weights = sum(bin_sessions_weekly(*get_session_arrays([{'start_time': part_start, 'duration': duration}]))
+                           for _, part_start, duration in parts)
+        full_weights = bin_sessions_weekly(*get_session_arrays([{'start_time': start_time, 'duration': (WEEK + timedelta(hours=3)).total_seconds()}]))
+        self.assertTrue(np.allclose(week_weights, full_weights), "Split weeks don't add up to the whole range.")
+
+class TestHeatmapRendering(unittest.TestCase):
+    def test_tick_labels(self):
+        axes = create_heatmap_figure(np.zeros((7, 48))).axes[0]
+        self.assertEqual([label.get_text() for label in axes.get_xticklabels()], ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'], "Wrong weekday labels.")
+        self.assertEqual([label.get_text() for label in axes.get_yticklabels()], [str(hour) for hour in range(25)], "Wrong hour labels.")
+        self.assertEqual(list(axes.get_yticks()), list(range(0, 49, 2)), "Hour labels at the wrong bins.")
+
+    def test_render_png(self):
+        self.assertTrue(render_heatmap_png(np.ones((7, 48))).startswith(b'\x89PNG'), "Heatmap not rendered as PNG.")
+
+if __name__ == '__main__':
+    unittest.main()